@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the `esphome` CLI used by the benchmarks.
+
+Supports the commands server.py calls (compile, run, upload, config) and
+prints output shaped like a real ESPHome/PlatformIO run: configuration and
+codegen lines, "Compiling ...o" per object, linking, RAM/Flash usage and OTA
+upload progress. `compile`/`run` write a deterministic firmware.bin where
+server.py looks for it (.esphome/build/<name>/.pioenvs/<name>/firmware.bin);
+like PlatformIO, an up-to-date firmware.bin is left alone (no objects
+compiled, mtime unchanged).
+
+Timing knobs (ENV):
+    FAKE_ESPHOME_OBJECTS    objects per compile (default 40)
+    FAKE_ESPHOME_OBJ_DELAY  seconds per object (default 0.005)
+    FAKE_ESPHOME_UPLOAD     seconds for an OTA upload (default 0.2)
+    FAKE_ESPHOME_BIN_KB     firmware size in KiB (default 900)
+    FAKE_ESPHOME_FAIL       substring; configs containing it fail to compile
+"""
+import hashlib
+import os
+import re
+import sys
+import time
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, default))
+    except ValueError:
+        return default
+
+
+def _node_name(text: str, fallback: str) -> str:
+    subs = dict(re.findall(r'^\s+(\w+):\s*["\']?([^"\'\n#]+?)["\']?\s*$',
+                           text.split("esphome:", 1)[0], re.M))
+    m = re.search(r'^esphome:\s*\n(?:\s+.*\n)*?\s+name:\s*["\']?([^"\'\n#]+?)["\']?\s*$', text, re.M)
+    name = m.group(1) if m else fallback
+    return re.sub(r'\$\{(\w+)\}|\$(\w+)', lambda x: subs.get(x.group(1) or x.group(2), x.group(0)), name)
+
+
+def _say(line: str, delay: float = 0.0) -> None:
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+    if delay:
+        time.sleep(delay)
+
+
+def _firmware(text: str) -> bytes:
+    size = int(_env_float("FAKE_ESPHOME_BIN_KB", 900)) * 1024
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return (b"\xe9" + seed * (size // len(seed) + 1))[:size]
+
+
+def _up_to_date(path: str, blob: bytes) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read() == blob
+    except OSError:
+        return False
+
+
+def _compile(yaml_file: str, text: str, name: str) -> int:
+    objects = int(_env_float("FAKE_ESPHOME_OBJECTS", 40))
+    obj_delay = _env_float("FAKE_ESPHOME_OBJ_DELAY", 0.005)
+    _say(f"INFO ESPHome 2099.1.0 (benchmark stub)")
+    _say(f"INFO Reading configuration {yaml_file}...", 0.02)
+    _say("INFO Generating C++ source...", 0.02)
+    _say("INFO Compiling app...")
+    _say(f"Processing {name} (board: esp32dev; framework: arduino; platform: platformio/espressif32)")
+    _say("-" * 80)
+    fail = os.environ.get("FAKE_ESPHOME_FAIL")
+    env_dir = f".pioenvs/{name}"
+    out_dir = os.path.join(".esphome", "build", name, ".pioenvs", name)
+    bin_path = os.path.join(out_dir, "firmware.bin")
+    blob = _firmware(text)
+    if not (fail and fail in text) and _up_to_date(bin_path, blob):
+        # nichts geändert: PlatformIO baut nichts neu und fasst firmware.bin nicht an
+        _say("Checking size " + f"{env_dir}/firmware.elf", obj_delay)
+        _say("RAM:   [=         ]  11.2% (used 36712 bytes from 327680 bytes)")
+        _say("Flash: [=====     ]  52.3% (used 959461 bytes from 1835008 bytes)")
+        _say("========================= [SUCCESS] Took 0.50 seconds =========================")
+        _say("INFO Successfully compiled program.")
+        return 0
+    for i in range(objects):
+        where = "FrameworkArduino" if i < objects // 2 else "src/esphome/components"
+        _say(f"Compiling {env_dir}/{where}/obj{i:03d}.cpp.o", obj_delay)
+        if i == objects // 3:
+            _say(f"src/esphome/components/obj{i:03d}.cpp:12:5: warning: unused variable 'x' [-Wunused-variable]")
+    if fail and fail in text:
+        _say(f"src/main.cpp:42:1: error: expected ';' before '}}' token")
+        _say(f"*** [{env_dir}/src/main.cpp.o] Error 1")
+        _say("========================= [FAILED] Took 1.00 seconds =========================")
+        return 1
+    _say(f"Linking {env_dir}/firmware.elf", obj_delay * 4)
+    _say("RAM:   [=         ]  11.2% (used 36712 bytes from 327680 bytes)")
+    _say("Flash: [=====     ]  52.3% (used 959461 bytes from 1835008 bytes)")
+    _say(f"Building {env_dir}/firmware.bin", obj_delay * 2)
+
+    os.makedirs(out_dir, exist_ok=True)
+    tmp = bin_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, bin_path)
+    _say("========================= [SUCCESS] Took 1.00 seconds =========================")
+    _say("INFO Successfully compiled program.")
+    return 0
+
+
+def _upload(args) -> int:
+    duration = _env_float("FAKE_ESPHOME_UPLOAD", 0.2)
+    target = args[args.index("--device") + 1] if "--device" in args else "OTA"
+    _say(f"INFO Connecting to {target}")
+    _say("INFO Uploading firmware.bin (921600 bytes)")
+    for pct in range(0, 101, 10):
+        sys.stdout.write(f"Uploading: [{'=' * (pct // 10):<10}] {pct}% \r")
+        sys.stdout.flush()
+        time.sleep(duration / 11)
+    _say("")
+    _say("INFO OTA successful")
+    return 0
+
+
+def main(argv) -> int:
+    if argv[:1] == ["version"]:
+        _say("Version: 2099.1.0")
+        return 0
+    if len(argv) < 2:
+        _say("usage: esphome <command> <config.yaml> [...]")
+        return 2
+    cmd, yaml_file, rest = argv[0], argv[1], argv[2:]
+    try:
+        with open(yaml_file, encoding="utf-8") as f:
+            text = f.read()
+    except OSError as e:
+        _say(f"ERROR {e}")
+        return 2
+    name = _node_name(text, os.path.splitext(os.path.basename(yaml_file))[0])
+
+    if cmd == "config":
+        _say(f"INFO Reading configuration {yaml_file}...", 0.05)
+        fail = os.environ.get("FAKE_ESPHOME_FAIL")
+        if fail and fail in text:
+            _say("ERROR Failed config")
+            return 1
+        _say("INFO Configuration is valid!")
+        return 0
+    if cmd == "compile":
+        return _compile(yaml_file, text, name)
+    if cmd == "run":
+        rc = _compile(yaml_file, text, name)
+        return rc if rc else _upload(rest)
+    if cmd == "upload":
+        return _upload(rest)
+    _say(f"ERROR unknown command {cmd}")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
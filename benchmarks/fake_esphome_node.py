@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+ESPHome node stand-in for fingerprinting tests.
+
+Binds every node IP (<net>.1 ... <net>.<count>) and serves
+  * the native API (plaintext): HelloResponse + DeviceInfoResponse, like
+    a device without encryption; with --encrypted every node answers with
+    the Noise indicator byte instead (encrypted API),
+  * the web server on --http-port: with --web-version 1 an index page titled
+    with the friendly name; with 2/3 (default 1) a page without <title> and
+    an /events stream whose first "ping" carries the friendly name.
+
+Node i is named <prefix>_<i> with MAC aa:bb:cc:<i>, same as
+fake_mdns_responder.py, so both can run side by side:
+    python3 benchmarks/fake_esphome_node.py --count 20 &
+    curl 'localhost:8099/scan?cidr=127.0.88.0/27&ports=6053,80'
+
+Add --slow N to have every node wait N seconds before answering
+(deadline tests).
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+
+def varint(n: int) -> bytes:
+    out = b""
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out += bytes([b | 0x80])
+        else:
+            return out + bytes([b])
+
+
+def pb_string(num: int, value: str) -> bytes:
+    raw = value.encode("utf-8")
+    return varint(num << 3 | 2) + varint(len(raw)) + raw
+
+
+def pb_uint(num: int, value: int) -> bytes:
+    return varint(num << 3) + varint(value)
+
+
+def frame(msg_type: int, body: bytes) -> bytes:
+    return b"\0" + varint(len(body)) + varint(msg_type) + body
+
+
+async def read_varint(reader: asyncio.StreamReader) -> int:
+    n = shift = 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n
+        shift += 7
+
+
+class Node:
+    def __init__(self, i: int, args):
+        self.name = f"{args.name_prefix}_{i:04d}"
+        self.friendly = f"Bench {i}"
+        self.ip = f"{args.net}.{1 + i % 254}"
+        self.mac = "AA:BB:CC:%02X:%02X:%02X" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        self.args = args
+
+    async def api(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.sleep(self.args.slow)
+            while True:
+                if (await reader.readexactly(1))[0] != 0:
+                    break
+                if self.args.encrypted:
+                    # Noise-Gerät: Fehler-Frame mit Indikator 0x01, dann zu
+                    writer.write(b"\x01\x00\x0f\x01Bad indicator byte")
+                    break
+                length = await read_varint(reader)
+                msg_type = await read_varint(reader)
+                await reader.readexactly(length)
+                if msg_type == 1:     # HelloRequest
+                    body = (pb_uint(1, 1) + pb_uint(2, 10)
+                            + pb_string(3, f"{self.name} (esphome v{self.args.version})")
+                            + pb_string(4, self.name))
+                    writer.write(frame(2, body))
+                elif msg_type == 9:   # DeviceInfoRequest
+                    body = (pb_string(2, self.name) + pb_string(3, self.mac)
+                            + pb_string(4, self.args.version)
+                            + pb_string(5, "Jan  1 2099, 00:00:00") + pb_string(6, "esp32dev")
+                            + pb_uint(10, self.args.http_port) + pb_string(12, "Espressif")
+                            + pb_string(13, self.friendly))
+                    writer.write(frame(10, body))
+                elif msg_type == 5:   # DisconnectRequest
+                    writer.write(frame(6, b""))
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.sleep(self.args.slow)
+            head = await reader.readuntil(b"\r\n\r\n")
+            if self.args.web_version > 1 and head.startswith(b"GET /events "):
+                ping = json.dumps({"title": self.friendly, "comment": "", "ota": True, "log": True,
+                                   "lang": "en"})
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                             b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n"
+                             + f"retry: 30000\nid: 1\nevent: ping\ndata: {ping}\n\n".encode())
+                await writer.drain()
+                await asyncio.sleep(30)   # SSE bleibt offen wie auf dem Gerät
+                return
+            title = f"<title>{self.friendly}</title>" if self.args.web_version == 1 else ""
+            body = (f"<!DOCTYPE html><html><head>{title}<meta charset=UTF-8></head>"
+                    "<body><esp-app></esp-app>"
+                    "<script src=\"https://oi.esphome.io/v3/www.js\"></script></body></html>").encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: "
+                         + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args) -> None:
+    servers = []
+    for i in range(args.count):
+        node = Node(i, args)
+        servers.append(await asyncio.start_server(node.api, node.ip, args.api_port))
+        if args.http_port:
+            servers.append(await asyncio.start_server(node.http, node.ip, args.http_port))
+    print(f"{args.count} nodes on {args.net}.1-{args.count} (api :{args.api_port}, http :{args.http_port})",
+          flush=True)
+    await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=10, help="number of nodes (max 254)")
+    ap.add_argument("--net", default="127.0.88", help="first three octets of the node IPs")
+    ap.add_argument("--name-prefix", default="bench")
+    ap.add_argument("--version", default="2099.1.0", help="reported ESPHome version")
+    ap.add_argument("--api-port", type=int, default=6053)
+    ap.add_argument("--http-port", type=int, default=80, help="0 = no web server")
+    ap.add_argument("--web-version", type=int, default=1, choices=(1, 2, 3),
+                    help="web_server version (2/3: no <title>, name via /events)")
+    ap.add_argument("--encrypted", action="store_true", help="answer like a Noise-encrypted API")
+    ap.add_argument("--slow", type=float, default=0.0, help="seconds before answering")
+    args = ap.parse_args()
+    args.count = min(args.count, 254)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+mDNS responder stand-in announcing fake ESPHome nodes (_esphomelib._tcp).
+
+Per node it sends what an ESPHome device sends: PTR for the service, SRV
+(<name>.local:6053), TXT (version, mac, platform, board, network,
+friendly_name) and an A record. Nodes are announced on start, queries for
+the service / an instance / a host are answered, and goodbye packets
+(TTL 0) are sent on exit.
+
+Use a non-default port to stay off the real LAN:
+    python3 benchmarks/fake_mdns_responder.py --count 20 --port 15353 &
+    ESPFLASHER_MDNS_PORT=15353 python3 espflasher_web/server.py
+    curl localhost:8099/api/discovery/mdns
+
+Node i is named <prefix>_<i> (bench_0000 ...) with IP <net>.<1 + i % 254>,
+so it matches the registry load_test.py generates.
+"""
+import argparse
+import signal
+import socket
+import struct
+import sys
+import time
+
+GROUP = "224.0.0.251"
+SERVICE = "_esphomelib._tcp.local"
+A, PTR, TXT, SRV = 1, 12, 16, 33
+
+
+def encode_name(name: str) -> bytes:
+    out = b""
+    for label in name.rstrip(".").split("."):
+        raw = label.encode("utf-8")
+        out += bytes([len(raw)]) + raw
+    return out + b"\0"
+
+
+def read_name(buf: bytes, off: int):
+    labels, end = [], None
+    while True:
+        n = buf[off]
+        if n & 0xC0 == 0xC0:
+            end = end or off + 2
+            off = ((n & 0x3F) << 8) | buf[off + 1]
+            continue
+        off += 1
+        if n == 0:
+            return ".".join(labels), end or off
+        labels.append(buf[off:off + n].decode("utf-8", "replace"))
+        off += n
+
+
+def record(name: str, rtype: int, ttl: int, rdata: bytes, flush: bool = True) -> bytes:
+    rclass = 0x8001 if flush else 1   # cache-flush Bit wie bei ESPHome
+    return encode_name(name) + struct.pack("!HHIH", rtype, rclass, ttl, len(rdata)) + rdata
+
+
+class Node:
+    def __init__(self, i: int, args):
+        self.name = f"{args.name_prefix}_{i:04d}"
+        self.instance = f"{self.name}.{SERVICE}"
+        self.host = f"{self.name}.local"
+        self.ip = f"{args.net}.{1 + i % 254}"
+        self.txt = {
+            "version": args.version,
+            "mac": "aabbcc%06x" % i,
+            "platform": "ESP32" if i % 3 else "ESP8266",
+            "board": "esp32dev" if i % 3 else "d1_mini",
+            "network": "wifi",
+            "friendly_name": f"Bench {i}",
+        }
+
+    def packet(self, ttl_scale: float = 1.0) -> bytes:
+        """Response with PTR as answer and SRV/TXT/A as additional records."""
+        ptr_ttl, host_ttl = int(4500 * ttl_scale), int(120 * ttl_scale)
+        txt = b"".join(bytes([len(e)]) + e for e in (f"{k}={v}".encode() for k, v in self.txt.items()))
+        answers = [record(SERVICE, PTR, ptr_ttl, encode_name(self.instance), flush=False)]
+        extra = [
+            record(self.instance, SRV, host_ttl, struct.pack("!HHH", 0, 0, 6053) + encode_name(self.host)),
+            record(self.instance, TXT, ptr_ttl, txt),
+            record(self.host, A, host_ttl, socket.inet_aton(self.ip)),
+        ]
+        header = struct.pack("!6H", 0, 0x8400, 0, len(answers), 0, len(extra))
+        return header + b"".join(answers) + b"".join(extra)
+
+
+def questions(buf: bytes):
+    _, flags, qd = struct.unpack("!3H", buf[:6])
+    if flags & 0x8000:
+        return
+    off = 12
+    for _ in range(qd):
+        name, off = read_name(buf, off)
+        qtype = struct.unpack("!H", buf[off:off + 2])[0]
+        off += 4
+        yield name.lower(), qtype
+
+
+def open_socket(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    struct.pack("4s4s", socket.inet_aton(GROUP), socket.inet_aton("0.0.0.0")))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    return sock
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=10, help="number of nodes")
+    ap.add_argument("--port", type=int, default=15353, help="mDNS port (5353 = real LAN)")
+    ap.add_argument("--net", default="127.0.88", help="first three octets of the node IPs")
+    ap.add_argument("--name-prefix", default="bench")
+    ap.add_argument("--version", default="2099.1.0", help="ESPHome version in TXT")
+    ap.add_argument("--quiet", action="store_true", help="no unsolicited announcements on start")
+    args = ap.parse_args()
+
+    nodes = [Node(i, args) for i in range(args.count)]
+    by_name = {}
+    for n in nodes:
+        by_name[n.instance.lower()] = n
+        by_name[n.host.lower()] = n
+    sock = open_socket(args.port)
+    dest = (GROUP, args.port)
+
+    def _goodbye(*_):
+        for n in nodes:
+            sock.sendto(n.packet(ttl_scale=0), dest)
+        print(f"goodbye sent for {len(nodes)} nodes")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _goodbye)
+    signal.signal(signal.SIGINT, _goodbye)
+
+    if not args.quiet:
+        for n in nodes:
+            sock.sendto(n.packet(), dest)
+    print(f"announcing {len(nodes)} nodes on {GROUP}:{args.port}", flush=True)
+
+    while True:
+        data, src = sock.recvfrom(9000)
+        try:
+            qs = list(questions(data))
+        except (IndexError, struct.error):
+            continue
+        reply = []
+        for qname, qtype in qs:
+            if qname == SERVICE and qtype == PTR:
+                reply = nodes
+                break
+            n = by_name.get(qname)
+            if n is not None and n not in reply:
+                reply.append(n)
+        for n in reply:
+            sock.sendto(n.packet(), dest)
+            time.sleep(0.001)   # Burst etwas strecken, wie echte Geräte (20-120 ms Jitter)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Load/latency benchmark for server.py with a stub toolchain.
+
+For every registry size (default 10, 100, 1000 devices) this
+  * builds a temp data dir with a synthetic devices.json (legacy inline
+    format, so startup migration is part of the run) and the device YAMLs,
+  * copies the real www bundle (static assets),
+  * puts benchmarks/fake_esphome.py on PATH as `esphome`,
+  * opens loopback TCP listeners on 127.0.88.x standing in for the nodes,
+  * starts `python server.py` as a subprocess (ESPFLASHER_* env, own port)
+and drives concurrent HTTP load against /ping, /api/devices*, static assets,
+/compile (fresh, cached, and forced rebuilds of an unchanged config), OTA
+/flash and /scan. Per scenario it reports p50/p95/p99/max latency,
+throughput and errors.
+
+Results are compared against benchmarks/baseline.json (written with
+--save-baseline); latencies or throughput that are worse than --tolerance
+are flagged. The baseline is machine-specific: record it on the machine you
+compare on.
+
+Usage:
+    python3 benchmarks/load_test.py                     # all sizes, compare with baseline
+    python3 benchmarks/load_test.py --sizes 100 --quick
+    python3 benchmarks/load_test.py --save-baseline
+    python3 benchmarks/load_test.py --only devices,static --json out.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+SERVER = os.path.join(REPO, "espflasher_web", "server.py")
+WWW_SRC = os.path.join(REPO, "espflasher_web", "www")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+STATIC_PROBES = ("/main.dart.js", "/assets/assets/icons/esphome_mdi_icons.json")
+
+NODE_PREFIX = "127.0.88"
+NODE_PORT = 16053
+
+
+# ---------------------------------------------------------------------------
+# Fixture
+# ---------------------------------------------------------------------------
+def _device_yaml(name: str, platform: str, board: str) -> str:
+    block = "esp8266" if platform == "ESP8266" else "esp32"
+    return (
+        f"esphome:\n  name: {name}\n\n{block}:\n  board: {board}\n\n"
+        "logger:\n\napi:\n\nota:\n  - platform: esphome\n\n"
+        "wifi:\n  ssid: \"bench\"\n  password: \"bench-password\"\n\n"
+        "sensor:\n  - platform: uptime\n    name: Uptime\n"
+    )
+
+
+def make_fixture(root: str, n_devices: int) -> dict:
+    data = os.path.join(root, "data")
+    yaml_dir = os.path.join(data, "yaml")
+    os.makedirs(yaml_dir)
+    shutil.copytree(WWW_SRC, os.path.join(root, "www"), ignore=shutil.ignore_patterns("firmware"))
+
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir)
+    stub = os.path.join(bin_dir, "esphome")
+    with open(stub, "w") as f:
+        f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.join(HERE, 'fake_esphome.py')}\" \"$@\"\n")
+    os.chmod(stub, 0o755)
+
+    rnd = random.Random(n_devices)
+    devices = []
+    for i in range(n_devices):
+        platform = "ESP32" if i % 3 else "ESP8266"
+        board = "esp32dev" if platform == "ESP32" else "d1_mini"
+        name = f"bench_{i:04d}"
+        text = _device_yaml(name, platform, board)
+        with open(os.path.join(yaml_dir, f"{name}.yaml"), "w") as f:
+            f.write(text)
+        devices.append({
+            "id": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "name": name,
+            "friendly_name": f"Bench {i}",
+            "platform": platform,
+            "board": board,
+            "board_id": board,
+            "board_label": board,
+            "yaml": text,
+            "yaml_snapshot": text,
+            "config_json": {"sensors": [{"platform": "uptime", "name": "Uptime"}] * 5},
+            "firmware_sha256": None,
+            "ip": f"{NODE_PREFIX}.{1 + i % 254}",
+            "mac": "AA:BB:CC:%02X:%02X:%02X" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "tags": ["bench", "even" if i % 2 == 0 else "odd"],
+            "notes": "",
+            "flashed_at": "2024-01-01T00:00:00+00:00",
+            "history": [{"flashed_at": "2023-12-01T00:00:00+00:00", "firmware_sha256": "0" * 64}] * 3,
+        })
+    with open(os.path.join(data, "devices.json"), "w") as f:
+        json.dump({"devices": devices, "version": 1}, f)
+    return {"data": data, "www": os.path.join(root, "www"), "bin": bin_dir, "devices": devices}
+
+
+class NodeFarm:
+    """Accepting listeners on NODE_PREFIX.1-254:NODE_PORT (ESPHome API port stand-ins)."""
+
+    def __init__(self, count: int = 254):
+        self.socks = []
+        for i in range(1, count + 1):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((f"{NODE_PREFIX}.{i}", NODE_PORT))
+            s.listen(64)
+            s.setblocking(False)
+            self.socks.append(s)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self) -> None:
+        # Verbindungen annehmen und gleich schließen, damit die Queues nicht volllaufen
+        while not self.stop.is_set():
+            for s in self.socks:
+                try:
+                    while True:
+                        c, _ = s.accept()
+                        c.close()
+                except (BlockingIOError, OSError):
+                    pass
+            time.sleep(0.01)
+
+    def close(self) -> None:
+        self.stop.set()
+        self.thread.join()
+        for s in self.socks:
+            s.close()
+
+
+def _free_port() -> int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class ServerProcess:
+    def __init__(self, fixture: dict, threads: int, workers: int):
+        self.port = _free_port()
+        env = dict(os.environ)
+        env.update({
+            "ESPFLASHER_DATA_DIR": fixture["data"],
+            "ESPFLASHER_WWW_DIR": fixture["www"],
+            "ESPFLASHER_PORT": str(self.port),
+            "ESPFLASHER_SERVER_THREADS": str(threads),
+            "ESPFLASHER_COMPILE_WORKERS": str(workers),
+            "PATH": fixture["bin"] + os.pathsep + env.get("PATH", ""),
+            "PYTHONUNBUFFERED": "1",
+        })
+        self.log = open(os.path.join(os.path.dirname(fixture["data"]), "server.log"), "w")
+        t0 = time.monotonic()
+        self.proc = subprocess.Popen([sys.executable, SERVER], env=env, stdout=self.log,
+                                     stderr=subprocess.STDOUT, cwd=os.path.dirname(SERVER))
+        while True:
+            try:
+                status, _, _ = request(self.port, "GET", "/ping")
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            if self.proc.poll() is not None or time.monotonic() - t0 > 60:
+                raise RuntimeError(f"server did not start, see {self.log.name}")
+            time.sleep(0.05)
+        self.startup = time.monotonic() - t0
+        self._wait_static_warm()
+
+    def _wait_static_warm(self, timeout: float = 60.0) -> None:
+        # Vorkomprimierung läuft im Hintergrund; erst messen, wenn gzip ausgeliefert wird
+        deadline = time.monotonic() + timeout
+        for path in STATIC_PROBES:
+            while time.monotonic() < deadline:
+                _, headers, _ = request(self.port, "GET", path, headers={"Accept-Encoding": "gzip"})
+                if headers.get("Content-Encoding"):
+                    break
+                time.sleep(0.1)
+
+    def close(self) -> None:
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+# ---------------------------------------------------------------------------
+# Load driver
+# ---------------------------------------------------------------------------
+_local = threading.local()
+
+
+def request(port: int, method: str, path: str, body=None, headers=None):
+    """One request on a per-thread keep-alive connection; reads the whole body."""
+    conn = getattr(_local, "conns", {}).get(port)
+    if conn is None:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+        _local.__dict__.setdefault("conns", {})[port] = conn
+    hdrs = dict(headers or {})
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+        hdrs["Content-Type"] = "application/json"
+    try:
+        conn.request(method, path, body=data, headers=hdrs)
+        resp = conn.getresponse()
+        payload = resp.read()
+    except (http.client.HTTPException, OSError):
+        conn.close()
+        _local.conns.pop(port, None)
+        raise
+    return resp.status, resp.headers, payload
+
+
+def run_scenario(port: int, name: str, make_request, count: int, concurrency: int) -> dict:
+    """make_request(i) -> (method, path, body, headers, ok_statuses)."""
+    latencies, errors = [], 0
+    nbytes = 0
+    lock = threading.Lock()
+
+    def _one(i):
+        nonlocal errors, nbytes
+        method, path, body, headers, ok = make_request(i)
+        t0 = time.perf_counter()
+        try:
+            status, _, payload = request(port, method, path, body, headers)
+            good = status in ok
+        except OSError:
+            good, payload = False, b""
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+            nbytes += len(payload)
+            if not good:
+                errors += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(_one, range(count)))
+    wall = time.perf_counter() - t0
+    latencies.sort()
+
+    def _pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+
+    return {
+        "scenario": name,
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": _pct(0.50),
+        "p95_ms": _pct(0.95),
+        "p99_ms": _pct(0.99),
+        "max_ms": round(latencies[-1] * 1000, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "rps": round(count / wall, 2),
+        "kb_per_req": round(nbytes / count / 1024, 1),
+    }
+
+
+def scenarios(fixture: dict, quick: bool):
+    """(group, name, make_request, count, concurrency) per scenario."""
+    k = 0.25 if quick else 1.0
+    devs = fixture["devices"]
+    ids = [d["id"] for d in devs]
+    gz = {"Accept-Encoding": "gzip, br"}
+    n = lambda x: max(2, int(x * k))  # noqa: E731
+
+    def _compile_req(tag):
+        def make(i):
+            yaml = _device_yaml(f"{tag}_{i:03d}", "ESP32", "esp32dev")
+            return "POST", "/compile", {"configuration": yaml}, None, (200,)
+        return make
+
+    cached_yaml = _device_yaml("bench_cached", "ESP32", "esp32dev")
+    out = [
+        ("ping", "ping", lambda i: ("GET", "/ping", None, None, (200,)), n(2000), 16),
+        ("devices", "devices_list", lambda i: ("GET", "/api/devices", None, None, (200,)), n(400), 8),
+        ("devices", "devices_page", lambda i: ("GET", f"/api/devices?limit=50&fields=id,name,ip&tag=even",
+                                               None, None, (200,)), n(400), 8),
+        ("devices", "devices_since", lambda i: ("GET", "/api/devices?since=0&fields=id,revision",
+                                                None, None, (200,)), n(400), 8),
+        ("devices", "devices_full", lambda i: ("GET", "/api/devices?include=full", None, None, (200,)),
+         n(40), 4),
+        ("devices", "device_get", lambda i: ("GET", f"/api/devices/{ids[i % len(ids)]}", None, None, (200,)),
+         n(1000), 8),
+        ("devices", "device_upsert", lambda i: ("POST", "/api/devices", {
+            "id": ids[i % len(ids)], "name": devs[i % len(devs)]["name"],
+            "platform": devs[i % len(devs)]["platform"], "ip": devs[i % len(devs)]["ip"],
+            "tags": devs[i % len(devs)]["tags"], "notes": f"bench {i}"}, None, (200,)), n(300), 4),
+        ("static", "static_index", lambda i: ("GET", "/", None, gz, (200,)), n(500), 8),
+        ("static", "static_main_js", lambda i: ("GET", "/main.dart.js", None, gz, (200,)), n(60), 4),
+        ("static", "static_icons_json", lambda i: ("GET", STATIC_PROBES[1], None, gz, (200,)), n(100), 4),
+        ("catalog", "catalog_icons", lambda i: ("GET", f"/api/catalog/icons?q={['therm', 'wifi', 'li'][i % 3]}"
+                                                       "&limit=20&fields=name", None, None, (200,)), n(500), 8),
+        ("compile", "compile_fresh", _compile_req(f"fresh{random.randrange(1 << 30)}"), n(8), 4),
+        ("compile", "compile_cached", lambda i: ("POST", "/compile", {"configuration": cached_yaml},
+                                                 None, (200,)), n(8), 4),
+        # force=true am Build-Cache vorbei; die Toolchain lässt die unveränderte firmware.bin liegen
+        ("compile", "compile_forced", lambda i: ("POST", "/compile", {"configuration": cached_yaml,
+                                                                      "force": True}, None, (200,)), n(8), 4),
+        ("flash", "flash_ota", lambda i: ("POST", "/flash", {"name": devs[i % len(devs)]["name"],
+                                                             "ip": devs[i % len(devs)]["ip"]},
+                                          None, (200,)), n(6), 3),
+        ("scan", "scan_refresh", lambda i: ("GET", f"/scan?cidr={NODE_PREFIX}.0/24&ports={NODE_PORT}"
+                                                   "&refresh=1&timeout=0.2", None, None, (200,)), n(6), 2),
+        ("scan", "scan_cached", lambda i: ("GET", f"/scan?cidr={NODE_PREFIX}.0/24&ports={NODE_PORT}",
+                                           None, None, (200,)), n(40), 4),
+    ]
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Baseline comparison
+# ---------------------------------------------------------------------------
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Yield (size, scenario, metric, base, now, ratio) for regressions beyond tolerance."""
+    for size, rows in results.items():
+        base_rows = {r["scenario"]: r for r in baseline.get("results", {}).get(size, [])}
+        for row in rows:
+            base = base_rows.get(row["scenario"])
+            if not base:
+                continue
+            for metric in ("p50_ms", "p95_ms"):
+                if base[metric] > 0 and row[metric] > base[metric] * (1 + tolerance) \
+                        and row[metric] - base[metric] > 1.0:   # <1 ms Unterschied ist Rauschen
+                    yield size, row["scenario"], metric, base[metric], row[metric], row[metric] / base[metric]
+            if base["rps"] > 0 and row["rps"] < base["rps"] / (1 + tolerance):
+                yield size, row["scenario"], "rps", base["rps"], row["rps"], row["rps"] / base["rps"]
+            if row["errors"] > base.get("errors", 0):
+                yield size, row["scenario"], "errors", base.get("errors", 0), row["errors"], None
+
+
+def print_table(size: str, rows, startup: float) -> None:
+    print(f"\n== {size} devices (server start {startup * 1000:.0f} ms) ==")
+    print(f"{'scenario':<20}{'req':>6}{'conc':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}{'req/s':>10}{'KiB/req':>9}{'err':>5}")
+    for r in rows:
+        print(f"{r['scenario']:<20}{r['requests']:>6}{r['concurrency']:>6}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['max_ms']:>10}{r['rps']:>10}{r['kb_per_req']:>9}{r['errors']:>5}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10,100,1000", help="registry sizes to test")
+    ap.add_argument("--only", default="", help="comma-separated groups (ping,devices,static,catalog,"
+                                                "compile,flash,scan)")
+    ap.add_argument("--quick", action="store_true", help="quarter of the requests")
+    ap.add_argument("--threads", type=int, default=16, help="server threads")
+    ap.add_argument("--workers", type=int, default=2, help="compile workers")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs. baseline (0.25 = 25%%)")
+    ap.add_argument("--json", help="write results to this file")
+    args = ap.parse_args()
+
+    groups = set(filter(None, args.only.split(",")))
+
+    results, startups = {}, {}
+    farm = NodeFarm()
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            root = tempfile.mkdtemp(prefix=f"espflasher-load-{size}-")
+            try:
+                fixture = make_fixture(root, size)
+                server = ServerProcess(fixture, args.threads, args.workers)
+                try:
+                    rows = []
+                    for group, name, make, count, conc in scenarios(fixture, args.quick):
+                        if groups and group not in groups:
+                            continue
+                        rows.append(run_scenario(server.port, name, make, count, conc))
+                    results[str(size)] = rows
+                    startups[str(size)] = round(server.startup, 3)
+                    print_table(str(size), rows, server.startup)
+                finally:
+                    server.close()
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+    finally:
+        farm.close()
+
+    doc = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"python": sys.version.split()[0], "cpus": os.cpu_count(), "platform": sys.platform},
+        "options": {"quick": args.quick, "threads": args.threads, "workers": args.workers},
+        "startup_s": startups,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(doc, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(doc, f, indent=2)
+        print(f"\nbaseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("\nno baseline yet (run with --save-baseline)")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("options", {}).get("quick") != args.quick:
+        print("\nnote: baseline was recorded with a different --quick setting")
+    regressions = list(compare(results, baseline, args.tolerance))
+    if not regressions:
+        print(f"\nno regressions vs. baseline ({baseline.get('created_at')}, tolerance {args.tolerance:.0%})")
+        return 0
+    print(f"\nREGRESSIONS vs. baseline ({baseline.get('created_at')}):")
+    for size, scenario, metric, base, now, ratio in regressions:
+        change = f"x{ratio:.2f}" if ratio else ""
+        print(f"  {size:>5} {scenario:<20} {metric:<7} {base} -> {now} {change}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
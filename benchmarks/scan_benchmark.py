@@ -0,0 +1,119 @@
+"""
+Scan benchmark against a local listener farm on loopback aliases.
+
+Linux routes all of 127.0.0.0/8 to lo, so every 127.0.x.y is usable without
+any setup. The farm emulates a /24:
+  * "live" hosts accept connections (ESPHome nodes),
+  * "blackhole" hosts have a full accept queue, so SYNs are dropped and the
+    connect runs into the timeout (like an absent host on a real LAN).
+
+Usage:
+    python3 benchmarks/scan_benchmark.py [--prefix 127.0.77] [--live-every 16]
+                                         [--ports 18080,16053] [--sequential]
+"""
+import argparse
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "espflasher_web"))
+_tmp = tempfile.mkdtemp(prefix="espflasher-bench-")
+os.environ.setdefault("ESPFLASHER_DATA_DIR", os.path.join(_tmp, "data"))
+os.environ.setdefault("ESPFLASHER_WWW_DIR", os.path.join(_tmp, "www"))
+
+import server  # noqa: E402
+
+
+def _raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 4096:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(4096, hard), hard))
+
+
+def build_farm(prefix: str, ports, live_every: int):
+    """Return (sockets, expected_live_ips)."""
+    socks, live = [], []
+    for i in range(1, 255):
+        ip = f"{prefix}.{i}"
+        is_live = i % live_every == 0
+        for port in ports:
+            lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            lsock.bind((ip, port))
+            if is_live:
+                lsock.listen(128)
+            else:
+                # Accept-Queue füllen → weitere SYNs werden verworfen
+                lsock.listen(0)
+                for _ in range(2):
+                    c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    c.setblocking(False)
+                    c.connect_ex((ip, port))
+                    socks.append(c)
+            socks.append(lsock)
+        if is_live:
+            live.append(ip)
+    time.sleep(0.2)
+    return socks, live
+
+
+def legacy_scan(prefix: str, ports, timeout: float):
+    """The former /scan loop: one blocking connect after another."""
+    found = []
+    for i in range(1, 255):
+        ip = f"{prefix}.{i}"
+        open_ports = []
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            if sock.connect_ex((ip, port)) == 0:
+                open_ports.append(port)
+            sock.close()
+        if open_ports:
+            found.append(ip)
+    return found
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--prefix", default="127.0.77")
+    ap.add_argument("--ports", default="18080,16053")
+    ap.add_argument("--live-every", type=int, default=16)
+    ap.add_argument("--timeout", type=float, default=server.SCAN_CONNECT_TIMEOUT)
+    ap.add_argument("--concurrency", type=int, default=server.SCAN_DEFAULT_CONCURRENCY)
+    ap.add_argument("--sequential", action="store_true",
+                    help="also time the legacy sequential scan (~2 min)")
+    args = ap.parse_args()
+
+    _raise_fd_limit()
+    ports = [int(p) for p in args.ports.split(",")]
+    socks, live = build_farm(args.prefix, ports, args.live_every)
+    try:
+        hosts = server._parse_scan_targets(cidr=f"{args.prefix}.0/24")
+        t0 = time.monotonic()
+        found = [ip for ip, p in server.scan_hosts(hosts, ports, concurrency=args.concurrency,
+                                                   timeout=args.timeout, budget=120) if p]
+        dt = time.monotonic() - t0
+        ok = sorted(found) == sorted(live)
+        print(f"concurrent: {len(hosts)} hosts x {len(ports)} ports in {dt:.3f}s "
+              f"(concurrency={args.concurrency}, timeout={args.timeout}s) "
+              f"found={len(found)}/{len(live)} {'OK' if ok else 'MISMATCH'}")
+
+        if args.sequential:
+            t0 = time.monotonic()
+            seq = legacy_scan(args.prefix, ports, args.timeout)
+            dt_seq = time.monotonic() - t0
+            print(f"sequential: {dt_seq:.3f}s found={len(seq)}/{len(live)} "
+                  f"speedup x{dt_seq / dt:.1f}")
+        return 0 if ok else 1
+    finally:
+        for s in socks:
+            s.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,12 @@
 # server.py
-from flask import Flask, request, Response, send_from_directory, jsonify
+from flask import Flask, request, Response, send_file, jsonify
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Dict, Any, Optional, Tuple, List
+from typing import Dict, Any, Optional, Tuple, List, Iterable, Iterator
 import os
+import sys
 import json
 import uuid
 import shutil
@@ -13,21 +15,387 @@ import subprocess
 import traceback
 import re
 import hashlib
+import itertools
+import errno
+import resource
+import struct
+import ipaddress
+import selectors
+import threading
+import time
+import sqlite3
+import gzip
+import mimetypes
+import bisect
+import base64
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from functools import wraps
+
+try:  # optional: .br-Varianten nur wenn brotli installiert ist
+    import brotli
+except ImportError:
+    brotli = None
+
+try:  # optional: Produktions-WSGI-Server
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
+
+
+# =========================
+# Validation worker (server.py --validation-worker)
+# =========================
+def _validate_config_inprocess(path: str) -> Dict[str, Any]:
+    """Validate one YAML file with the already imported ESPHome (no compile)."""
+    from esphome.core import CORE
+    from esphome import config as es_config, yaml_util
+
+    CORE.reset()
+    CORE.config_path = Path(path)
+    try:
+        raw = yaml_util.load_yaml(Path(path))
+    except Exception as e:   # YAML-/!secret-/!include-Fehler
+        return {"valid": False, "errors": [{"path": "", "message": str(e)}]}
+    result = es_config.validate_config(raw, {})
+    errors = [
+        {"path": ".".join(str(p) for p in (getattr(err, "path", None) or [])),
+         "message": getattr(err, "error_message", None) or str(err)}
+        for err in result.errors
+    ]
+    return {"valid": not errors, "errors": errors}
+
+
+def _validation_worker_main() -> None:
+    """
+    Long-lived validator: imports ESPHome once, then answers one JSON request
+    per stdin line ({"id", "path"}) with one JSON line on the original stdout.
+    ESPHome's own output goes to stderr so it can't corrupt the protocol.
+    """
+    proto = os.fdopen(os.dup(1), "w", buffering=1, encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    try:
+        import esphome.config  # noqa: F401  (der eigentliche Warm-up)
+        import esphome.yaml_util  # noqa: F401
+        proto.write(json.dumps({"ready": True}) + "\n")
+    except Exception as e:
+        proto.write(json.dumps({"ready": False, "error": str(e)}) + "\n")
+        return
+    for line in sys.stdin:
+        try:
+            req = json.loads(line)
+        except ValueError:
+            continue
+        try:
+            resp = _validate_config_inprocess(req["path"])
+        except Exception as e:
+            resp = {"failed": f"{type(e).__name__}: {e}"}   # Server fällt auf die CLI zurück
+        proto.write(json.dumps({"id": req.get("id"), **resp}) + "\n")
+
+
+if __name__ == "__main__" and "--validation-worker" in sys.argv:
+    # vor dem restlichen Modul: keine Registry, keine Threads, kein Flask-Setup
+    _validation_worker_main()
+    sys.exit(0)
 
 
 # =========================
 # Flask & paths
 # =========================
-app = Flask(__name__, static_folder="/app/www", static_url_path="/")
+# Pfade lassen sich für lokale Tests/Benchmarks per ENV umbiegen
+DATA_DIR = os.environ.get("ESPFLASHER_DATA_DIR", "/data")
+WWW_DIR = os.environ.get("ESPFLASHER_WWW_DIR", "/app/www")
+
+OPTIONS_FILE = Path(DATA_DIR) / "options.json"   # Add-on Optionen (Supervisor)
+
+
+def _addon_option(key: str, default: Any) -> Any:
+    """ENV ESPFLASHER_<KEY> > /data/options.json > default."""
+    env = os.environ.get(f"ESPFLASHER_{key.upper()}")
+    if env not in (None, ""):
+        return env
+    try:
+        value = json.loads(OPTIONS_FILE.read_text(encoding="utf-8")).get(key)
+    except Exception:
+        value = None
+    return default if value in (None, "") else value
+
+
+app = Flask(__name__, static_folder=None)   # statische Dateien: siehe "Static assets"
 _NAME_RE = re.compile(r'(?m)^\s*esphome:\s*(?:#.*)?$|^\s*name:\s*["\']?([^"\']+)["\']?\s*(?:#.*)?$')
 CORS(app)
 
-YAML_DIR = "/data/yaml"
-OUTPUT_DIR = "/app/www/firmware"
+YAML_DIR = os.path.join(DATA_DIR, "yaml")
+OUTPUT_DIR = os.path.join(WWW_DIR, "firmware")
 os.makedirs(YAML_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-DEVICES_FILE = Path("/data/devices.json")
+DEVICES_FILE = Path(DATA_DIR) / "devices.json"
+DEVICES_JOURNAL = Path(DATA_DIR) / "devices.journal.jsonl"   # Änderungen seit dem letzten Index-Write
+BLOBS_DIR = Path(DATA_DIR) / "blobs"          # YAML/config, content-addressed
+HISTORY_DIR = Path(DATA_DIR) / "history"      # <id>.jsonl, append-only
+DEVICES_DB = Path(DATA_DIR) / "devices.sqlite3"
+REGISTRY_BACKEND = str(_addon_option("registry_backend", "json")).lower()   # json | sqlite
+REGISTRY_TOMBSTONES = 1000   # gelöschte IDs, die für Delta-Syncs (?since=) gemerkt werden
+REGISTRY_JOURNAL_MIN = 256   # Journal wird kompaktiert ab max(MIN, Anzahl Geräte) Einträgen
+
+
+# =========================
+# Serving (threads, stream slots)
+# =========================
+SERVER_MODE = str(_addon_option("server_mode", "production")).lower()   # production | dev
+SERVER_THREADS = max(2, int(_addon_option("server_threads", 16)))
+SERVER_CONNECTION_LIMIT = int(_addon_option("server_connection_limit", 100))
+SERVER_RESERVED_THREADS = 4   # bleiben für /ping, Registry & statische Dateien frei
+SERVER_PORT = int(os.environ.get("ESPFLASHER_PORT", "8099"))   # Add-on: fest 8099, Benchmarks: frei
+
+
+class _StreamSlots:
+    """
+    Caps long-running responses (log streams, blocking scans/flashes) so they can
+    never occupy all server threads. Excess requests get 503 + Retry-After.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.sem = threading.BoundedSemaphore(self.slots)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+
+    def acquire(self) -> bool:
+        if not self.sem.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            M_STREAM_REJECTED.inc()
+            return False
+        with self.lock:
+            self.active += 1
+        return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+        self.sem.release()
+
+    def guard(self, body: Iterable) -> Iterator:
+        try:
+            yield from body
+        finally:
+            close = getattr(body, "close", None)
+            if close:
+                close()
+            self.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"slots": self.slots, "active": self.active, "rejected": self.rejected}
+
+
+_stream_slots = _StreamSlots(
+    int(_addon_option("server_stream_slots", 0)) or SERVER_THREADS - SERVER_RESERVED_THREADS)
+
+
+def _streaming(view):
+    """Route decorator: hold a stream slot for the request, or until a streamed body ends."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _stream_slots.acquire():
+            resp = jsonify({"error": "Too many active streams, try again shortly."})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = "5"
+            return resp
+        try:
+            rv = view(*args, **kwargs)
+        except BaseException:
+            _stream_slots.release()
+            raise
+        if isinstance(rv, Response) and rv.is_streamed:
+            rv.response = _stream_slots.guard(rv.response)
+        else:
+            _stream_slots.release()
+        return rv
+    return wrapper
+
+
+# =========================
+# Metrics (Prometheus text format)
+# =========================
+_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+_BUILD_BUCKETS = (1, 5, 10, 30, 60, 120, 180, 300, 600, 900, 1200, 1800, 3600)
+_COUNT_BUCKETS = (0, 1, 4, 16, 64, 256, 1024, 4096)
+
+
+def _label_str(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """One value per label set; subclasses add the update methods."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_label_str(self.labels, k)} {float(v):g}"
+                    for k, v in sorted(self.values.items()) if v is not None]
+
+
+class _Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class _Gauge(_Metric):
+    """Set/inc/dec, or computed at scrape time via `fn` (returns value or {labels-tuple: value})."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), fn=None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def _samples(self) -> List[str]:
+        if self.fn is None:
+            return super()._samples()
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return [f"{self.name}{_label_str(self.labels, k)} {float(v):g}"
+                for k, v in sorted(values.items()) if v is not None]
+
+
+class _Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = _DURATION_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], List[float]] = {}   # counts je Bucket + [sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def time(self, **labels):
+        """Context manager observing the elapsed seconds."""
+        hist = self
+
+        class _Timer:
+            def __enter__(self):
+                self.t0 = time.monotonic()
+                return self
+
+            def __exit__(self, *exc):
+                hist.observe(time.monotonic() - self.t0, **labels)
+                return False
+
+        return _Timer()
+
+    def _samples(self) -> List[str]:
+        out: List[str] = []
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for key, row in items:
+            for i, bound in enumerate(self.buckets):
+                le = 'le="%g"' % bound
+                out.append(f"{self.name}_bucket{_label_str(self.labels, key, le)} {row[i]:g}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_label_str(self.labels, key, le)} {row[-1]:g}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, key)} {row[-2]:g}")
+            out.append(f"{self.name}_count{_label_str(self.labels, key)} {row[-1]:g}")
+        return out
+
+
+_metrics: List[_Metric] = []
+
+M_JOB_DURATION = _Histogram("espflasher_job_duration_seconds",
+                            "Build/flash job run time (compile, usb, flash = OTA, build, rollback).",
+                            ("kind", "outcome"), _BUILD_BUCKETS)
+M_JOBS = _Counter("espflasher_jobs_total", "Finished build/flash jobs.", ("kind", "outcome"))
+M_JOB_WAIT = _Histogram("espflasher_job_queue_wait_seconds", "Time jobs spent queued.", ("kind",))
+M_OTA_UPLOAD = _Histogram("espflasher_ota_upload_duration_seconds",
+                          "Single OTA upload attempt (batch flashing).", ("outcome",), _BUILD_BUCKETS)
+M_SUBPROCS = _Gauge("espflasher_subprocesses_in_flight", "Running esphome subprocesses.", ("command",))
+M_SCAN_DURATION = _Histogram("espflasher_scan_duration_seconds", "Network scan duration.", ("mode",))
+M_SCAN_HOSTS = _Histogram("espflasher_scan_hosts_probed", "Hosts actually probed per scan.",
+                          ("mode",), _COUNT_BUCKETS)
+M_STREAM_REJECTED = _Counter("espflasher_stream_slots_rejected_total",
+                             "Requests rejected with 503 for lack of stream slots.")
+M_SCAN_CACHED = _Counter("espflasher_scan_hosts_cached_total", "Scan hosts answered from the discovery cache.")
+M_REGISTRY_OP = _Histogram("espflasher_registry_op_seconds", "Device registry load/save latency.",
+                           ("backend", "op"))
+M_DEVICES_LOAD = _Histogram("espflasher_devices_json_load_seconds", "Parsing devices.json (_load_devices).")
+M_WRITE_SECONDS = _Histogram("espflasher_atomic_write_seconds", "JSON state file writes.", ("file",))
+M_WRITE_BYTES = _Counter("espflasher_atomic_write_bytes_total", "Bytes written to JSON state files.", ("file",))
+M_FW_BYTES = _Counter("espflasher_firmware_bytes_served_total", "Firmware/manifest bytes served.", ("status",))
+M_FW_TRANSFER = _Histogram("espflasher_firmware_transfer_seconds", "Firmware download duration.", ("status",))
+M_CACHE_LOOKUPS = _Counter("espflasher_build_cache_lookups_total", "Build cache lookups.", ("result",))
+M_PIO_OBJECTS = _Counter("espflasher_pio_objects_total",
+                         "Object files per build: compiled vs. retrieved from the PlatformIO build cache.",
+                         ("result",))
+M_DISCOVERY_LOOKUPS = _Counter("espflasher_discovery_cache_lookups_total", "Discovery cache lookups per host.",
+                               ("result",))
+M_FINGERPRINTS = _Counter("espflasher_fingerprints_total", "Host identifications by source.", ("source",))
+M_FINGERPRINT_DURATION = _Histogram("espflasher_fingerprint_duration_seconds",
+                                    "Time to fingerprint one host (API hello / HTTP).", ("source",))
+
+
+def _metric_file_label(path: Path) -> str:
+    # Manifeste gibt es pro Gerät -> zusammenfassen (Label-Kardinalität)
+    if path.name.endswith(".manifest.json"):
+        return "manifest.json"
+    try:
+        return Path(path).relative_to(DATA_DIR).as_posix()   # build_cache/index.json vs. firmware_store/...
+    except ValueError:
+        return path.name
 
 
 # =========================
@@ -37,10 +405,16 @@ def _iso_now() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
 
-def _atomic_write(path: Path, data: Dict[str, Any]) -> None:
-    tmp = path.with_suffix(".tmp")
-    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    os.replace(tmp, path)
+def _atomic_write(path: Path, data: Dict[str, Any], indent: Optional[int] = 2) -> None:
+    # eigener Temp-Name pro Schreiber, sonst überschreiben sich parallele Writes
+    label = _metric_file_label(path)
+    with M_WRITE_SECONDS.time(file=label):
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        separators = None if indent else (",", ":")
+        raw = json.dumps(data, ensure_ascii=False, indent=indent, separators=separators).encode("utf-8")
+        tmp.write_bytes(raw)
+        os.replace(tmp, path)
+    M_WRITE_BYTES.inc(len(raw), file=label)
 
 
 def _normalize_name(s: str) -> str:
@@ -48,17 +422,17 @@ def _normalize_name(s: str) -> str:
 
 
 def _load_devices() -> Dict[str, Any]:
+    """Parse devices.json from disk (no migration; see _DeviceRegistry)."""
+    with M_DEVICES_LOAD.time():
+        return _read_devices_file()
+
+
+def _read_devices_file() -> Dict[str, Any]:
     if DEVICES_FILE.exists():
         try:
             db = json.loads(DEVICES_FILE.read_text(encoding="utf-8"))
-            changed = False
             db.setdefault("devices", [])
             db.setdefault("version", 1)
-            for d in db["devices"]:
-                if _migrate_device_inplace(d):
-                    changed = True
-            if changed:
-                _atomic_write(DEVICES_FILE, db)
             return db
         except Exception:
             pass
@@ -66,7 +440,8 @@ def _load_devices() -> Dict[str, Any]:
 
 
 def _save_devices(db: Dict[str, Any]) -> None:
-    _atomic_write(DEVICES_FILE, db)
+    # Index enthält nur noch Zusammenfassungen → kompakt schreiben
+    _atomic_write(DEVICES_FILE, db, indent=None)
 
 
 def _migrate_device_inplace(d: Dict[str, Any]) -> bool:
@@ -114,6 +489,635 @@ def _migrate_device_inplace(d: Dict[str, Any]) -> bool:
     return changed
 
 
+def _device_key(d: Dict[str, Any]) -> Tuple[str, str]:
+    return (_normalize_name(d.get("name", "")), d.get("platform") or "")
+
+
+def _device_summary(d: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields returned by GET /api/devices (without include=full)."""
+    return {
+        "id": d.get("id"),
+        "name": d.get("name"),
+        "friendly_name": d.get("friendly_name") or d.get("name"),
+        "platform": d.get("platform"),
+        # include modern board fields
+        "board_id": d.get("board_id"),
+        "board_label": d.get("board_label"),
+        # legacy field for UI display fallback
+        "board": d.get("board") or d.get("board_label") or d.get("board_id"),
+        "ip": d.get("ip"),
+        "mac": d.get("mac"),
+        "flashed_at": d.get("flashed_at"),
+        "firmware_sha256": d.get("firmware_sha256"),
+        "firmware_size": d.get("firmware_size"),
+        "tags": d.get("tags") or [],
+        "revision": d.get("revision", 0),
+    }
+
+
+# Felder, die nicht im Index stehen, sondern als Blob/Log daneben liegen
+_BULKY_FIELDS = ("yaml", "yaml_snapshot", "config_json", "history")
+_BLOB_REF_FIELDS = ("yaml_ref", "yaml_snapshot_ref", "config_ref", "build_samples_ref")
+# Warn-/Fehlerzeilen aus build_stats: Blob statt Index, dort stehen nur die Zähler
+_BUILD_SAMPLE_FIELDS = ("warning_samples", "error_samples")
+
+
+class _JsonDeviceStore:
+    """
+    File layout behind the registry:
+      devices.json            index with summary fields + blob refs
+      devices.journal.jsonl   puts/deletes since the index was last written
+      blobs/<ab>/<sha256>     YAML / config_json, deduplicated by hash
+      history/<id>.jsonl      flash history, one entry per line
+
+    A single put/delete appends one journal line; the index is rewritten
+    (and the journal emptied) only once the journal outgrows the index.
+    """
+
+    def __init__(self, index_path: Path, blobs_dir: Path, history_dir: Path,
+                 journal_path: Optional[Path] = None):
+        self.index_path = index_path
+        self.journal_path = journal_path or index_path.with_name(index_path.stem + ".journal.jsonl")
+        self.blobs_dir = blobs_dir
+        self.history_dir = history_dir
+        self.revision = 0
+        self.deleted: List[Dict[str, Any]] = []   # Tombstones {id, revision, deleted_at}
+        self._journaled = 0
+
+    # --- index ---
+    def stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        try:
+            jt = os.stat(self.journal_path)
+            return (st.st_mtime_ns ^ jt.st_mtime_ns, st.st_size + jt.st_size)
+        except OSError:
+            return (st.st_mtime_ns, st.st_size)
+
+    def load(self) -> List[Dict[str, Any]]:
+        db = _load_devices()
+        self.revision = int(db.get("revision") or 0)
+        self.deleted = list(db.get("deleted") or [])
+        records = db["devices"]
+        self._journaled = 0
+        try:
+            lines = self.journal_path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return records
+        by_id = {d.get("id"): i for i, d in enumerate(records) if d.get("id")}
+        base = self.revision
+        torn = False
+        for line in lines:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                torn = True   # halb geschriebene Zeile nach Absturz
+                continue
+            rev = int(op.get("revision") or 0)
+            if rev <= base:
+                continue   # schon im Index (Absturz zwischen Index-Write und Journal-Reset)
+            self._journaled += 1
+            self.revision = max(self.revision, rev)
+            if op.get("op") == "put":
+                rec = op["record"]
+                self.deleted = [t for t in self.deleted if t.get("id") != rec["id"]]
+                if rec["id"] in by_id:
+                    records[by_id[rec["id"]]] = rec
+                else:
+                    by_id[rec["id"]] = len(records)
+                    records.append(rec)
+            elif op.get("op") == "delete":
+                self.deleted.append({"id": op["id"], "revision": rev, "deleted_at": op.get("deleted_at")})
+                if op["id"] in by_id:
+                    records[by_id.pop(op["id"])] = None
+        records = [d for d in records if d is not None]
+        if torn:
+            self._write(records)   # sonst klebt die nächste Zeile an der kaputten
+        return records
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        self.deleted = self.deleted[-REGISTRY_TOMBSTONES:]
+        _save_devices({"devices": records, "version": 2, "revision": self.revision, "deleted": self.deleted})
+        try:
+            self.journal_path.unlink()
+        except OSError:
+            pass
+        self._journaled = 0
+
+    def _journal(self, op: Dict[str, Any], records: List[Dict[str, Any]]) -> None:
+        if self._journaled >= max(REGISTRY_JOURNAL_MIN, len(records)):
+            self._write(records)
+            return
+        with M_WRITE_SECONDS.time(file=self.journal_path.name):
+            raw = (json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            with open(self.journal_path, "ab") as f:
+                f.write(raw)
+        M_WRITE_BYTES.inc(len(raw), file=self.journal_path.name)
+        self._journaled += 1
+
+    def current_revision(self) -> int:
+        return self.revision
+
+    def tombstones(self) -> List[Dict[str, Any]]:
+        return list(self.deleted)
+
+    def save_record(self, rec: Dict[str, Any], records: List[Dict[str, Any]], revision: int) -> None:
+        self.revision = revision
+        self.deleted = [t for t in self.deleted if t.get("id") != rec["id"]]
+        self._journal({"op": "put", "revision": revision, "record": rec}, records)
+
+    def delete_record(self, dev_id: str, records: List[Dict[str, Any]], revision: int) -> None:
+        self.revision = revision
+        now = _iso_now()
+        self.deleted.append({"id": dev_id, "revision": revision, "deleted_at": now})
+        self._journal({"op": "delete", "revision": revision, "id": dev_id, "deleted_at": now}, records)
+
+    def save_all(self, records: List[Dict[str, Any]]) -> None:
+        self._write(records)
+
+    # --- blobs ---
+    def _blob_path(self, sha: str) -> Path:
+        return self.blobs_dir / sha[:2] / sha
+
+    def put_blob(self, data: bytes) -> str:
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{sha}.{uuid.uuid4().hex}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        return sha
+
+    def get_blob(self, sha: Optional[str]) -> Optional[bytes]:
+        if not sha:
+            return None
+        try:
+            return self._blob_path(sha).read_bytes()
+        except OSError:
+            return None
+
+    def drop_blob(self, sha: str) -> None:
+        try:
+            self._blob_path(sha).unlink()
+        except OSError:
+            pass
+
+    # --- history ---
+    def _history_path(self, dev_id: str) -> Path:
+        return self.history_dir / f"{dev_id}.jsonl"
+
+    def read_history(self, dev_id: str) -> List[Dict[str, Any]]:
+        try:
+            lines = self._history_path(dev_id).read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return []
+        out = []
+        for line in lines:
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                pass  # halb geschriebene Zeile nach Absturz ignorieren
+        return out
+
+    def append_history(self, dev_id: str, entry: Dict[str, Any]) -> None:
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        with open(self._history_path(dev_id), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def write_history(self, dev_id: str, entries: List[Dict[str, Any]]) -> None:
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        path = self._history_path(dev_id)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries),
+                       encoding="utf-8")
+        os.replace(tmp, path)
+
+    def drop_history(self, dev_id: str) -> None:
+        try:
+            self._history_path(dev_id).unlink()
+        except OSError:
+            pass
+
+
+class _SqliteDeviceStore:
+    """
+    SQLite (WAL) variant of _JsonDeviceStore: one row per device, blobs and
+    history in their own tables, every write is a single short transaction.
+    On first start the JSON index (and its blobs/history) is imported.
+    """
+
+    def __init__(self, db_path: Path, legacy: _JsonDeviceStore):
+        self.db_path = db_path
+        self.legacy = legacy
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS devices (
+                    id        TEXT PRIMARY KEY,
+                    name_norm TEXT NOT NULL,
+                    platform  TEXT NOT NULL,
+                    data      TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS devices_name_platform ON devices (name_norm, platform);
+                CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, data BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS history (
+                    seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+                    device_id TEXT NOT NULL,
+                    entry     TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS history_device ON history (device_id);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', '0');
+                CREATE TABLE IF NOT EXISTS tombstones (
+                    id         TEXT PRIMARY KEY,
+                    revision   INTEGER NOT NULL,
+                    deleted_at TEXT NOT NULL
+                );
+            """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _bump(self, conn: sqlite3.Connection) -> None:
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'revision'")
+
+    def _set_revision(self, conn: sqlite3.Connection, revision: int) -> None:
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'revision'", (str(revision),))
+
+    def _row(self, rec: Dict[str, Any]) -> Tuple[str, str, str, str]:
+        name_norm, platform = _device_key(rec)
+        return (rec["id"], name_norm, platform, json.dumps(rec, ensure_ascii=False))
+
+    # --- index ---
+    def stamp(self) -> Optional[Tuple[int, int]]:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        return (int(row[0]), 0) if row else None
+
+    def current_revision(self) -> int:
+        stamp = self.stamp()
+        return stamp[0] if stamp else 0
+
+    def tombstones(self) -> List[Dict[str, Any]]:
+        rows = self._conn().execute("SELECT id, revision, deleted_at FROM tombstones ORDER BY revision")
+        return [{"id": r[0], "revision": r[1], "deleted_at": r[2]} for r in rows]
+
+    def load(self) -> List[Dict[str, Any]]:
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone() is None:
+            self._import_legacy()
+        return [json.loads(r[0]) for r in conn.execute("SELECT data FROM devices ORDER BY rowid")]
+
+    def _import_legacy(self) -> None:
+        """Copy devices.json (+ blobs/history) once; the JSON files stay as backup."""
+        records = self.legacy.load()
+        with self._conn() as conn:
+            for rec in records:
+                if not rec.get("id"):
+                    rec["id"] = str(uuid.uuid4())
+                for f in _BLOB_REF_FIELDS:
+                    data = self.legacy.get_blob(rec.get(f))
+                    if data is not None:
+                        conn.execute("INSERT OR IGNORE INTO blobs (sha, data) VALUES (?, ?)",
+                                     (rec[f], data))
+                for entry in self.legacy.read_history(rec["id"]):
+                    conn.execute("INSERT INTO history (device_id, entry) VALUES (?, ?)",
+                                 (rec["id"], json.dumps(entry, ensure_ascii=False)))
+                conn.execute("INSERT OR REPLACE INTO devices (id, name_norm, platform, data) "
+                             "VALUES (?, ?, ?, ?)", self._row(rec))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)",
+                         (_iso_now(),))
+            self._bump(conn)
+
+    def save_record(self, rec: Dict[str, Any], records: List[Dict[str, Any]], revision: int) -> None:
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO devices (id, name_norm, platform, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name_norm = excluded.name_norm, "
+                "platform = excluded.platform, data = excluded.data",
+                self._row(rec),
+            )
+            conn.execute("DELETE FROM tombstones WHERE id = ?", (rec["id"],))
+            self._set_revision(conn, revision)
+
+    def delete_record(self, dev_id: str, records: List[Dict[str, Any]], revision: int) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM devices WHERE id = ?", (dev_id,))
+            conn.execute("DELETE FROM history WHERE device_id = ?", (dev_id,))
+            conn.execute("INSERT OR REPLACE INTO tombstones (id, revision, deleted_at) VALUES (?, ?, ?)",
+                         (dev_id, revision, _iso_now()))
+            conn.execute("DELETE FROM tombstones WHERE id NOT IN "
+                         "(SELECT id FROM tombstones ORDER BY revision DESC LIMIT ?)", (REGISTRY_TOMBSTONES,))
+            self._set_revision(conn, revision)
+
+    def save_all(self, records: List[Dict[str, Any]]) -> None:
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO devices (id, name_norm, platform, data) VALUES (?, ?, ?, ?)",
+                [self._row(r) for r in records],
+            )
+            self._bump(conn)
+
+    # --- blobs ---
+    def put_blob(self, data: bytes) -> str:
+        sha = hashlib.sha256(data).hexdigest()
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO blobs (sha, data) VALUES (?, ?)", (sha, data))
+        return sha
+
+    def get_blob(self, sha: Optional[str]) -> Optional[bytes]:
+        if not sha:
+            return None
+        row = self._conn().execute("SELECT data FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def drop_blob(self, sha: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM blobs WHERE sha = ?", (sha,))
+
+    # --- history ---
+    def read_history(self, dev_id: str) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT entry FROM history WHERE device_id = ? ORDER BY seq", (dev_id,))
+        return [json.loads(r[0]) for r in rows]
+
+    def append_history(self, dev_id: str, entry: Dict[str, Any]) -> None:
+        with self._conn() as conn:
+            conn.execute("INSERT INTO history (device_id, entry) VALUES (?, ?)",
+                         (dev_id, json.dumps(entry, ensure_ascii=False)))
+
+    def write_history(self, dev_id: str, entries: List[Dict[str, Any]]) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM history WHERE device_id = ?", (dev_id,))
+            conn.executemany("INSERT INTO history (device_id, entry) VALUES (?, ?)",
+                             [(dev_id, json.dumps(e, ensure_ascii=False)) for e in entries])
+
+    def drop_history(self, dev_id: str) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM history WHERE device_id = ?", (dev_id,))
+
+
+class _DeviceRegistry:
+    """
+    In-memory device index with hash indexes on id and
+    (normalized name, platform).
+
+    Only the small index records live in memory; YAML, config_json and
+    history are stored beside them (see _JsonDeviceStore/_SqliteDeviceStore)
+    and read when a full record is requested. The index is re-read only when
+    its stamp changes (e.g. edited by hand). Legacy records are migrated –
+    and their bulky fields split out – once at load time.
+    Read-modify-write sequences must hold `lock` (an RLock).
+    """
+
+    def __init__(self, store: Any):
+        self.store = store
+        self.lock = threading.RLock()
+        self._devices: List[Dict[str, Any]] = []
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._by_key: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._refs: Dict[str, int] = {}
+        self._summaries: Optional[List[Dict[str, Any]]] = None
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._loaded = False
+        self._revision = 0   # steigt mit jedem put/delete; Records tragen ihre eigene "revision"
+
+    def _refresh(self) -> None:
+        stamp = self.store.stamp()
+        if self._loaded and stamp == self._stamp:
+            return
+        with M_REGISTRY_OP.time(backend=REGISTRY_BACKEND, op="load"):
+            records = self.store.load()
+        migrated = False
+        for i, d in enumerate(records):
+            if "yaml_ref" not in d:
+                # Altformat: alles inline → einmalig migrieren und aufteilen
+                _migrate_device_inplace(d)
+                records[i] = self._split(d)
+                migrated = True
+            elif not d.get("id"):
+                d["id"] = str(uuid.uuid4())
+                migrated = True
+            elif any(k in (d.get("build_stats") or {}) for k in _BUILD_SAMPLE_FIELDS):
+                records[i] = self._split(d)
+                migrated = True
+        self._devices = records
+        self._loaded = True
+        self._reindex()
+        if migrated:
+            self.store.save_all(self._devices)
+        self._stamp = self.store.stamp()
+        self._revision = max([self.store.current_revision()] + [d.get("revision", 0) for d in records])
+
+    def _reindex(self) -> None:
+        self._by_id = {}
+        self._by_key = {}
+        self._refs = {}
+        for d in self._devices:
+            self._by_id.setdefault(d["id"], d)
+            self._by_key.setdefault(_device_key(d), d)
+            for f in _BLOB_REF_FIELDS:
+                if d.get(f):
+                    self._refs[d[f]] = self._refs.get(d[f], 0) + 1
+        self._summaries = None
+
+    def _split(self, dev: Dict[str, Any], base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Turn a full record into an index record, storing blobs/history."""
+        rec = {k: v for k, v in (base or {}).items()}
+        rec.update({k: v for k, v in dev.items() if k not in _BULKY_FIELDS})
+        rec.setdefault("yaml_ref", None)
+        if "yaml" in dev or "yaml_snapshot" in dev:
+            y = dev.get("yaml") or dev.get("yaml_snapshot") or ""
+            ys = dev.get("yaml_snapshot") or y
+            rec["yaml_ref"] = self.store.put_blob(y.encode("utf-8")) if y else None
+            if ys != y:
+                rec["yaml_snapshot_ref"] = self.store.put_blob(ys.encode("utf-8"))
+            else:
+                rec.pop("yaml_snapshot_ref", None)
+        if "config_json" in dev:
+            cj = json.dumps(dev.get("config_json") or {}, ensure_ascii=False, sort_keys=True)
+            rec["config_ref"] = self.store.put_blob(cj.encode("utf-8"))
+        if "history" in dev:
+            self.store.write_history(rec["id"], [h for h in dev.get("history") or []])
+        stats = dev.get("build_stats")
+        if isinstance(stats, dict) and any(k in stats for k in _BUILD_SAMPLE_FIELDS):
+            samples = {k: stats[k] for k in _BUILD_SAMPLE_FIELDS if stats.get(k)}
+            rec["build_stats"] = {k: v for k, v in stats.items() if k not in _BUILD_SAMPLE_FIELDS}
+            if samples:
+                raw = json.dumps(samples, ensure_ascii=False, sort_keys=True)
+                rec["build_samples_ref"] = self.store.put_blob(raw.encode("utf-8"))
+            else:
+                rec.pop("build_samples_ref", None)
+        return rec
+
+    def full(self, rec: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Index record → full record with yaml, config_json and history."""
+        if rec is None:
+            return None
+        # unter dem Lock und gegen den aktuellen Stand lesen: ein paralleles
+        # put()/delete() kann die Blobs von `rec` sonst schon freigegeben haben
+        with self.lock:
+            rec = self._by_id.get(rec.get("id")) or rec
+            d = {k: v for k, v in rec.items() if k not in _BLOB_REF_FIELDS}
+            y = (self.store.get_blob(rec.get("yaml_ref")) or b"").decode("utf-8")
+            ys = self.store.get_blob(rec.get("yaml_snapshot_ref"))
+            cj = self.store.get_blob(rec.get("config_ref"))
+            samples = self.store.get_blob(rec.get("build_samples_ref"))
+            d["history"] = self.store.read_history(rec["id"])
+        d["yaml"] = y
+        d["yaml_snapshot"] = ys.decode("utf-8") if ys is not None else y
+        try:
+            d["config_json"] = json.loads(cj) if cj else {}
+        except ValueError:
+            d["config_json"] = {}
+        if samples and isinstance(d.get("build_stats"), dict):
+            try:
+                d["build_stats"] = {**d["build_stats"], **json.loads(samples)}
+            except ValueError:
+                pass
+        return d
+
+    def yaml(self, rec: Dict[str, Any]) -> str:
+        """Stored YAML, falling back to the snapshot (like the legacy yaml/yaml_snapshot pair)."""
+        with self.lock:
+            rec = self._by_id.get(rec.get("id")) or rec
+            ref = rec.get("yaml_ref") or rec.get("yaml_snapshot_ref")
+            return (self.store.get_blob(ref) or b"").decode("utf-8")
+
+    def _release(self, old: Optional[Dict[str, Any]]) -> None:
+        """Drop blobs of a replaced/deleted record that nothing references anymore."""
+        if old is None:
+            return
+        for f in _BLOB_REF_FIELDS:
+            sha = old.get(f)
+            if sha and self._refs.get(sha, 0) <= 0:
+                self._refs.pop(sha, None)
+                self.store.drop_blob(sha)
+
+    def all(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            self._refresh()
+            return list(self._devices)
+
+    @property
+    def revision(self) -> int:
+        with self.lock:
+            self._refresh()
+            return self._revision
+
+    def snapshot(self) -> Tuple[List[Dict[str, Any]], int]:
+        """(all index records, revision) from one locked read."""
+        with self.lock:
+            self._refresh()
+            return list(self._devices), self._revision
+
+    def changes(self, since: int) -> Tuple[List[Dict[str, Any]], List[str], bool, int]:
+        """
+        (index records changed after `since`, ids deleted after `since`, reset, revision).
+        reset=True: tombstones older than `since` may already be gone -> full resync;
+        the records are then all records.
+        """
+        with self.lock:
+            self._refresh()
+            stones = self.store.tombstones()
+            deleted = [t["id"] for t in stones if t.get("revision", 0) > since]
+            reset = (len(stones) >= REGISTRY_TOMBSTONES and bool(stones)
+                     and since < min(t.get("revision", 0) for t in stones))
+            changed = [d for d in self._devices if reset or d.get("revision", 0) > since]
+            return changed, deleted, reset, self._revision
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            self._refresh()
+            if self._summaries is None:
+                self._summaries = [_device_summary(d) for d in self._devices]
+            return self._summaries
+
+    def get(self, dev_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Index record by id (no yaml/config/history; see full())."""
+        if not dev_id:
+            return None
+        with self.lock:
+            self._refresh()
+            return self._by_id.get(dev_id)
+
+    def find(self, name: str, platform: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            self._refresh()
+            return self._by_key.get((_normalize_name(name), platform or ""))
+
+    def put(self, dev: Dict[str, Any], append_history: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Insert or update (by id) and persist; returns the full record.
+        Bulky fields missing from `dev` keep their stored value; a given
+        `history` replaces the log, `append_history` appends one entry.
+        """
+        with self.lock:
+            self._refresh()
+            old = self._by_id.get(dev["id"])
+            rec = self._split(dev, base=old)
+            self._revision += 1
+            rec["revision"] = self._revision
+            if append_history:
+                self.store.append_history(rec["id"], append_history)
+
+            if old is not None:
+                self._devices[self._devices.index(old)] = rec
+                if self._by_key.get(_device_key(old)) is old:
+                    del self._by_key[_device_key(old)]
+                for f in _BLOB_REF_FIELDS:
+                    if old.get(f):
+                        self._refs[old[f]] -= 1
+            else:
+                self._devices.append(rec)
+            self._by_id[rec["id"]] = rec
+            self._by_key.setdefault(_device_key(rec), rec)
+            for f in _BLOB_REF_FIELDS:
+                if rec.get(f):
+                    self._refs[rec[f]] = self._refs.get(rec[f], 0) + 1
+            self._summaries = None
+
+            with M_REGISTRY_OP.time(backend=REGISTRY_BACKEND, op="save"):
+                self.store.save_record(rec, self._devices, self._revision)
+            self._stamp = self.store.stamp()
+            self._release(old)
+            return self.full(rec)
+
+    def delete(self, dev_id: str) -> bool:
+        with self.lock:
+            self._refresh()
+            old = self._by_id.get(dev_id)
+            if old is None:
+                return False
+            self._devices = [d for d in self._devices if d.get("id") != dev_id]
+            self._reindex()
+            self._revision += 1
+            with M_REGISTRY_OP.time(backend=REGISTRY_BACKEND, op="delete"):
+                self.store.delete_record(dev_id, self._devices, self._revision)
+            self._stamp = self.store.stamp()
+            self.store.drop_history(dev_id)
+            self._release(old)
+            return True
+
+
+def _make_device_store() -> Any:
+    json_store = _JsonDeviceStore(DEVICES_FILE, BLOBS_DIR, HISTORY_DIR, DEVICES_JOURNAL)
+    if REGISTRY_BACKEND == "sqlite":
+        return _SqliteDeviceStore(DEVICES_DB, legacy=json_store)
+    return json_store
+
+
+_registry = _DeviceRegistry(_make_device_store())
+
+
 def detect_platform_from_yaml(text: str) -> str:
     t = (text or "").lower()
     if "\nesp8266:" in t:
@@ -143,49 +1147,49 @@ def upsert_device_record(
     yaml_text: str,
     config_json: Optional[Dict[str, Any]] = None,
     firmware_sha256: Optional[str] = None,
+    firmware_size: Optional[int] = None,
     ip: Optional[str] = None,
     mac: Optional[str] = None,
+    build_stats: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     """
     Create/update a device entry keyed by (normalized name + platform).
     Keeps simple history of previous flashed_at/firmware_sha256.
     """
-    db = _load_devices()
     name_norm = _normalize_name(name)
+    now_iso = _iso_now()
 
-    existing = next(
-        (d for d in db["devices"]
-         if _normalize_name(d.get("name", "")) == name_norm and d.get("platform") == platform),
-        None
-    )
+    with _registry.lock:
+        existing = _registry.find(name_norm, platform)
+        if existing:
+            prev = None
+            if existing.get("flashed_at") or existing.get("firmware_sha256"):
+                prev = {
+                    "flashed_at": existing.get("flashed_at"),
+                    "firmware_sha256": existing.get("firmware_sha256")
+                }
+            dev = {
+                **existing,
+                "name": name_norm,
+                "friendly_name": existing.get("friendly_name") or name,
+                "platform": platform,
+                "board": board_label,         # legacy field
+                "board_label": board_label,
+                "board_id": board_id,
+                "yaml": yaml_text,
+                "yaml_snapshot": yaml_text,
+                "firmware_sha256": firmware_sha256,
+                "firmware_size": firmware_size,
+                "ip": ip or existing.get("ip"),
+                "mac": mac or existing.get("mac"),
+                "flashed_at": now_iso,
+            }
+            if config_json:
+                dev["config_json"] = config_json
+            if build_stats:
+                dev["build_stats"] = build_stats
+            return _registry.put(dev, append_history=prev if prev and prev.get("flashed_at") else None)
 
-    now_iso = _iso_now()
-    if existing:
-        hist = existing.get("history", [])
-        if existing.get("flashed_at") or existing.get("firmware_sha256"):
-            hist.append({
-                "flashed_at": existing.get("flashed_at"),
-                "firmware_sha256": existing.get("firmware_sha256")
-            })
-        existing.update({
-            "name": name_norm,
-            "friendly_name": existing.get("friendly_name") or name,
-            "platform": platform,
-            "board": board_label,         # legacy field
-            "board_label": board_label,
-            "board_id": board_id,
-            "yaml": yaml_text,
-            "yaml_snapshot": yaml_text,
-            "config_json": config_json or existing.get("config_json") or {},
-            "firmware_sha256": firmware_sha256,
-            "ip": ip or existing.get("ip"),
-            "mac": mac or existing.get("mac"),
-            "flashed_at": now_iso,
-            "history": [h for h in hist if h.get("flashed_at")],
-        })
-        _save_devices(db)
-        return existing
-    else:
         dev = {
             "id": str(uuid.uuid4()),
             "name": name_norm,
@@ -198,6 +1202,7 @@ def upsert_device_record(
             "yaml_snapshot": yaml_text,
             "config_json": config_json or {},
             "firmware_sha256": firmware_sha256,
+            "firmware_size": firmware_size,
             "ip": ip,
             "mac": mac,
             "tags": [],
@@ -205,44 +1210,155 @@ def upsert_device_record(
             "flashed_at": now_iso,
             "history": [],
         }
-        db["devices"].append(dev)
-        _save_devices(db)
-        return dev
+        if build_stats:
+            dev["build_stats"] = build_stats
+        return _registry.put(dev)
 
 
-def get_firmware_paths(name: str) -> Tuple[Optional[str], Optional[str]]:
-    """
-    Recursively search /data/yaml/.esphome/build/** for firmware.bin or
-    firmware.factory.bin, pick the newest. Prefer firmware.bin when both exist.
-    """
-    build_root = os.path.join(YAML_DIR, ".esphome", "build")
-    if not os.path.isdir(build_root):
-        return None, None
+ARTIFACTS_FILE = Path(DATA_DIR) / "artifacts.json"
 
-    candidates: List[Tuple[float, str]] = []
-    for root, _, files in os.walk(build_root):
-        for fn in files:
-            if fn in ("firmware.bin", "firmware.factory.bin"):
-                full = os.path.join(root, fn)
-                try:
-                    mtime = os.path.getmtime(full)
-                    candidates.append((mtime, full))
-                except OSError:
-                    pass
 
-    if not candidates:
-        return None, None
+class _ArtifactIndex:
+    """name -> {"path", "sha256", "size", "mtime", "built_at"} of the last successful build."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self.entries is None:
+            try:
+                self.entries = json.loads(self.path.read_text(encoding="utf-8")).get("artifacts", {})
+            except Exception:
+                self.entries = {}
+        return self.entries
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            e = self._load().get(name)
+            return dict(e) if e else None
+
+    def record(self, name: str, path: str, sha256: str, size: int) -> None:
+        with self.lock:
+            self._load()[name] = {
+                "path": path,
+                "sha256": sha256,
+                "size": size,
+                "mtime": os.path.getmtime(path),
+                "built_at": _iso_now(),
+            }
+            _atomic_write(self.path, {"version": 1, "artifacts": self.entries}, indent=None)
+
+
+_artifacts = _ArtifactIndex(ARTIFACTS_FILE)
 
-    candidates.sort(key=lambda t: t[0], reverse=True)
-    latest_path = candidates[0][1]
 
-    if latest_path.endswith("firmware.factory.bin"):
-        maybe_bin = latest_path.replace("firmware.factory.bin", "firmware.bin")
-        if os.path.exists(maybe_bin):
-            latest_path = maybe_bin
+def _yaml_substitutions(text: str) -> Dict[str, str]:
+    subs: Dict[str, str] = {}
+    in_block = False
+    for line in (text or "").splitlines():
+        if re.match(r'^substitutions:\s*(?:#.*)?$', line):
+            in_block = True
+            continue
+        if in_block:
+            if line.strip() == "" or line.lstrip().startswith("#"):
+                continue
+            if not line.startswith((" ", "\t")):
+                break
+            m = re.match(r'^\s+(\w+):\s*["\']?([^"\'#]*?)["\']?\s*(?:#.*)?$', line)
+            if m:
+                subs[m.group(1)] = m.group(2)
+    return subs
+
+
+def _esphome_node_name(text: str) -> Optional[str]:
+    """esphome.name with ${substitutions} applied – the build directory ESPHome uses."""
+    raw = extract_name_from_yaml(text or "")
+    if not raw:
+        return None
+    subs = _yaml_substitutions(text)
+    return re.sub(r'\$\{?(\w+)\}?', lambda m: subs.get(m.group(1), m.group(0)), raw)
+
+
+def _firmware_candidates(name: str) -> List[str]:
+    """Where this device's firmware has to be: last indexed path, then its build dir."""
+    build_root = os.path.join(YAML_DIR, ".esphome", "build")
+    out: List[str] = []
+    known = _artifacts.get(name)
+    if known and known.get("path"):
+        out.append(known["path"])
+    node_names = [name]
+    try:
+        node = _esphome_node_name(Path(YAML_DIR, f"{name}.yaml").read_text(encoding="utf-8"))
+        if node and node not in node_names:
+            node_names.insert(0, node)
+    except OSError:
+        pass
+    for node in node_names:
+        env_dir = os.path.join(build_root, node, ".pioenvs", node)
+        for fn in ("firmware.bin", "firmware.factory.bin"):
+            path = os.path.join(env_dir, fn)
+            if path not in out:
+                out.append(path)
+    return out
+
 
+def get_firmware_paths(name: str, since: Optional[float] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Resolve firmware.bin (preferred) or firmware.factory.bin for `name`:
+    indexed path / known build dir first (a few stats), then a scan of the
+    per-device env dirs restricted to matching names. With `since`, binaries
+    written at/after that time (i.e. by the current build) are preferred; an
+    older one still counts – PlatformIO leaves an up-to-date firmware.bin alone.
+    """
     manifest_path = os.path.join(OUTPUT_DIR, f"{name}.manifest.json")
-    return latest_path, manifest_path
+
+    def _mtime(path: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _fresh(mtime: float) -> bool:
+        return since is None or mtime >= since - 1.0
+
+    stale = None
+    for path in _firmware_candidates(name):
+        mtime = _mtime(path)
+        if mtime is None:
+            continue
+        if _fresh(mtime):
+            return path, manifest_path
+        stale = stale or path
+
+    # Fallback: nur die env-Verzeichnisse ansehen, nicht den ganzen Build-Baum
+    build_root = os.path.join(YAML_DIR, ".esphome", "build")
+    try:
+        dirs = os.listdir(build_root)
+    except OSError:
+        dirs = []
+    candidates: List[Tuple[bool, float, str]] = []
+    for d in dirs:
+        if _normalize_name(d).replace("-", "_") != name.replace("-", "_"):
+            continue
+        envs = os.path.join(build_root, d, ".pioenvs")
+        try:
+            env_names = os.listdir(envs)
+        except OSError:
+            continue
+        for env in env_names:
+            for fn in ("firmware.bin", "firmware.factory.bin"):
+                full = os.path.join(envs, env, fn)
+                mtime = _mtime(full)
+                if mtime is not None:
+                    candidates.append((_fresh(mtime), mtime + (0.5 if fn == "firmware.bin" else 0), full))
+    candidates.sort(reverse=True)
+    if candidates and (candidates[0][0] or stale is None):
+        return candidates[0][2], manifest_path
+    if stale:
+        return stale, manifest_path
+    return None, None
 
 
 def extract_name_from_yaml(text: str) -> Optional[str]:
@@ -270,428 +1386,4292 @@ def _sha256_file(path: str) -> str:
             h.update(chunk)
     return h.hexdigest()
 
-def ensure_manifest_for_name(name: str, platform: str) -> tuple[str, str]:
+
+_FICLONE = 0x40049409   # linux/fs.h, Reflink (btrfs/xfs)
+
+
+def _link_or_copy(src: str, dst: str, want_hash: bool) -> Tuple[str, Optional[str], int]:
     """
-    Sucht/holt das neueste firmware(.factory).bin, kopiert sie nach OUTPUT_DIR/<name>.bin,
-    schreibt ein Manifest mit korrektem chipFamily und gibt (rel_manifest_url, sha256) zurück.
+    Place src at dst without copying bytes if possible: hardlink, then
+    reflink, then a plain copy (which hashes on the way if `want_hash`).
+    dst is replaced atomically. Returns (method, sha256 or None, size).
+    src must never be modified in place afterwards (build cache files aren't).
     """
-    bin_src, _ = get_firmware_paths(name)
-    if not bin_src or not os.path.exists(bin_src):
-        raise FileNotFoundError("No firmware binary found after compile.")
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    size = os.path.getsize(src)
+    try:
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+        return "hardlink", None, size
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+        os.replace(tmp, dst)
+        return "reflink", None, size
+    except (OSError, ImportError):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    if want_hash:
+        sha, size = _copy_hashing(src, dst)
+        return "copy", sha, size
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return "copy", None, size
 
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    bin_dst = os.path.join(OUTPUT_DIR, f"{name}.bin")
-    shutil.copyfile(bin_src, bin_dst)
 
-    chip_family = chip_family_for_platform(platform)
+def publish_firmware(name: str, platform: str, bin_src: str,
+                     sha256: Optional[str] = None, version: str = "1.0.0") -> Dict[str, Any]:
+    """
+    Expose bin_src as OUTPUT_DIR/<name>.bin and write the Web-Flasher manifest.
+    The SHA-256 is only computed if the caller doesn't already know it, and
+    then in the same pass as the copy (or one read when linked).
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    bin_dst = os.path.join(OUTPUT_DIR, f"{name}.bin")
+    method, copied_sha, size = _link_or_copy(bin_src, bin_dst, want_hash=sha256 is None)
+    sha256 = sha256 or copied_sha or _sha256_file(bin_dst)
+
     manifest_path = os.path.join(OUTPUT_DIR, f"{name}.manifest.json")
     manifest_data = {
         "name": f"{name} Firmware",
-        "version": "1.0.0",
+        "version": version,
         "builds": [{
-            "chipFamily": chip_family,
-            "parts": [{"path": f"firmware/{name}.bin", "offset": 0}],
+            "chipFamily": chip_family_for_platform(platform),
+            "parts": [{"path": f"firmware/{name}.bin", "offset": 0,
+                       "sha256": sha256, "size": size}],
         }],
     }
-    with open(manifest_path, "w", encoding="utf-8") as f:
+    tmp = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(manifest_data, f)
+    os.replace(tmp, manifest_path)
+
+    return {
+        "manifest_url": f"/firmware/{name}.manifest.json",
+        "path": bin_dst,
+        "sha256": sha256,
+        "size": size,
+        "version": version,
+        "method": method,
+    }
+
+
+# =========================
+# Build cache (YAML + includes + ESPHome version -> firmware.bin)
+# =========================
+BUILD_CACHE_DIR = Path(DATA_DIR) / "build_cache"
+BUILD_CACHE_MAX_BYTES = int(_addon_option("build_cache_mb", 512)) * 1024 * 1024
+BUILD_CACHE_MAX_ENTRIES = 500
+
+_INCLUDE_RE = re.compile(r'!include\s+(?:\{\s*file:\s*)?["\']?([^\s"\'},]+)')
+_FILE_RE = re.compile(r'^\s*(?:-\s*)?file:\s*["\']?([^\s"\'#]+)', re.M)
+# "key: |-", "- >", "lambda: |" ... → danach folgt ein Block-Scalar (Code, nicht YAML)
+_BLOCK_SCALAR_RE = re.compile(r'^(\s*)(?:-\s+)?(?:[^#\s][^#]*:\s+)?[|>][-+0-9]*\s*(?:#.*)?$')
+_KEY_LINE_RE = re.compile(r'^(\s*)(?:-\s+)?([A-Za-z_][\w-]*):(.*)$')
+_LIST_ITEM_RE = re.compile(r'^\s*-\s*["\']?([^\s"\'#]+)')
+# external_components: "source: my_components", "path: ...", "{type: local, path: ...}"
+_PATH_VALUE_RE = re.compile(r'(?:^[ \t]*(?:-[ \t]*)?source|\bpath):[ \t]*["\']?([^\s"\'#,{}]+)', re.M)
+_esphome_version_cache: Optional[str] = None
+
+
+def _esphome_version() -> str:
+    global _esphome_version_cache
+    if _esphome_version_cache is None:
+        try:
+            from importlib.metadata import version
+            _esphome_version_cache = version("esphome")
+        except Exception:
+            try:
+                out = subprocess.run(["esphome", "version"], capture_output=True, text=True, timeout=60)
+                _esphome_version_cache = out.stdout.strip() or "unknown"
+            except Exception:
+                _esphome_version_cache = "unknown"
+    return _esphome_version_cache
+
+
+def _normalize_yaml_for_key(text: str) -> str:
+    """
+    Drop what cannot change the build: CRLF, trailing blanks, empty and comment
+    lines. Block scalars (lambda: |- ...) are kept verbatim – a line starting
+    with # there is C++ (#include, #define), not a YAML comment.
+    """
+    lines = []
+    block_indent = None   # Einrückung der Zeile, die den Block-Scalar eröffnet hat
+    for raw in (text or "").replace("\r\n", "\n").split("\n"):
+        if block_indent is not None:
+            if not raw.strip() or len(raw) - len(raw.lstrip()) > block_indent:
+                lines.append(raw)
+                continue
+            block_indent = None
+        line = raw.rstrip()
+        if line and not line.lstrip().startswith("#"):
+            lines.append(line)
+            m = _BLOCK_SCALAR_RE.match(line)
+            if m:
+                block_indent = len(m.group(1))
+    return "\n".join(lines)
+
+
+def _yaml_section(text: str, key: str) -> List[str]:
+    """Lines nested under every `key:` (any depth), including an inline value on the key line."""
+    out = []
+    indent = None
+    for line in text.split("\n"):
+        if indent is not None:
+            if not line.strip() or len(line) - len(line.lstrip()) > indent:
+                out.append(line)
+                continue
+            indent = None
+        m = _KEY_LINE_RE.match(line)
+        if m and m.group(2) == key:
+            indent = len(m.group(1))
+            out.append(m.group(3))
+    return out
+
+
+def _is_local_source(value: str) -> bool:
+    return "://" not in value and not value.startswith(("github:", "gh:", "git@")) and "@" not in value
+
+
+def _yaml_dependencies(text: str) -> List[str]:
+    """
+    Local files a config pulls in: !include targets (local packages included,
+    followed recursively), file: assets, esphome includes:, local
+    external_components sources and secrets.yaml. Directories expand to the
+    files below them.
+    """
+    root = os.path.realpath(YAML_DIR)
+    out: List[str] = []
+    seen = set()
+
+    def _add(base: str, dep: str, follow: bool) -> None:
+        full = os.path.realpath(os.path.join(base, dep))
+        if not full.startswith(root + os.sep) or full in seen:
+            return
+        seen.add(full)
+        if os.path.isdir(full):
+            for dirpath, dirnames, filenames in os.walk(full):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and d != "__pycache__")
+                for fn in sorted(filenames):
+                    if not fn.startswith("."):
+                        _add(dirpath, fn, False)
+        elif os.path.isfile(full):
+            out.append(full)
+            if follow and full.endswith((".yaml", ".yml")):
+                try:
+                    with open(full, "r", encoding="utf-8", errors="replace") as f:
+                        _scan(os.path.dirname(full), f.read())
+                except OSError:
+                    pass
+
+    def _scan(base: str, body: str) -> None:
+        for dep in _INCLUDE_RE.findall(body):
+            _add(base, dep, True)
+        for dep in _FILE_RE.findall(body):
+            _add(base, dep, False)
+        for line in _yaml_section(body, "includes"):
+            inline = line.strip()
+            if inline.startswith("["):
+                deps = [d.strip(" \"'") for d in inline.strip("[]").split(",")]
+            else:
+                m = _LIST_ITEM_RE.match(line)
+                deps = [m.group(1)] if m else []
+            for dep in deps:
+                if dep:
+                    _add(base, dep, False)
+        ext = "\n".join(_yaml_section(body, "external_components"))
+        for dep in _PATH_VALUE_RE.findall(ext):
+            if _is_local_source(dep):
+                _add(base, dep, False)
+        if "!secret" in body:
+            _add(YAML_DIR, "secrets.yaml", False)
+
+    _scan(YAML_DIR, text or "")
+    return sorted(out)
+
+
+def build_cache_key(config_text: str) -> str:
+    h = hashlib.sha256()
+    h.update(f"esphome={_esphome_version()}\n".encode())
+    h.update(_normalize_yaml_for_key(config_text).encode("utf-8"))
+    for dep in _yaml_dependencies(config_text):
+        h.update(f"\n--- {os.path.relpath(dep, YAML_DIR)}\n".encode())
+        with open(dep, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _copy_hashing(src: str, dst: str) -> Tuple[str, int]:
+    """Copy src→dst (via temp file) and return (sha256, size) from the same pass."""
+    h = hashlib.sha256()
+    size = 0
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+            h.update(chunk)
+            fout.write(chunk)
+            size += len(chunk)
+    os.replace(tmp, dst)
+    return h.hexdigest(), size
+
+
+class _BuildCache:
+    """
+    key -> {"sha256", "size", "name", "created_at", "last_used"} in index.json;
+    binaries live once per content hash in artifacts/<sha256>.bin.
+    Evicts least recently used keys beyond the size/entry budget.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, max_entries: int):
+        self.root = root
+        self.artifacts = root / "artifacts"
+        self.index_path = root / "index.json"
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self.entries is None:
+            try:
+                self.entries = json.loads(self.index_path.read_text(encoding="utf-8")).get("entries", {})
+            except Exception:
+                self.entries = {}
+        return self.entries
+
+    def _save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        _atomic_write(self.index_path, {"version": 1, "entries": self._load()}, indent=None)
+
+    def artifact_path(self, sha: str) -> Path:
+        return self.artifacts / f"{sha}.bin"
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            e = self._load().get(key)
+            if e and self.artifact_path(e["sha256"]).exists():
+                e["last_used"] = time.time()
+                self.hits += 1
+                M_CACHE_LOOKUPS.inc(result="hit")
+                self._save()
+                return {**e, "key": key, "path": str(self.artifact_path(e["sha256"]))}
+            if e:
+                del self.entries[key]
+            self.misses += 1
+            M_CACHE_LOOKUPS.inc(result="miss")
+            return None
+
+    def store(self, key: str, bin_path: str, name: str) -> Dict[str, Any]:
+        now = time.time()
+        size = os.path.getsize(bin_path)
+        if size > self.max_bytes or self.max_entries <= 0:
+            # passt nie ins Budget (z. B. build_cache_mb: 0) – nicht cachen, Build-Output direkt nutzen
+            return {"sha256": _sha256_file(bin_path), "size": size, "name": name,
+                    "created_at": now, "last_used": now, "key": key, "path": bin_path}
+        self.artifacts.mkdir(parents=True, exist_ok=True)
+        tmp = self.artifacts / f".incoming-{uuid.uuid4().hex}"
+        sha, size = _copy_hashing(bin_path, str(tmp))
+        with self.lock:
+            dst = self.artifact_path(sha)
+            if dst.exists():
+                tmp.unlink()
+            else:
+                os.replace(tmp, dst)
+            entry = {"sha256": sha, "size": size, "name": name,
+                     "created_at": now, "last_used": now}
+            self._load()[key] = entry
+            self._evict(keep=key)
+            self._save()
+            return {**entry, "key": key, "path": str(dst)}
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """LRU eviction; `keep` (the entry just stored) is never evicted."""
+        entries = self._load()
+        by_age = sorted(((k, e) for k, e in entries.items() if k != keep),
+                        key=lambda kv: kv[1].get("last_used", 0))
+
+        def _total() -> int:
+            sizes = {e["sha256"]: e.get("size", 0) for e in entries.values()}
+            return sum(sizes.values())
+
+        while by_age and (len(entries) > self.max_entries or _total() > self.max_bytes):
+            key, e = by_age.pop(0)
+            del entries[key]
+            if not any(o["sha256"] == e["sha256"] for o in entries.values()):
+                try:
+                    self.artifact_path(e["sha256"]).unlink()
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = self._load()
+            total = self.hits + self.misses
+            return {
+                "entries": len(entries),
+                "bytes": sum({e["sha256"]: e.get("size", 0) for e in entries.values()}.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else None,
+            }
+
+
+_build_cache = _BuildCache(BUILD_CACHE_DIR, BUILD_CACHE_MAX_BYTES, BUILD_CACHE_MAX_ENTRIES)
+
+
+# =========================
+# Firmware store (versioned, content-addressed)
+# =========================
+FIRMWARE_STORE_DIR = Path(DATA_DIR) / "firmware_store"
+FIRMWARE_KEEP_BUILDS = int(_addon_option("firmware_keep_builds", 5))
+FIRMWARE_STORE_MAX_BYTES = int(_addon_option("firmware_store_mb", 1024)) * 1024 * 1024
+
+
+def _firmware_version(config_text: str, sha256: str) -> str:
+    """esphome.project.version if set, else '<esphome version>-<sha8>'."""
+    lines = (config_text or "").splitlines()
+    for i, line in enumerate(lines):
+        m = re.match(r'^(\s*)project:\s*(?:#.*)?$', line)
+        if not m:
+            continue
+        indent = len(m.group(1))
+        for nxt in lines[i + 1:]:
+            if nxt.strip() and len(nxt) - len(nxt.lstrip()) <= indent:
+                break
+            v = re.match(r'^\s+version:\s*["\']?([^"\'#\s]+)', nxt)
+            if v:
+                return v.group(1)
+    return f"{_esphome_version()}-{sha256[:8]}"
+
+
+class _FirmwareStore:
+    """
+    Every published/flashed build, once per SHA-256:
+      firmware_store/<ab>/<sha256>.bin      (hardlinked from the build cache when possible)
+      firmware_store/yaml/<sha256>.yaml     YAML the build came from
+      firmware_store/index.json             blobs + last FIRMWARE_KEEP_BUILDS builds per device
+    Blobs no device keeps anymore are deleted; above the disk budget the
+    least recently used blobs go first, but never a device's current build.
+    """
+
+    def __init__(self, root: Path, keep: int, max_bytes: int):
+        self.root = root
+        self.keep = max(1, keep)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self.index is None:
+            try:
+                self.index = json.loads((self.root / "index.json").read_text(encoding="utf-8"))
+            except Exception:
+                self.index = {}
+            self.index.setdefault("blobs", {})
+            self.index.setdefault("devices", {})
+        return self.index
+
+    def _save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        _atomic_write(self.root / "index.json", {"version": 1, **self._load()}, indent=None)
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha[:2] / f"{sha}.bin"
+
+    def _yaml_path(self, yaml_sha: str) -> Path:
+        return self.root / "yaml" / f"{yaml_sha}.yaml"
+
+    def add(self, name: str, src: str, sha256: str, size: int, config_text: str) -> Dict[str, Any]:
+        """Store a build for `name` (dedup by hash) and return its entry incl. "path"."""
+        dst = self.path(sha256)
+        if not dst.exists():
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            _link_or_copy(src, str(dst), want_hash=False)
+        yaml_bytes = (config_text or "").encode("utf-8")
+        yaml_sha = hashlib.sha256(yaml_bytes).hexdigest()
+        ypath = self._yaml_path(yaml_sha)
+        if not ypath.exists():
+            ypath.parent.mkdir(parents=True, exist_ok=True)
+            tmp = ypath.with_name(f".{yaml_sha}.{uuid.uuid4().hex}.tmp")
+            tmp.write_bytes(yaml_bytes)
+            os.replace(tmp, ypath)
+
+        now = time.time()
+        entry = {
+            "sha256": sha256,
+            "size": size,
+            "version": _firmware_version(config_text, sha256),
+            "esphome_version": _esphome_version(),
+            "yaml_sha256": yaml_sha,
+            "built_at": _iso_now(),
+        }
+        with self.lock:
+            idx = self._load()
+            blob = idx["blobs"].setdefault(sha256, {"size": size, "created_at": now})
+            blob["last_used"] = now
+            builds = [b for b in idx["devices"].get(name, []) if b["sha256"] != sha256]
+            builds.append(entry)
+            idx["devices"][name] = builds[-self.keep:]
+            self._gc()
+            self._save()
+        return {**entry, "path": str(dst)}
+
+    def builds(self, name: str) -> List[Dict[str, Any]]:
+        """Retained builds of a device, newest first."""
+        with self.lock:
+            return [dict(b) for b in reversed(self._load()["devices"].get(name, []))
+                    if self.path(b["sha256"]).exists()]
+
+    def get(self, name: str, sha256: str) -> Optional[Dict[str, Any]]:
+        for b in self.builds(name):
+            if b["sha256"] == sha256:
+                return {**b, "path": str(self.path(sha256))}
+        return None
+
+    def yaml(self, entry: Dict[str, Any]) -> Optional[str]:
+        try:
+            return self._yaml_path(entry["yaml_sha256"]).read_text(encoding="utf-8")
+        except (KeyError, OSError):
+            return None
+
+    def touch(self, name: str, sha256: str) -> None:
+        """Mark a stored build as the device's current one again (after a rollback)."""
+        with self.lock:
+            idx = self._load()
+            blob = idx["blobs"].get(sha256)
+            if not blob:
+                return
+            blob["last_used"] = time.time()
+            builds = idx["devices"].get(name, [])
+            idx["devices"][name] = ([b for b in builds if b["sha256"] != sha256]
+                                    + [b for b in builds if b["sha256"] == sha256])
+            self._save()
+
+    def _gc(self) -> None:
+        idx = self._load()
+        referenced = {b["sha256"] for builds in idx["devices"].values() for b in builds}
+        current = {builds[-1]["sha256"] for builds in idx["devices"].values() if builds}
+        for sha in [s for s in idx["blobs"] if s not in referenced]:
+            self._drop_blob(sha)
+        total = sum(b.get("size", 0) for b in idx["blobs"].values())
+        for sha, blob in sorted(idx["blobs"].items(), key=lambda kv: kv[1].get("last_used", 0)):
+            if total <= self.max_bytes:
+                break
+            if sha in current:
+                continue
+            total -= blob.get("size", 0)
+            self._drop_blob(sha)
+            for name, builds in idx["devices"].items():
+                idx["devices"][name] = [b for b in builds if b["sha256"] != sha]
+        live_yaml = {b.get("yaml_sha256") for builds in idx["devices"].values() for b in builds}
+        ydir = self.root / "yaml"
+        if ydir.is_dir():
+            for f in ydir.glob("*.yaml"):
+                if f.stem not in live_yaml:
+                    f.unlink()
+
+    def _drop_blob(self, sha: str) -> None:
+        self._load()["blobs"].pop(sha, None)
+        try:
+            self.path(sha).unlink()
+        except OSError:
+            pass
+
+
+_firmware_store = _FirmwareStore(FIRMWARE_STORE_DIR, FIRMWARE_KEEP_BUILDS, FIRMWARE_STORE_MAX_BYTES)
+
+
+# =========================
+# Build output parsing (phases, progress, usage)
+# =========================
+# esphome/PlatformIO-Zeilen -> Phase; Reihenfolge = Priorität
+_PHASE_PATTERNS = [
+    ("config", re.compile(r'INFO Reading configuration')),
+    ("codegen", re.compile(r'INFO Generating C\+\+ source|INFO Compiling app')),
+    ("dependencies", re.compile(r'^(Library Manager|Dependency Graph|Processing \S+ \(|Tool Manager|Platform Manager)')),
+    ("compile", re.compile(r'^(Compiling|Retrieved \S+) \S*\.o\b|^Retrieved \S+\.o')),
+    ("link", re.compile(r'^Linking \S+')),
+    ("image", re.compile(r'^(Building \S+\.bin|Creating esp\S* image|Generating \S+\.bin)')),
+    ("upload", re.compile(r'INFO (Uploading|Connecting to|Starting OTA|Upload with baud)|^esptool')),
+]
+_OBJECT_RE = re.compile(r'^Compiling (\S+\.o)\b')
+_CACHED_OBJECT_RE = re.compile(r"^Retrieved [`'\"]?(\S+?\.o)[`'\"]? from cache")
+_FRAMEWORK_OBJECT_RE = re.compile(r'Framework|framework-|/esp-idf/|/arduino-esp|/esp8266/', re.I)
+_USAGE_RE = re.compile(r'^(RAM|Flash):\s*\[[^\]]*\]\s*([\d.]+)%\s*\(used (\d+) bytes from (\d+) bytes\)')
+_UPLOAD_PCT_RE = re.compile(r'Uploading:\s*\[[^\]]*\]\s*(\d+)%|Writing at 0x[0-9a-f]+\.*\s*\((\d+)\s*%\)')
+_WARNING_RE = re.compile(r'\bwarning:|^WARNING\b|\[W\]')
+_ERROR_RE = re.compile(r'\berror:|^ERROR\b|\*\*\* \[.*\] Error')
+
+
+class _BuildOutputParser:
+    """
+    Fed every output line of a compile/upload. Tracks the current phase and its
+    duration, objects compiled (total estimated from the device's previous
+    build), RAM/flash usage, OTA percentage and warnings/errors, and publishes
+    "progress" events on the job.
+    """
+
+    MAX_MESSAGES = 5
+
+    def __init__(self, job: Optional["_Job"] = None, expected_objects: Optional[int] = None):
+        self.job = job
+        self.expected_objects = expected_objects
+        self.phase: Optional[str] = None
+        self.phase_started = time.monotonic()
+        self.started = self.phase_started
+        self.phases: Dict[str, float] = {}
+        self.objects = 0
+        self.cached_objects = 0      # aus PLATFORMIO_BUILD_CACHE_DIR
+        self.framework_compiled = 0  # kalte Framework-Objekte (Cache nicht warm)
+        self.usage: Dict[str, Dict[str, Any]] = {}
+        self.upload_pct: Optional[int] = None
+        self.warnings: List[str] = []
+        self.errors: List[str] = []
+        self.warning_count = 0
+        self.error_count = 0
+
+    def _progress(self, **data) -> None:
+        if self.job is not None:
+            self.job.publish("progress", {"phase": self.phase, **data})
+
+    def _enter(self, phase: str) -> None:
+        if phase == self.phase:
+            return
+        now = time.monotonic()
+        if self.phase:
+            self.phases[self.phase] = round(self.phases.get(self.phase, 0.0) + now - self.phase_started, 3)
+        self.phase, self.phase_started = phase, now
+        self._progress()
+
+    def feed(self, line: str) -> None:
+        line = line.strip()
+        if not line:
+            return
+        for phase, rx in _PHASE_PATTERNS:
+            if rx.search(line):
+                self._enter(phase)
+                break
+
+        m = _OBJECT_RE.match(line) or _CACHED_OBJECT_RE.match(line)
+        if m:
+            self.objects += 1
+            if line.startswith("Retrieved"):
+                self.cached_objects += 1
+            elif _FRAMEWORK_OBJECT_RE.search(m.group(1)):
+                self.framework_compiled += 1
+            total = self.expected_objects
+            self._progress(objects=self.objects, objects_total=total,
+                           percent=min(99, round(100 * self.objects / total)) if total else None)
+            return
+        m = _USAGE_RE.match(line)
+        if m:
+            self.usage[m.group(1).lower()] = {"percent": float(m.group(2)), "used": int(m.group(3)),
+                                              "total": int(m.group(4))}
+            self._progress(usage=self.usage)
+            return
+        m = _UPLOAD_PCT_RE.search(line)
+        if m:
+            pct = int(m.group(1) or m.group(2))
+            if pct != self.upload_pct:
+                self.upload_pct = pct
+                self._enter("upload")
+                self._progress(percent=pct)
+            return
+        if _ERROR_RE.search(line):
+            self.error_count += 1
+            if len(self.errors) < self.MAX_MESSAGES:
+                self.errors.append(line[:300])
+                self._progress(error=line[:300])
+        elif _WARNING_RE.search(line):
+            self.warning_count += 1
+            if len(self.warnings) < self.MAX_MESSAGES:
+                self.warnings.append(line[:300])
+
+    def stats(self) -> Dict[str, Any]:
+        """Close the running phase; summary for the device record (build_stats)."""
+        self._enter("done")
+        self.phases.pop("done", None)
+        compiled = self.objects - self.cached_objects
+        if self.objects:
+            M_PIO_OBJECTS.inc(compiled, result="compiled")
+            M_PIO_OBJECTS.inc(self.cached_objects, result="cached")
+            _pio_cache_tally.add(compiled, self.cached_objects, self.framework_compiled)
+        return {
+            "phases": self.phases,
+            "total_seconds": round(time.monotonic() - self.started, 3),
+            "objects": self.objects,
+            "cached_objects": self.cached_objects,
+            "framework_compiled": self.framework_compiled,
+            "ram": self.usage.get("ram"),
+            "flash": self.usage.get("flash"),
+            "warnings": self.warning_count,
+            "errors": self.error_count,
+            "warning_samples": self.warnings,
+            "error_samples": self.errors,
+            "esphome_version": _esphome_version(),
+            "at": _iso_now(),
+        }
+
+
+class _PioCacheTally:
+    """Object-level hit rate of the PlatformIO build cache since start."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.compiled = 0
+        self.cached = 0
+        self.framework_compiled = 0
+
+    def add(self, compiled: int, cached: int, framework_compiled: int) -> None:
+        with self.lock:
+            self.compiled += compiled
+            self.cached += cached
+            self.framework_compiled += framework_compiled
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.compiled + self.cached
+            return {"compiled": self.compiled, "cached": self.cached,
+                    "framework_compiled": self.framework_compiled,
+                    "hit_rate": (self.cached / total) if total else None}
+
+
+_pio_cache_tally = _PioCacheTally()
+
+
+def _expected_objects(name: str, platform: str) -> Optional[int]:
+    """Object count of the device's last full compile (for N/M progress)."""
+    d = _registry.find(name, platform)
+    return ((d or {}).get("build_stats") or {}).get("objects") or None
+
+
+# =========================
+# Build jobs (queue + worker pool)
+# =========================
+COMPILE_MEM_PER_BUILD = 1024 * 1024 * 1024   # grobe Obergrenze RAM pro PlatformIO-Build
+COMPILE_QUEUE_MAX = 64
+JOB_RETENTION = 3600.0                        # s, fertige Jobs bleiben abrufbar
+JOB_EVENT_BUFFER = 2000                       # Events pro Job (Ringpuffer für Reconnects)
+JOB_LOG_LINES = 5000                          # Logzeilen pro Job; ältere fallen vorne heraus
+
+
+def _default_compile_workers() -> int:
+    """Parallel builds: core count, capped by what fits into RAM."""
+    cpus = os.cpu_count() or 1
+    try:
+        mem = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        by_mem = max(1, mem // COMPILE_MEM_PER_BUILD)
+    except (ValueError, OSError, AttributeError):
+        by_mem = cpus
+    return max(1, min(cpus, by_mem))
+
+
+COMPILE_WORKERS = int(_addon_option("compile_workers", 0)) or _default_compile_workers()
+
+
+class _Job:
+    """
+    One queued build/flash; the last JOB_LOG_LINES log lines are kept so
+    clients can (re)attach. Log offsets count all lines ever emitted.
+    """
+
+    def __init__(self, kind: str, name: str, params: Dict[str, Any], runner):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.name = name
+        self.params = params
+        self.runner = runner
+        self.state = "queued"          # queued | running | succeeded | failed | cancelled
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.log: deque = deque(maxlen=JOB_LOG_LINES)
+        self.log_total = 0             # emittierte Zeilen insgesamt (Offsets sind absolut)
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.proc: Optional[subprocess.Popen] = None
+        self.cancelled = threading.Event()
+        self.cond = threading.Condition()
+        # Typisierte Events (state/log/progress/artifact/result), ids fortlaufend ab 1
+        self.events: deque = deque(maxlen=JOB_EVENT_BUFFER)
+        self.last_event_id = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("succeeded", "failed", "cancelled")
+
+    def publish(self, kind: str, data: Dict[str, Any]) -> None:
+        with self.cond:
+            self.last_event_id += 1
+            self.events.append({"id": self.last_event_id, "type": kind, "t": round(time.time(), 3), "data": data})
+            self.cond.notify_all()
+
+    def emit(self, line: str) -> None:
+        with self.cond:
+            self.log.append(line)
+            self.log_total += 1
+            self.publish("log", {"line": line})
+
+    def set_state(self, state: str) -> None:
+        with self.cond:
+            self.state = state
+            self.publish("state", {"state": state})
+
+    def finish(self, state: str, error: Optional[str] = None) -> None:
+        with self.cond:
+            self.error = error or self.error   # vom Runner gesetzte Fehler nicht verlieren
+            self.finished_at = time.time()
+            self.publish("result", {"state": state, "result": self.result, "error": self.error})
+            self.set_state(state)
+
+    def events_after(self, last_id: int, timeout: float = 15.0) -> Tuple[List[Dict[str, Any]], int, bool]:
+        """Events with id > last_id (waits up to `timeout`); returns (events, dropped, finished)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.last_event_id > last_id or self.finished, timeout=timeout)
+            oldest = self.events[0]["id"] if self.events else self.last_event_id + 1
+            dropped = max(0, oldest - last_id - 1)
+            return [e for e in self.events if e["id"] > last_id], dropped, self.finished
+
+    def log_since(self, offset: int) -> Tuple[List[str], int]:
+        """Retained lines from absolute `offset` on and the offset after them (call under cond)."""
+        first = self.log_total - len(self.log)
+        start = max(offset, first)
+        lines = list(itertools.islice(self.log, start - first, None))
+        return lines, start + len(lines)
+
+    def log_tail(self, n: int) -> List[str]:
+        with self.cond:
+            return list(self.log)[-n:]
+
+    def follow(self, offset: int = 0) -> Iterator[str]:
+        """Yield log lines from `offset` on until the job has finished."""
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.log_total > offset or self.finished, timeout=15.0)
+                lines, offset = self.log_since(offset)
+                done = self.finished
+            for line in lines:
+                yield line
+            if done and not lines:
+                return
+
+    def to_dict(self, position: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "state": self.state,
+            "position": position,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "log_lines": self.log_total,
+            "last_event_id": self.last_event_id,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class _JobScheduler:
+    """
+    FIFO queue with a fixed worker pool. Jobs for the same device never run
+    at the same time (shared build dir), and a job that is still queued for
+    a device absorbs newer submissions of the same kind.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.lock = threading.Condition()
+        self.queue: List[_Job] = []
+        self.jobs: Dict[str, _Job] = {}
+        self.running: Dict[str, _Job] = {}   # device name -> job
+        self._threads: List[threading.Thread] = []
+
+    def _ensure_workers(self) -> None:
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name=f"build-{len(self._threads)}", daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - JOB_RETENTION
+        for jid, job in list(self.jobs.items()):
+            if job.finished and (job.finished_at or 0) < cutoff:
+                del self.jobs[jid]
+
+    def submit(self, kind: str, name: str, params: Dict[str, Any], runner) -> Tuple[_Job, bool]:
+        """Queue a job; returns (job, deduplicated). Raises RuntimeError when full."""
+        with self.lock:
+            self._prune()
+            for queued in self.queue:
+                if queued.kind == kind and queued.name == name:
+                    queued.params = params   # neueste YAML gewinnt
+                    return queued, True
+            if len(self.queue) >= self.max_queue:
+                raise RuntimeError("Build queue is full, try again later.")
+            job = _Job(kind, name, params, runner)
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self._ensure_workers()
+            self.lock.notify_all()
+            return job, False
+
+    def get(self, job_id: str) -> Optional[_Job]:
+        with self.lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    def snapshot(self) -> List[_Job]:
+        """All known jobs, oldest first (copied under the lock)."""
+        with self.lock:
+            self._prune()
+            jobs = list(self.jobs.values())
+        return sorted(jobs, key=lambda j: j.created_at)
+
+    def position(self, job: _Job) -> Optional[int]:
+        """1-based queue position, 0 while running, None when done."""
+        with self.lock:
+            if job in self.queue:
+                return self.queue.index(job) + 1
+            return 0 if job.state == "running" else None
+
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def cancel(self, job: _Job) -> None:
+        with self.lock:
+            job.cancelled.set()
+            if job in self.queue:
+                self.queue.remove(job)
+                job.finish("cancelled")
+                return
+        if job.proc is not None and job.proc.poll() is None:
+            job.proc.terminate()
+
+    def _next(self) -> _Job:
+        with self.lock:
+            while True:
+                for job in self.queue:
+                    if job.name not in self.running:
+                        self.queue.remove(job)
+                        self.running[job.name] = job
+                        job.started_at = time.time()
+                        job.set_state("running")
+                        return job
+                self.lock.wait()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next()
+            M_JOB_WAIT.observe(job.started_at - job.created_at, kind=job.kind)
+            try:
+                ok = job.runner(job)
+                if job.cancelled.is_set():
+                    job.finish("cancelled")
+                else:
+                    job.finish("succeeded" if ok else "failed")
+            except Exception as e:
+                traceback.print_exc()
+                job.emit(f"💥 Error: {str(e)}\n")
+                job.finish("failed", str(e))
+            finally:
+                M_JOB_DURATION.observe(time.time() - job.started_at, kind=job.kind, outcome=job.state)
+                M_JOBS.inc(kind=job.kind, outcome=job.state)
+                if job.kind != "rollback":
+                    _pio_cache_usage.invalidate()
+                with self.lock:
+                    self.running.pop(job.name, None)
+                    self.lock.notify_all()
+
+
+_scheduler = _JobScheduler(COMPILE_WORKERS, COMPILE_QUEUE_MAX)
+
+
+def _run_logged(job: _Job, args: List[str], parser: Optional[_BuildOutputParser] = None) -> int:
+    """Run an esphome command in YAML_DIR, streaming its output into the job log."""
+    proc = subprocess.Popen(
+        args,
+        cwd=YAML_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    )
+    job.proc = proc
+    M_SUBPROCS.inc(command=args[1])
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            job.emit(line)
+            if parser is not None:
+                parser.feed(line)
+        proc.stdout.close()
+        return proc.wait()
+    finally:
+        job.proc = None
+        M_SUBPROCS.dec(command=args[1])
+
+
+def _collect_artifact(name: str, key: str, since: float) -> Optional[Dict[str, Any]]:
+    """After a successful compile: resolve the bin, put it in the build cache, index it."""
+    bin_path, _ = get_firmware_paths(name, since=since)
+    if not bin_path or not os.path.exists(bin_path):
+        return None
+    entry = _build_cache.store(key, bin_path, name)
+    _artifacts.record(name, bin_path, entry["sha256"], entry["size"])
+    return {**entry, "build_path": bin_path}
+
+
+def _compile_runner(job: _Job) -> bool:
+    """Compile, mirror the bin into www/firmware, write the manifest, update the registry."""
+    p = job.params
+    name = job.name
+    yaml_path = os.path.join(YAML_DIR, f"{name}.yaml")
+    # YAML erst hier schreiben – ein laufender Build desselben Geräts liest sie sonst mitten drin
+    with open(yaml_path, "w", encoding="utf-8") as f:
+        f.write(p["config"])
+
+    job.emit(f"📥 YAML saved: {yaml_path}\n")
+
+    key = build_cache_key(p["config"])
+    artifact = None if p.get("force") else _build_cache.lookup(key)
+    build_stats = None
+    if artifact:
+        job.emit(f"♻️ Build cache hit ({key[:12]}), skipping compilation.\n")
+        job.publish("progress", {"phase": "cached", "key": key})
+    else:
+        job.emit("🚀 Starting compilation...\n\n")
+
+        # Wichtig: im YAML_DIR ausführen und nur den Dateinamen übergeben
+        started = time.time()
+        parser = _BuildOutputParser(job, _expected_objects(name, p["platform"]))
+        returncode = _run_logged(job, ["esphome", "compile", f"{name}.yaml"], parser)
+        build_stats = parser.stats()
+        if returncode != 0:
+            job.emit(f"\n❌ Compilation failed with code {returncode}.\n")
+            return False
+
+        artifact = _collect_artifact(name, key, started)
+        if not artifact:
+            job.emit(f"❌ No binary file found under {os.path.join(YAML_DIR, '.esphome', 'build')}.\n")
+            return False
+        job.emit(f"📦 Found firmware at: {artifact['build_path']}\n")
+
+    # Versioniert ablegen, dann in www/firmware verlinken (Fallback: kopieren) + Manifest
+    stored = _firmware_store.add(name, artifact["path"], artifact["sha256"], artifact["size"], p["config"])
+    published = publish_firmware(name, p["platform"], stored["path"], stored["sha256"], stored["version"])
+    job.emit(f"🔗 Published firmware {published['version']} "
+             f"({published['method']}, {published['size']} bytes)\n")
+    job.publish("artifact", {k: published[k] for k in ("manifest_url", "sha256", "size", "version")})
+
+    # Registry synchronisieren (falls UI state mitschickt)
+    saved_dev = upsert_device_record(
+        name=name,
+        platform=p["platform"],
+        board_label=p["board_label"],
+        board_id=p["board_id"],
+        yaml_text=p["config"],
+        config_json=p.get("config_json") or {},
+        firmware_sha256=published["sha256"],
+        firmware_size=published["size"],
+        build_stats=build_stats,
+    )
+
+    job.result = {
+        "manifest_url": published["manifest_url"],
+        "device": saved_dev,
+    }
+    job.emit("\n✅ Compilation successful!\n")
+    # WICHTIG: Device-Objekt mitsenden -> Client kann saved_dev['id'] merken
+    job.emit(json.dumps(job.result) + "\n")
+    return True
+
+
+def _usb_prepare_runner(job: _Job) -> bool:
+    """Compile for Web Serial flashing; result carries manifest URL + device id."""
+    p = job.params
+    name = job.name
+    # 1) (Re-)Compile sicherstellen – außer die Build-Eingaben sind unverändert
+    key = build_cache_key(p["config"])
+    cached = None if p.get("force") else _build_cache.lookup(key)
+    build_stats = None
+    if cached:
+        artifact: Optional[Dict[str, Any]] = cached
+    else:
+        started = time.time()
+        parser = _BuildOutputParser(job, _expected_objects(name, p["platform"]))
+        returncode = _run_logged(job, ["esphome", "compile", f"{name}.yaml"], parser)
+        build_stats = parser.stats()
+        if returncode != 0:
+            job.emit("\n❌ Compile failed.\n")
+            return False
+        artifact = _collect_artifact(name, key, started)
+
+    # 2) Manifest + Bin im WWW-Verzeichnis sicherstellen (Hash ist schon bekannt)
+    try:
+        if not artifact:
+            raise FileNotFoundError("No firmware binary found after compile.")
+        stored = _firmware_store.add(name, artifact["path"], artifact["sha256"], artifact["size"],
+                                     p["config"])
+        published = publish_firmware(name, p["platform"], stored["path"], stored["sha256"],
+                                     stored["version"])
+    except Exception as ex:
+        job.error = f"Failed to prepare manifest: {ex}"
+        return False
+    job.publish("artifact", {k: published[k] for k in ("manifest_url", "sha256", "size", "version")})
+
+    # 3) Registry upserten (inkl. SHA)
+    saved = upsert_device_record(
+        name=name,
+        platform=p["platform"],
+        board_label=p["board_label"],
+        board_id=p["board_id"],
+        yaml_text=p["config"],
+        ip=p.get("ip"),
+        mac=p.get("mac"),
+        firmware_sha256=published["sha256"],
+        firmware_size=published["size"],
+        build_stats=build_stats,
+    )
+    job.result = {
+        "status": "ok",
+        "manifest_url": published["manifest_url"],
+        "device_id": saved.get("id"),
+    }
+    return True
+
+
+def _flash_ota_runner(job: _Job) -> bool:
+    p = job.params
+    name = job.name
+    job.emit(f"🚀 Starting OTA flash for {os.path.join(YAML_DIR, name + '.yaml')}...\n\n")
+    started = time.time()
+    parser = _BuildOutputParser(job, _expected_objects(name, p["platform"]))
+    returncode = _run_logged(job, ["esphome", "run", f"{name}.yaml"], parser)
+    build_stats = parser.stats()
+    if returncode != 0:
+        job.emit(f"\n❌ Flash failed with code {returncode}.\n")
+        return False
+    # Geflashtes Binary für spätere Rollbacks aufheben
+    artifact = _collect_artifact(name, build_cache_key(p["config"]), started)
+    if artifact:
+        stored = _firmware_store.add(name, artifact["path"], artifact["sha256"], artifact["size"],
+                                     p["config"])
+        job.publish("artifact", {k: stored[k] for k in ("sha256", "size", "version")})
+    upsert_device_record(
+        name=name,
+        platform=p["platform"],
+        board_label=p["board_label"],
+        board_id=p["board_id"],
+        yaml_text=p["config"],
+        ip=p.get("ip"),
+        mac=p.get("mac"),
+        firmware_sha256=artifact["sha256"] if artifact else None,
+        firmware_size=artifact["size"] if artifact else None,
+        build_stats=build_stats,
+    )
+    job.emit("\n✅ Flash successful.\n")
+    return True
+
+
+def _build_only_runner(job: _Job) -> bool:
+    """Compile into the build cache without publishing or touching the registry."""
+    p = job.params
+    name = job.name
+    with open(os.path.join(YAML_DIR, f"{name}.yaml"), "w", encoding="utf-8") as f:
+        f.write(p["config"])
+    started = time.time()
+    platform = p.get("platform") or detect_platform_from_yaml(p["config"])
+    parser = _BuildOutputParser(job, _expected_objects(name, platform))
+    returncode = _run_logged(job, ["esphome", "compile", f"{name}.yaml"], parser)
+    if returncode != 0:
+        job.emit(f"\n❌ Compilation failed with code {returncode}.\n")
+        return False
+    job.result = _collect_artifact(name, p["key"], started)
+    if not job.result:
+        job.error = "No firmware binary found after compile."
+        return False
+    job.result["build_stats"] = parser.stats()
+    return True
+
+
+def _rollback_runner(job: _Job) -> bool:
+    """OTA-upload a stored build (no compile) and point the registry at it."""
+    p = job.params
+    name = job.name
+    # esphome upload liest Adresse/OTA-Passwort aus der YAML des Builds – eigene Datei
+    # im YAML_DIR (relative includes/secrets), die aktuelle <name>.yaml bleibt unangetastet
+    upload_yaml = f".{name}.rollback-{job.id}.yaml"
+    upload_path = os.path.join(YAML_DIR, upload_yaml)
+    with open(upload_path, "w", encoding="utf-8") as f:
+        f.write(p["config"])
+    job.emit(f"⏪ Rolling back {name} to {p['version']} ({p['sha256'][:12]}) via {p['target']}...\n\n")
+    try:
+        returncode = _run_logged(job, ["esphome", "upload", upload_yaml,
+                                       "--device", p["target"], "--file", p["path"]],
+                                 _BuildOutputParser(job))
+    finally:
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
+    if returncode != 0:
+        job.emit(f"\n❌ Rollback failed with code {returncode}.\n")
+        return False
+    _firmware_store.touch(name, p["sha256"])
+    job.result = {"device": upsert_device_record(
+        name=name,
+        platform=p["platform"],
+        board_label=p["board_label"],
+        board_id=p["board_id"],
+        yaml_text=p["config"],
+        firmware_sha256=p["sha256"],
+        firmware_size=p["size"],
+        ip=p.get("ip"),
+    )}
+    job.emit("\n✅ Rollback successful.\n")
+    return True
+
+
+def _compile_params(data: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Validate a compile request; returns (device name, job params)."""
+    config = (data.get("configuration") or "").strip()
+    if not config:
+        raise ValueError("No YAML configuration received.")
+
+    # Name bevorzugt aus YAML (Option B). Fallback: Request-Name.
+    yaml_name = extract_name_from_yaml(config)
+    req_name = (data.get("name") or "device").strip()
+    name = _normalize_name(yaml_name or req_name)
+
+    platform = data.get("platform") or detect_platform_from_yaml(config)
+    board_label, board_id = unify_board(data)
+    if not board_id:
+        board_id = "esp32dev" if platform == "ESP32" else "d1_mini"
+    if not board_label:
+        board_label = board_id
+
+    return name, {
+        "config": config,
+        "platform": platform,
+        "board_label": board_label,
+        "board_id": board_id,
+        "config_json": data.get("config_json") or {},
+        "force": bool(data.get("force")),
+    }
+
+
+def _job_event_stream(job: _Job, last_id: int = 0, fmt: str = "sse") -> Response:
+    """
+    Typed job events as SSE (id/event/data) or NDJSON, starting after `last_id`.
+    Any number of viewers can attach; a "gap" event reports events that
+    already fell out of the ring buffer.
+    """
+    sse = fmt != "ndjson"
+
+    def _frame(ev: Dict[str, Any]) -> str:
+        if sse:
+            return f"id: {ev['id']}\nevent: {ev['type']}\ndata: {json.dumps(ev['data'])}\n\n"
+        return json.dumps(ev) + "\n"
+
+    def generate():
+        pos = last_id
+        if sse:
+            yield "retry: 2000\n\n"
+        while True:
+            events, dropped, done = job.events_after(pos)
+            if dropped:
+                yield _frame({"id": pos, "type": "gap", "data": {"dropped": dropped}})
+            for ev in events:
+                yield _frame(ev)
+            if events:
+                pos = events[-1]["id"]
+            elif done:
+                return
+            elif sse:
+                yield ": keepalive\n\n"
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Job-Id": job.id},
+    )
+
+
+def _wants_events() -> Optional[str]:
+    """'sse' / 'ndjson' when the client asked for typed events instead of the text log."""
+    fmt = request.args.get("stream", "")
+    if fmt in ("sse", "ndjson"):
+        return fmt
+    if "text/event-stream" in request.headers.get("Accept", ""):
+        return "sse"
+    return None
+
+
+def _stream_job_log(job: _Job, deduped: bool = False) -> Response:
+    position = _scheduler.position(job)
+    if position and not deduped:
+        job.emit(f"⏳ Queued as job {job.id} (position {position})\n")
+        job.publish("progress", {"phase": "queued", "position": position})
+    fmt = _wants_events()
+    if fmt:
+        return _job_event_stream(job, 0, fmt)
+    return Response(job.follow(), mimetype="text/plain",
+                    headers={"X-Job-Id": job.id, "X-Accel-Buffering": "no"})
+
+
+# =========================
+# Routes
+# =========================
+@app.route("/compile", methods=["POST"])
+@_streaming
+def compile_yaml():
+    """
+    Queue a compile job and stream its log (legacy text format: log lines,
+    then one JSON line with manifest_url + device). The build keeps running
+    if the client disconnects; reattach via /jobs/<id>/log.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        name, params = _compile_params(data)
+    except ValueError as e:
+        return Response(f"❌ {e}\n", status=400, mimetype="text/plain")
+    try:
+        job, deduped = _scheduler.submit("compile", name, params, _compile_runner)
+    except RuntimeError as e:
+        return Response(f"❌ {e}\n", status=429, mimetype="text/plain")
+    return _stream_job_log(job, deduped)
+
+
+@app.route("/flash", methods=["POST"])
+@_streaming
+def flash_device():
+    try:
+        data = request.get_json(silent=True) or {}
+        name = _normalize_name(data.get("name", ""))
+        method = data.get("method", "ota")
+        ip = data.get("ip")
+        mac = data.get("mac")
+
+        if not name:
+            return jsonify({"error": "No device name provided."}), 400
+
+        yaml_path = os.path.join(YAML_DIR, f"{name}.yaml")
+        if not os.path.exists(yaml_path):
+            return jsonify({"error": "YAML config not found."}), 404
+
+        config_text = Path(yaml_path).read_text(encoding="utf-8")
+        platform = detect_platform_from_yaml(config_text)
+
+        # best-guess board from registry if available
+        existing = _registry.find(name, platform)
+        board_label = existing.get("board_label") if existing else ""
+        board_id = existing.get("board_id") if existing else ""
+        if not board_id:
+            board_id = "esp32dev" if platform == "ESP32" else "d1_mini"
+        if not board_label:
+            board_label = board_id
+
+        params = {
+            "config": config_text,
+            "platform": platform,
+            "board_label": board_label,
+            "board_id": board_id,
+            "ip": ip,
+            "mac": mac,
+            "force": bool(data.get("force")),
+        }
+
+        if method == "usb":
+            try:
+                job, _ = _scheduler.submit("usb", name, params, _usb_prepare_runner)
+            except RuntimeError as e:
+                return jsonify({"error": str(e)}), 429
+            for _ in job.follow():
+                pass
+            if job.state == "succeeded":
+                return jsonify(job.result)
+            if job.error:
+                return jsonify({"error": job.error}), 500
+            return Response("".join(job.log_tail(JOB_LOG_LINES)), mimetype="text/plain")
+
+        try:
+            job, deduped = _scheduler.submit("flash", name, params, _flash_ota_runner)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 429
+        return _stream_job_log(job, deduped)
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# =========================
+# Job API
+# =========================
+_JOB_RUNNERS = {"compile": _compile_runner}
+
+
+@app.route("/jobs", methods=["POST"])
+def api_submit_job():
+    """Queue a job without streaming. Body like /compile (kind defaults to compile)."""
+    data = request.get_json(silent=True) or {}
+    kind = data.get("kind") or "compile"
+    runner = _JOB_RUNNERS.get(kind)
+    if runner is None:
+        return jsonify({"error": f"Unknown job kind: {kind}"}), 400
+    try:
+        name, params = _compile_params(data)
+        job, deduped = _scheduler.submit(kind, name, params, runner)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify({**job.to_dict(_scheduler.position(job)), "deduplicated": deduped}), 202
+
+
+@app.route("/jobs", methods=["GET"])
+def api_list_jobs():
+    jobs = _scheduler.snapshot()
+    return jsonify({
+        "workers": _scheduler.workers,
+        "queue_depth": _scheduler.depth(),
+        "build_cache": _build_cache.stats(),
+        "streams": _stream_slots.stats(),
+        "jobs": [j.to_dict(_scheduler.position(j)) for j in jobs],
+    }), 200
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def api_get_job(job_id):
+    job = _scheduler.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(job.to_dict(_scheduler.position(job))), 200
+
+
+@app.route("/jobs/<job_id>/log", methods=["GET"])
+@_streaming
+def api_get_job_log(job_id):
+    """Job log as text/plain from ?offset=<line>; ?follow=1 streams until the job ends."""
+    job = _scheduler.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    offset = max(0, request.args.get("offset", type=int) or 0)
+    if request.args.get("follow") in ("1", "true"):
+        return Response(job.follow(offset), mimetype="text/plain",
+                        headers={"X-Job-Id": job.id, "X-Accel-Buffering": "no"})
+    with job.cond:
+        lines, _ = job.log_since(offset)
+        return Response("".join(lines), mimetype="text/plain",
+                        headers={"X-Job-Id": job.id, "X-Log-Lines": str(job.log_total)})
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+@_streaming
+def api_job_events(job_id):
+    """
+    SSE (default) or ?format=ndjson. Resume with the Last-Event-ID header
+    (EventSource sends it on reconnect) or ?last_event_id=<n>.
+    """
+    job = _scheduler.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    raw = request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "0"
+    try:
+        last_id = max(0, int(raw))
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID."}), 400
+    return _job_event_stream(job, last_id, request.args.get("format", "sse"))
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def api_cancel_job(job_id):
+    job = _scheduler.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    _scheduler.cancel(job)
+    return jsonify(job.to_dict(_scheduler.position(job))), 200
+
+
+# =========================
+# Build warm-up (PlatformIO build cache per board)
+# =========================
+# PlatformIO legt kompilierte Objekte (Framework, Libraries) hier ab und teilt sie
+# über alle Projekte mit identischen Flags -> gleiches Board/Framework = Cache-Treffer
+PIO_BUILD_CACHE_DIR = os.environ.setdefault(
+    "PLATFORMIO_BUILD_CACHE_DIR", os.path.join(DATA_DIR, "cache", "pio_build_cache"))
+WARMUP_STATE_FILE = Path(DATA_DIR) / "cache" / "warmup.json"
+BUILD_WARMUP_ON_START = str(_addon_option("build_warmup", "false")).lower() in ("1", "true", "yes")
+WARMUP_START_DELAY = 30.0   # s nach dem Start, damit der Server erst mal antwortet
+_PLATFORM_BLOCKS = ("esp32", "esp8266", "rp2040", "bk72xx", "rtl87xx", "ln882x", "libretiny")
+
+
+def _platform_block(config_text: str) -> Optional[str]:
+    """Top-level platform section (board + framework) of a device YAML."""
+    out: List[str] = []
+    for line in (config_text or "").splitlines():
+        if out:
+            if line.strip() and not line[0].isspace():
+                break
+            if line.strip() and not line.lstrip().startswith("#"):
+                out.append(line.rstrip())
+        elif re.match(r'^(%s):\s*(?:#.*)?$' % "|".join(_PLATFORM_BLOCKS), line):
+            out.append(line.split("#", 1)[0].rstrip())
+    return "\n".join(out) if out else None
+
+
+def _default_platform_block(platform: str, board_id: str) -> str:
+    if (platform or "").upper() == "ESP8266":
+        return f"esp8266:\n  board: {board_id or 'd1_mini'}"
+    return f"esp32:\n  board: {board_id or 'esp32dev'}"
+
+
+def _warmup_yaml(name: str, block: str) -> str:
+    # Komponenten, die praktisch jedes Gerät nutzt (WiFi/API-Stack, Logger)
+    return (
+        f"esphome:\n  name: {name}\n\n{block}\n\n"
+        "logger:\n\napi:\n\n"
+        "wifi:\n  ssid: \"warmup\"\n  password: \"warmup-build-only\"\n"
+    )
+
+
+class _BuildWarmup:
+    """
+    One minimal build per distinct platform block (board + framework) found in
+    the registry, so a device's first real compile finds the framework and
+    common libraries in the PlatformIO build cache. Re-run per board when the
+    ESPHome version changes.
+    """
+
+    def __init__(self, state_file: Path):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.state: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self.state is None:
+            try:
+                self.state = json.loads(self.state_file.read_text(encoding="utf-8"))
+            except Exception:
+                self.state = {}
+            self.state.setdefault("targets", {})
+        return self.state
+
+    def record(self, key: str, info: Dict[str, Any]) -> None:
+        with self.lock:
+            self._load()["targets"][key] = info
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            _atomic_write(self.state_file, self.state)
+
+    def targets(self) -> Dict[str, Dict[str, Any]]:
+        """key -> {block, board, devices[]} for every board/framework in the registry."""
+        out: Dict[str, Dict[str, Any]] = {}
+        for d in _registry.all():
+            block = _platform_block(_registry.yaml(d) or "") or _default_platform_block(
+                d.get("platform") or "", d.get("board_id") or d.get("board") or "")
+            key = hashlib.sha256(block.encode("utf-8")).hexdigest()[:12]
+            board = re.search(r'board:\s*["\']?([\w.-]+)', block)
+            t = out.setdefault(key, {"key": key, "block": block,
+                                     "board": board.group(1) if board else None, "devices": []})
+            t["devices"].append(d.get("name"))
+        return out
+
+    def status(self) -> List[Dict[str, Any]]:
+        version = _esphome_version()
+        with self.lock:
+            done = dict(self._load()["targets"])
+        items = []
+        for key, t in self.targets().items():
+            last = done.get(key)
+            items.append({**t, "last": last,
+                          "stale": not last or not last.get("ok") or last.get("esphome_version") != version})
+        return items
+
+    def submit(self, force: bool = False) -> List[_Job]:
+        jobs = []
+        for t in self.status():
+            if not (force or t["stale"]):
+                continue
+            name = f"warmup-{t['key']}"
+            job, _ = _scheduler.submit("warmup", name, {"key": t["key"], "block": t["block"],
+                                                         "board": t["board"]}, _warmup_runner)
+            jobs.append(job)
+        return jobs
+
+    def start_async(self, delay: float) -> None:
+        def _run():
+            try:
+                self.submit()
+            except Exception:
+                traceback.print_exc()
+        t = threading.Timer(delay, _run)
+        t.daemon = True
+        t.start()
+
+
+def _warmup_runner(job: _Job) -> bool:
+    """Compile the minimal config; only the PlatformIO build cache is kept."""
+    p = job.params
+    name = job.name
+    with open(os.path.join(YAML_DIR, f"{name}.yaml"), "w", encoding="utf-8") as f:
+        f.write(_warmup_yaml(name, p["block"]))
+    job.emit(f"🔥 Warm-up build for {p['board'] or p['key']}...\n\n")
+    parser = _BuildOutputParser(job)
+    returncode = _run_logged(job, ["esphome", "compile", f"{name}.yaml"], parser)
+    stats = parser.stats()
+    _build_warmup.record(p["key"], {
+        "ok": returncode == 0,
+        "board": p["board"],
+        "esphome_version": stats["esphome_version"],
+        "at": stats["at"],
+        "seconds": stats["total_seconds"],
+        "objects": stats["objects"],
+        "cached_objects": stats["cached_objects"],
+        "framework_compiled": stats["framework_compiled"],
+    })
+    # Build-Verzeichnis wegwerfen – die Objekte liegen im PlatformIO-Cache
+    shutil.rmtree(os.path.join(YAML_DIR, ".esphome", "build", name), ignore_errors=True)
+    try:
+        os.remove(os.path.join(YAML_DIR, f"{name}.yaml"))
+    except OSError:
+        pass
+    job.result = {"key": p["key"], "board": p["board"], **{k: stats[k] for k in (
+        "total_seconds", "objects", "cached_objects", "framework_compiled")}}
+    if returncode != 0:
+        job.emit(f"\n❌ Warm-up failed with code {returncode}.\n")
+        return False
+    job.emit("\n✅ Warm-up done.\n")
+    return True
+
+
+def _dir_usage(path: str) -> Tuple[int, int]:
+    """(bytes, files) below path."""
+    total, files = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, fn)).st_size
+                files += 1
+            except OSError:
+                pass
+    return total, files
+
+
+class _DirUsage:
+    """
+    _dir_usage() of one directory, cached: re-measured in the background once
+    older than `ttl` or invalidated (after a build); only the very first call walks inline.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value: Optional[Tuple[int, int]] = None
+        self.measured_at = 0.0
+        self.dirty = False
+        self.running = False
+
+    def invalidate(self) -> None:
+        self.dirty = True
+
+    def get(self) -> Tuple[int, int, float]:
+        with self.lock:
+            first = self.value is None and not self.running
+            stale = self.dirty or time.time() - self.measured_at > self.ttl
+            if stale and not self.running:
+                self.running = True
+                self.dirty = False
+                if not first:
+                    threading.Thread(target=self._measure, daemon=True).start()
+        if first:
+            self._measure()
+        with self.lock:
+            size, files = self.value or (0, 0)
+            return size, files, self.measured_at
+
+    def _measure(self) -> None:
+        value = None
+        try:
+            value = _dir_usage(self.path)
+        finally:
+            with self.lock:
+                if value is not None:
+                    self.value = value
+                    self.measured_at = time.time()
+                self.running = False
+
+
+PIO_CACHE_USAGE_TTL = 300.0   # s; danach (oder nach einem Build) wird im Hintergrund neu gezählt
+_pio_cache_usage = _DirUsage(PIO_BUILD_CACHE_DIR, PIO_CACHE_USAGE_TTL)
+
+_build_warmup = _BuildWarmup(WARMUP_STATE_FILE)
+
+
+@app.route("/api/warmup", methods=["GET"])
+def api_warmup_status():
+    size, files, measured_at = _pio_cache_usage.get()
+    return jsonify({
+        "build_cache_dir": PIO_BUILD_CACHE_DIR,
+        "cache_bytes": size,
+        "cache_files": files,
+        "cache_measured_at": round(measured_at, 3),
+        "objects": _pio_cache_tally.stats(),
+        "targets": _build_warmup.status(),
+    }), 200
+
+
+@app.route("/api/warmup", methods=["POST"])
+def api_warmup_start():
+    """Queue warm-up builds for stale boards (all with {"force": true})."""
+    data = request.get_json(silent=True) or {}
+    try:
+        jobs = _build_warmup.submit(force=bool(data.get("force")))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify({"jobs": [j.to_dict(_scheduler.position(j)) for j in jobs]}), 202
+
+
+# =========================
+# Validation (warm worker pool, cached by YAML hash)
+# =========================
+VALIDATION_WORKERS = max(1, int(_addon_option("validation_workers", 1)))
+VALIDATION_TIMEOUT = 30.0            # s pro Prüfung
+VALIDATION_WORKER_MAX_USES = 200     # danach neu starten (globaler CORE-State)
+VALIDATION_CACHE_SIZE = 256
+VALIDATION_CLI_TIMEOUT = 120.0
+VALIDATION_RETRY_MIN = 30.0          # s bis zum nächsten Worker-Start nach einem Fehlstart ...
+VALIDATION_RETRY_MAX = 1800.0        # ... verdoppelt bis hierhin
+
+
+class _ValidationWorker:
+    """One `server.py --validation-worker` subprocess."""
+
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--validation-worker"],
+            cwd=YAML_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        )
+        self.uses = 0
+        self.ready = False
+        self.error: Optional[str] = None
+        hello = self._read(VALIDATION_TIMEOUT * 2)   # ESPHome-Import dauert auf dem Pi
+        if hello and hello.get("ready"):
+            self.ready = True
+        else:
+            self.error = (hello or {}).get("error") or "worker did not start"
+            self.close()
+
+    def _read(self, timeout: float) -> Optional[Dict[str, Any]]:
+        killer = threading.Timer(timeout, self.proc.kill)
+        killer.start()
+        try:
+            line = self.proc.stdout.readline()
+        finally:
+            killer.cancel()
+        try:
+            return json.loads(line) if line else None
+        except ValueError:
+            return None
+
+    def validate(self, path: str) -> Optional[Dict[str, Any]]:
+        """Result dict, or None if the worker died/timed out (caller retries via CLI)."""
+        self.uses += 1
+        req_id = uuid.uuid4().hex
+        try:
+            self.proc.stdin.write(json.dumps({"id": req_id, "path": path}) + "\n")
+            self.proc.stdin.flush()
+        except OSError:
+            return None
+        resp = self._read(VALIDATION_TIMEOUT)
+        if not resp or resp.get("id") != req_id:
+            self.close()
+            return None
+        return resp
+
+    @property
+    def alive(self) -> bool:
+        return self.ready and self.proc.poll() is None and self.uses < VALIDATION_WORKER_MAX_USES
+
+    def close(self) -> None:
+        self.ready = False
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+class _ValidationService:
+    """
+    Validates configs without compiling. Requests go to idle warm workers
+    (ESPHome already imported); if those can't start (or crash on a config)
+    `esphome config` is used instead, and starting a worker is retried with
+    exponential backoff. Results are cached by the hash of YAML + the local
+    files it pulls in (secrets.yaml, !include, packages) + ESPHome version.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.idle: "queue.Queue[Optional[_ValidationWorker]]" = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)           # Platzhalter: Worker wird bei Bedarf gestartet
+        self.lock = threading.Lock()
+        self.cache: Dict[str, Dict[str, Any]] = {}
+        self.unavailable: Optional[str] = None   # letzter Startfehler, bis ein Worker wieder läuft
+        self.failures = 0
+        self.retry_at = 0.0
+        self.stats = {"requests": 0, "cache_hits": 0, "worker": 0, "cli": 0}
+
+    def _key(self, config_text: str) -> str:
+        h = hashlib.sha256(config_text.encode("utf-8"))
+        deps = set(_yaml_dependencies(config_text))
+        secrets = os.path.join(YAML_DIR, "secrets.yaml")
+        if os.path.exists(secrets):
+            deps.add(os.path.realpath(secrets))
+        for dep in sorted(deps):
+            h.update(f"\n--- {os.path.relpath(dep, YAML_DIR)}\n".encode())
+            try:
+                with open(dep, "rb") as f:
+                    h.update(f.read())
+            except OSError:
+                pass
+        h.update(_esphome_version().encode("utf-8"))
+        return h.hexdigest()
+
+    def _may_start(self) -> bool:
+        with self.lock:
+            return not self.unavailable or time.monotonic() >= self.retry_at
+
+    def _start_worker(self) -> Optional[_ValidationWorker]:
+        """Start a worker; on failure back off before the next attempt."""
+        worker = _ValidationWorker()
+        with self.lock:
+            if worker.ready:
+                self.unavailable, self.failures = None, 0
+                return worker
+            self.failures += 1
+            self.unavailable = worker.error
+            self.retry_at = time.monotonic() + min(VALIDATION_RETRY_MAX,
+                                                   VALIDATION_RETRY_MIN * 2 ** (self.failures - 1))
+        return None
+
+    def _worker_validate(self, path: str) -> Optional[Dict[str, Any]]:
+        worker = self.idle.get()
+        try:
+            if worker is None or not worker.alive:
+                if worker is not None:
+                    worker.close()
+                if not self._may_start():
+                    worker = None
+                    return None
+                worker = self._start_worker()
+                if worker is None:
+                    return None
+            resp = worker.validate(path)
+            if resp is None or "failed" in resp:
+                return None
+            return resp
+        finally:
+            self.idle.put(worker if worker is not None and worker.alive else None)
+
+    def _cli_validate(self, path: str) -> Dict[str, Any]:
+        try:
+            proc = subprocess.run(["esphome", "config", os.path.basename(path)], cwd=YAML_DIR,
+                                  capture_output=True, text=True, timeout=VALIDATION_CLI_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            return {"valid": False, "errors": [{"path": "", "message": "esphome config timed out"}]}
+        except OSError as e:
+            return {"valid": False, "errors": [{"path": "", "message": str(e)}]}
+        if proc.returncode == 0:
+            return {"valid": True, "errors": []}
+        out = (proc.stdout + proc.stderr).splitlines()
+        msgs = [l.strip() for l in out if re.search(r'ERROR|\[.+\] is an invalid|Failed config', l)]
+        return {"valid": False, "errors": [{"path": "", "message": m} for m in (msgs or out[-10:])]}
+
+    def validate(self, config_text: str) -> Dict[str, Any]:
+        key = self._key(config_text)
+        with self.lock:
+            self.stats["requests"] += 1
+            hit = self.cache.pop(key, None)
+            if hit is not None:
+                self.cache[key] = hit     # LRU: ans Ende
+                self.stats["cache_hits"] += 1
+                return {**hit, "cached": True}
+
+        t0 = time.monotonic()
+        path = os.path.join(YAML_DIR, f".validate-{key[:16]}-{uuid.uuid4().hex[:6]}.yaml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(config_text)
+        try:
+            resp = self._worker_validate(path)
+            mode = "worker"
+            if resp is None:
+                resp, mode = self._cli_validate(path), "cli"
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        result = {"valid": bool(resp.get("valid")), "errors": resp.get("errors") or [], "mode": mode,
+                  "duration_ms": round((time.monotonic() - t0) * 1000, 1)}
+        with self.lock:
+            self.stats[mode] += 1
+            self.cache[key] = result
+            while len(self.cache) > VALIDATION_CACHE_SIZE:
+                self.cache.pop(next(iter(self.cache)))
+        return {**result, "cached": False}
+
+    def prewarm(self) -> None:
+        """Start one worker in the background so the first check is already warm."""
+        def _run():
+            worker = self.idle.get()
+            try:
+                if worker is None and self._may_start():
+                    worker = self._start_worker()
+            except Exception:
+                traceback.print_exc()
+                worker = None
+            finally:
+                self.idle.put(worker)
+        threading.Thread(target=_run, name="validation-warm", daemon=True).start()
+
+
+_validation = _ValidationService(VALIDATION_WORKERS)
+
+
+@app.route("/validate", methods=["POST"])
+def api_validate():
+    """Body: {"configuration": "<yaml>"} -> {valid, errors[{path, message}], cached, mode, duration_ms}."""
+    data = request.get_json(silent=True) or {}
+    config = (data.get("configuration") or "").strip()
+    if not config:
+        return jsonify({"error": "No YAML configuration received."}), 400
+    result = _validation.validate(config)
+    return jsonify(result), 200
+
+
+@app.route("/validate/stats", methods=["GET"])
+def api_validate_stats():
+    with _validation.lock:
+        stats = dict(_validation.stats)
+        stats["cache_entries"] = len(_validation.cache)
+    stats["workers"] = _validation.size
+    stats["worker_unavailable"] = _validation.unavailable
+    if _validation.unavailable:
+        stats["worker_retry_in"] = round(max(0.0, _validation.retry_at - time.monotonic()), 1)
+    return jsonify(stats), 200
+
+
+# =========================
+# Fleet batch OTA
+# =========================
+BATCH_DEFAULT_CONCURRENCY = 4
+BATCH_MAX_CONCURRENCY = 16
+BATCH_DEFAULT_RETRIES = 2
+BATCH_DEFAULT_TIMEOUT = 300.0   # s pro Upload-Versuch
+
+
+class _BatchFlash:
+    """
+    Compile once per distinct build key, then OTA-upload the cached binary
+    to every device of that group in parallel. Progress is kept as a list
+    of events so any number of clients can follow (and re-follow) it.
+    """
+
+    def __init__(self, devices: List[Dict[str, Any]], concurrency: int, retries: int,
+                 timeout: float, force: bool):
+        self.id = uuid.uuid4().hex
+        self.devices = devices
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.force = force
+        self.events: List[Dict[str, Any]] = []
+        self.results: Dict[str, str] = {}      # device id -> succeeded | failed | cancelled
+        self.state = "running"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.cancel = threading.Event()
+        self.cond = threading.Condition()
+        self._procs: Dict[str, subprocess.Popen] = {}
+        self.thread = threading.Thread(target=self._run, name=f"batch-{self.id[:8]}", daemon=True)
+
+    @property
+    def finished(self) -> bool:
+        return self.state != "running"
+
+    def _event(self, kind: str, **payload: Any) -> None:
+        with self.cond:
+            self.events.append({"type": kind, "ts": time.time(), **payload})
+            self.cond.notify_all()
+
+    def summary(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for st in self.results.values():
+            counts[st] = counts.get(st, 0) + 1
+        return {
+            "id": self.id,
+            "state": self.state,
+            "devices": len(self.devices),
+            "done": len(self.results),
+            "counts": counts,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    def _run(self) -> None:
+        try:
+            self._execute()
+        except Exception as e:
+            traceback.print_exc()
+            self._event("error", error=str(e))
+        with self.cond:
+            self.state = "cancelled" if self.cancel.is_set() else "done"
+            self.finished_at = time.time()
+        self._event("done", **self.summary())
+
+    def _execute(self) -> None:
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for dev in self.devices:
+            groups.setdefault(build_cache_key(dev["config"]), []).append(dev)
+        self._event("batch", id=self.id, devices=len(self.devices), groups=len(groups))
+
+        # 1) Pro Gruppe genau ein Build (oder Cache-Treffer)
+        artifacts: Dict[str, Dict[str, Any]] = {}
+        builds: Dict[str, _Job] = {}
+        for key, members in groups.items():
+            names = [m["name"] for m in members]
+            cached = None if self.force else _build_cache.lookup(key)
+            if cached:
+                artifacts[key] = cached
+                self._event("group", key=key, devices=names, state="cached", sha256=cached["sha256"])
+                continue
+            leader = members[0]
+            try:
+                job, _ = _scheduler.submit("build", leader["name"],
+                                           {"config": leader["config"], "key": key,
+                                            "platform": leader["platform"]},
+                                           _build_only_runner)
+            except RuntimeError as e:
+                self._event("group", key=key, devices=names, state="failed", error=str(e))
+                for m in members:
+                    self._finish_device(m, "failed", error=str(e))
+                continue
+            builds[key] = job
+            self._event("group", key=key, devices=names, state="compiling", job_id=job.id)
+
+        # 2) Uploads starten, sobald die Firmware einer Gruppe bereitsteht
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ota") as pool:
+            for key, art in artifacts.items():
+                for m in groups[key]:
+                    pool.submit(self._upload_device, m, art)
+            while builds and not self.cancel.is_set():
+                for key, job in list(builds.items()):
+                    if not job.finished:
+                        continue
+                    del builds[key]
+                    names = [m["name"] for m in groups[key]]
+                    if job.state != "succeeded" or not job.result:
+                        err = job.error or "".join(job.log_tail(5)).strip() or "compile failed"
+                        self._event("group", key=key, devices=names, state="failed", error=err)
+                        for m in groups[key]:
+                            self._finish_device(m, "failed", error="compile failed")
+                        continue
+                    self._event("group", key=key, devices=names, state="built",
+                                sha256=job.result["sha256"])
+                    for m in groups[key]:
+                        pool.submit(self._upload_device, m, job.result)
+                time.sleep(0.2)
+            if self.cancel.is_set():
+                for key, job in builds.items():
+                    _scheduler.cancel(job)
+                    for m in groups[key]:
+                        self._finish_device(m, "cancelled")
+
+    def _finish_device(self, dev: Dict[str, Any], state: str, **extra: Any) -> None:
+        with self.cond:
+            self.results[dev["id"]] = state
+        self._event("device", id=dev["id"], name=dev["name"], state=state, **extra)
+
+    def _upload_device(self, dev: Dict[str, Any], artifact: Dict[str, Any]) -> None:
+        try:
+            self._upload_with_retries(dev, artifact)
+        except Exception as e:
+            traceback.print_exc()
+            self._finish_device(dev, "failed", error=str(e))
+
+    def _upload_with_retries(self, dev: Dict[str, Any], artifact: Dict[str, Any]) -> None:
+        target = dev.get("ip") or "OTA"
+        for attempt in range(1, self.retries + 2):
+            if self.cancel.is_set():
+                self._finish_device(dev, "cancelled")
+                return
+            self._event("device", id=dev["id"], name=dev["name"], state="uploading",
+                        attempt=attempt, target=target)
+            t0 = time.monotonic()
+            rc, tail = self._run_upload(dev, target, artifact["path"])
+            M_OTA_UPLOAD.observe(time.monotonic() - t0, outcome="ok" if rc == 0 else "error")
+            if rc == 0:
+                _firmware_store.add(dev["name"], artifact["path"], artifact["sha256"],
+                                    artifact["size"], dev["config"])
+                upsert_device_record(
+                    name=dev["name"],
+                    platform=dev["platform"],
+                    board_label=dev["board_label"],
+                    board_id=dev["board_id"],
+                    yaml_text=dev["config"],
+                    firmware_sha256=artifact["sha256"],
+                    firmware_size=artifact.get("size"),
+                    ip=dev.get("ip"),
+                    build_stats=artifact.get("build_stats"),
+                )
+                self._finish_device(dev, "succeeded", attempt=attempt,
+                                    duration=round(time.monotonic() - t0, 3))
+                return
+            if attempt <= self.retries and not self.cancel.is_set():
+                self._event("device", id=dev["id"], name=dev["name"], state="retry",
+                            attempt=attempt, returncode=rc, log_tail=tail)
+                self.cancel.wait(min(30.0, 2.0 * attempt))
+        self._finish_device(dev, "failed", returncode=rc, log_tail=tail)
+
+    def _run_upload(self, dev: Dict[str, Any], target: str, bin_path: str) -> Tuple[int, List[str]]:
+        """esphome upload with a hard timeout; returns (returncode, last log lines)."""
+        yaml_path = os.path.join(YAML_DIR, f"{dev['name']}.yaml")
+        if not os.path.exists(yaml_path):
+            # esphome braucht die YAML (OTA-Passwort, Adresse) auch für den Upload
+            with open(yaml_path, "w", encoding="utf-8") as f:
+                f.write(dev["config"])
+        proc = subprocess.Popen(
+            ["esphome", "upload", f"{dev['name']}.yaml", "--device", target, "--file", bin_path],
+            cwd=YAML_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        self._procs[dev["id"]] = proc
+        M_SUBPROCS.inc(command="upload")
+        killer = threading.Timer(self.timeout, proc.kill)
+        killer.start()
+        tail: List[str] = []
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                tail = (tail + [line.rstrip()])[-10:]
+            proc.stdout.close()
+            return proc.wait(), tail
+        finally:
+            killer.cancel()
+            self._procs.pop(dev["id"], None)
+            M_SUBPROCS.dec(command="upload")
+
+    def stop(self) -> None:
+        self.cancel.set()
+        for proc in list(self._procs.values()):
+            if proc.poll() is None:
+                proc.terminate()
+
+
+_batches: Dict[str, _BatchFlash] = {}
+_batches_lock = threading.Lock()
+
+
+def _batch_device(rec: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Registry record -> what a batch needs; YAML from YAML_DIR, else the registry copy."""
+    name = rec.get("name") or ""
+    yaml_path = os.path.join(YAML_DIR, f"{name}.yaml")
+    if os.path.exists(yaml_path):
+        config = Path(yaml_path).read_text(encoding="utf-8")
+    else:
+        config = _registry.yaml(rec)
+    if not name or not config:
+        return None
+    board_id = rec.get("board_id") or ("esp32dev" if rec.get("platform") == "ESP32" else "d1_mini")
+    return {
+        "id": rec["id"],
+        "name": name,
+        "platform": rec.get("platform") or detect_platform_from_yaml(config),
+        "board_id": board_id,
+        "board_label": rec.get("board_label") or board_id,
+        "ip": rec.get("ip"),
+        "config": config,
+    }
+
+
+def _batch_stream(batch: _BatchFlash, offset: int = 0) -> Response:
+    def generate():
+        pos = offset
+        while True:
+            with batch.cond:
+                batch.cond.wait_for(lambda: len(batch.events) > pos or batch.finished, timeout=15.0)
+                new = batch.events[pos:]
+                done = batch.finished
+            pos += len(new)
+            for ev in new:
+                yield json.dumps(ev) + "\n"
+            if done and not new:
+                return
+
+    return Response(generate(), mimetype="application/x-ndjson",
+                    headers={"X-Batch-Id": batch.id, "X-Accel-Buffering": "no"})
+
+
+@app.route("/flash/batch", methods=["POST"])
+@_streaming
+def api_flash_batch():
+    """
+    Body: {"device_ids": [...], "concurrency": 4, "retries": 2, "timeout": 300, "force": false}
+    Streams NDJSON events (batch, group, device, done). The batch keeps
+    running if the client disconnects; follow it again via /flash/batch/<id>/events.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object expected."}), 400
+    ids = data.get("device_ids") or []
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"error": "No device_ids provided."}), 400
+
+    devices, missing = [], []
+    for dev_id in dict.fromkeys(ids):
+        rec = _registry.get(dev_id)
+        dev = _batch_device(rec) if rec else None
+        if dev is None:
+            missing.append(dev_id)
+        else:
+            devices.append(dev)
+    if missing:
+        return jsonify({"error": "Unknown devices or no YAML.", "device_ids": missing}), 404
+
+    batch = _BatchFlash(
+        devices,
+        concurrency=int(_bounded_float(data.get("concurrency"), BATCH_DEFAULT_CONCURRENCY,
+                                       1, BATCH_MAX_CONCURRENCY)),
+        retries=int(_bounded_float(data.get("retries"), BATCH_DEFAULT_RETRIES, 0, 10)),
+        timeout=_bounded_float(data.get("timeout"), BATCH_DEFAULT_TIMEOUT, 10, 3600),
+        force=bool(data.get("force")),
+    )
+    with _batches_lock:
+        cutoff = time.time() - JOB_RETENTION
+        for bid, b in list(_batches.items()):
+            if b.finished and (b.finished_at or 0) < cutoff:
+                del _batches[bid]
+        _batches[batch.id] = batch
+    batch.thread.start()
+    return _batch_stream(batch)
+
+
+@app.route("/flash/batch/<batch_id>", methods=["GET"])
+def api_get_flash_batch(batch_id):
+    batch = _batches.get(batch_id)
+    if not batch:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({**batch.summary(), "results": batch.results}), 200
+
+
+@app.route("/flash/batch/<batch_id>/events", methods=["GET"])
+@_streaming
+def api_follow_flash_batch(batch_id):
+    batch = _batches.get(batch_id)
+    if not batch:
+        return jsonify({"error": "Not found"}), 404
+    return _batch_stream(batch, max(0, request.args.get("offset", type=int) or 0))
+
+
+@app.route("/flash/batch/<batch_id>", methods=["DELETE"])
+def api_cancel_flash_batch(batch_id):
+    batch = _batches.get(batch_id)
+    if not batch:
+        return jsonify({"error": "Not found"}), 404
+    batch.stop()
+    return jsonify(batch.summary()), 200
+
+
+# =========================
+# Device registry API
+# =========================
+DEVICE_PAGE_MAX = 500
+
+
+def _device_cursor(d: Dict[str, Any]) -> str:
+    raw = f"{d.get('name') or ''}\x00{d.get('id')}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _parse_device_cursor(cursor: str) -> Tuple[str, str]:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    name, _, dev_id = raw.partition("\x00")
+    return name, dev_id
+
+
+def _device_filter(args) -> Any:
+    platform = (args.get("platform") or "").upper()
+    board = (args.get("board") or "").lower()
+    tag = args.get("tag") or ""
+
+    def _match(d: Dict[str, Any]) -> bool:
+        if platform and (d.get("platform") or "").upper() != platform:
+            return False
+        if board and board not in {str(d.get(k) or "").lower() for k in ("board_id", "board_label", "board")}:
+            return False
+        if tag and tag not in (d.get("tags") or []):
+            return False
+        return True
+    return _match
+
+
+@app.route("/api/devices", methods=["GET"])
+def api_list_devices():
+    """
+    ?platform=&board=&tag=          filter
+    ?fields=id,name,ip              projection (yaml/config_json/history load the full record)
+    ?limit=50&cursor=<next_cursor>  pagination, ordered by name
+    ?since=<revision>               only devices changed since, plus deleted ids (removed
+                                    from the registry, or changed so they no longer match the filter)
+    ?include=full                   all fields (legacy)
+    ETag = registry revision + query; If-None-Match -> 304.
+    """
+    args = request.args
+    query = "&".join(f"{k}={v}" for k, v in sorted(args.items(multi=True)))
+
+    def _etag(rev: int) -> str:
+        return hashlib.sha256(f"{rev}?{query}".encode("utf-8")).hexdigest()[:16]
+
+    if request.if_none_match.contains(_etag(_registry.revision)):
+        resp = Response(status=304)
+        resp.set_etag(_etag(_registry.revision))
+        return resp
+
+    try:
+        since = args.get("since", type=int)
+        limit = args.get("limit", type=int)
+        cursor = _parse_device_cursor(args["cursor"]) if args.get("cursor") else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({"error": "Invalid since/limit/cursor."}), 400
+
+    deleted: List[str] = []
+    reset = False
+    # Daten und Revision aus demselben Lock-Abschnitt, sonst passt die Revision nicht zum Inhalt
+    if since is not None:
+        records, deleted, reset, revision = _registry.changes(since)
+    else:
+        records, revision = _registry.snapshot()
+    match = _device_filter(args)
+    if since is not None and not reset:
+        # aus dem Filter herausgefallen -> für den Client wie gelöscht
+        deleted += [d["id"] for d in records if not match(d)]
+    records = [d for d in records if match(d)]
+
+    next_cursor = None
+    if limit is not None or cursor is not None:
+        limit = min(DEVICE_PAGE_MAX, max(1, limit or DEVICE_PAGE_MAX))
+        records.sort(key=lambda d: (d.get("name") or "", d.get("id") or ""))
+        if cursor is not None:
+            records = [d for d in records if (d.get("name") or "", d.get("id") or "") > cursor]
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = _device_cursor(records[-1])
+
+    fields = [f for f in (args.get("fields") or "").split(",") if f]
+    if args.get("include") == "full":
+        items = [_registry.full(d) for d in records]
+    elif any(f in _BULKY_FIELDS for f in fields):
+        items = [_registry.full(d) for d in records]
+    else:
+        items = [{**{k: v for k, v in d.items() if k not in _BLOB_REF_FIELDS}, **_device_summary(d)}
+                 if fields else _device_summary(d) for d in records]
+    if fields:
+        items = [{k: it.get(k) for k in fields} for it in items]
+
+    body: Dict[str, Any] = {"devices": items, "revision": revision}
+    if next_cursor is not None or cursor is not None:
+        body["next_cursor"] = next_cursor
+    if since is not None:
+        body.update({"deleted": deleted, "since": since, "reset": reset})
+    resp = jsonify(body)
+    resp.set_etag(_etag(revision))
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.route("/api/build-stats", methods=["GET"])
+def api_build_stats():
+    """
+    Fleet view of the last build per device: per-phase mean/max seconds,
+    grouped by ESPHome version (regressions after upgrades stand out).
+    """
+    groups: Dict[str, Dict[str, Any]] = {}
+    for d in _registry.all():
+        st = d.get("build_stats")
+        if not st:
+            continue
+        g = groups.setdefault(st.get("esphome_version") or "unknown",
+                              {"devices": 0, "phases": {}, "total": []})
+        g["devices"] += 1
+        g["total"].append(st.get("total_seconds") or 0.0)
+        for phase, secs in (st.get("phases") or {}).items():
+            g["phases"].setdefault(phase, []).append(secs)
+
+    def _agg(values: List[float]) -> Dict[str, float]:
+        return {"mean": round(sum(values) / len(values), 3), "max": round(max(values), 3), "n": len(values)}
+
+    return jsonify({"esphome_versions": {
+        ver: {"devices": g["devices"], "total_seconds": _agg(g["total"]),
+              "phases": {ph: _agg(v) for ph, v in g["phases"].items()}}
+        for ver, g in groups.items()
+    }}), 200
+
+
+@app.route("/api/devices/<dev_id>", methods=["GET"])
+def api_get_device(dev_id):
+    d = _registry.full(_registry.get(dev_id))
+    if not d:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(d), 200
+
+
+@app.route("/api/devices/<dev_id>/yaml", methods=["GET"])
+def api_get_device_yaml(dev_id):
+    d = _registry.get(dev_id)
+    if not d:
+        return jsonify({"error": "Not found"}), 404
+    yaml_text = _registry.yaml(d)
+    if not yaml_text:
+        return jsonify({"error": "YAML not found"}), 404
+    filename = f"{(d.get('name') or 'device')}.yaml"
+    return Response(
+        yaml_text,
+        mimetype="application/x-yaml",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.route("/api/devices", methods=["POST"])
+def api_upsert_device():
+    p = request.get_json(silent=True) or {}
+
+    board_id = p.get("board_id") or p.get("board") or ""
+    board_label = p.get("board_label") or ""
+    raw_name = p.get("name", "")
+    norm_name = _normalize_name(raw_name)
+    friendly = p.get("friendly_name") or raw_name or norm_name
+
+    dev = {
+        "id": p.get("id") or None,
+        "name": norm_name,
+        "friendly_name": friendly,
+        "platform": p.get("platform", ""),
+        "board_id": board_id,
+        "board_label": board_label,
+        "board": board_id,  # legacy
+        "yaml": p.get("yaml") or p.get("yaml_snapshot") or "",
+        "yaml_snapshot": p.get("yaml_snapshot") or p.get("yaml") or "",
+        "config_json": p.get("config_json") or {},
+        "firmware_sha256": p.get("firmware_sha256"),
+        "ip": p.get("ip"),
+        "mac": p.get("mac"),
+        "tags": p.get("tags") or [],
+        "notes": p.get("notes") or "",
+        "flashed_at": p.get("flashed_at") or _iso_now(),
+        "history": p.get("history") or [],
+    }
+
+    with _registry.lock:
+        # upsert by id first, else by (name + platform)
+        existing = _registry.get(dev["id"])
+        if existing is None and dev["name"] and dev["platform"]:
+            existing = _registry.find(dev["name"], dev["platform"])
+            if existing is not None:
+                dev["id"] = existing.get("id")
+
+        # update or insert
+        if existing is not None:
+            prev = None
+            if existing.get("flashed_at") or existing.get("firmware_sha256"):
+                prev = {
+                    "flashed_at": existing.get("flashed_at"),
+                    "firmware_sha256": existing.get("firmware_sha256"),
+                }
+            dev.pop("history", None)  # Verlauf wird nur fortgeschrieben
+            saved = _registry.put({**existing, **dev},
+                                  append_history=prev if prev and prev.get("flashed_at") else None)
+        else:
+            dev["id"] = dev["id"] or str(uuid.uuid4())
+            saved = _registry.put(dev)
+
+    return saved
+
+
+@app.route("/api/devices/<dev_id>", methods=["DELETE"])
+def api_delete_device(dev_id):
+    if not _registry.delete(dev_id):
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({"ok": True}), 200
+
+
+@app.route("/api/devices/<dev_id>/builds", methods=["GET"])
+def api_device_builds(dev_id):
+    d = _registry.get(dev_id)
+    if not d:
+        return jsonify({"error": "Not found"}), 404
+    builds = _firmware_store.builds(d.get("name") or "")
+    current = d.get("firmware_sha256")
+    for b in builds:
+        b["current"] = b["sha256"] == current
+    return jsonify({"device_id": dev_id, "builds": builds}), 200
+
+
+def _rollback_image_name(name: str, sha: str) -> str:
+    # eigener Name je Build: <name>.bin/.manifest.json bleiben der aktuelle Stand
+    return f"{name}.rollback-{sha[:12]}"
+
+
+def _drop_rollback_images(name: str, keep: Optional[str] = None) -> None:
+    """Remove published USB rollback images of `name` except the one named `keep`."""
+    prefix = f"{name}.rollback-"
+    try:
+        files = os.listdir(OUTPUT_DIR)
+    except OSError:
+        return
+    for f in files:
+        if f.startswith(prefix) and (keep is None or not f.startswith(f"{keep}.")):
+            try:
+                os.unlink(os.path.join(OUTPUT_DIR, f))
+            except OSError:
+                pass
+
+
+@app.route("/api/devices/<dev_id>/rollback", methods=["POST"])
+def api_device_rollback(dev_id):
+    """
+    Flash a previously stored build again. Body: {"sha256"?, "method": "ota"|"usb"}.
+    Without sha256 the build before the current one is used.
+    USB only publishes the build under its own manifest URL (the live
+    <name>.bin stays current); once Web Serial flashed it, the client
+    confirms with {"method": "usb", "sha256": ..., "flashed": true} and only
+    then the registry points at the build.
+    """
+    data = request.get_json(silent=True) or {}
+    d = _registry.get(dev_id)
+    if not d:
+        return jsonify({"error": "Not found"}), 404
+    name = d.get("name") or ""
+    builds = _firmware_store.builds(name)
+    sha = (data.get("sha256") or "").lower()
+    if not sha:
+        older = [b for b in builds if b["sha256"] != d.get("firmware_sha256")]
+        if not older:
+            return jsonify({"error": "No previous build stored for this device."}), 404
+        sha = older[0]["sha256"]
+    entry = _firmware_store.get(name, sha)
+    if not entry:
+        return jsonify({"error": f"Build {sha[:12]} is not stored for this device."}), 404
+
+    method = (data.get("method") or "ota").lower()
+    config = _firmware_store.yaml(entry) or _registry.yaml(d) or ""
+    if method == "usb":
+        if data.get("flashed"):
+            _firmware_store.touch(name, sha)
+            saved = upsert_device_record(
+                name=name,
+                platform=d.get("platform") or "",
+                board_label=d.get("board_label") or "",
+                board_id=d.get("board_id") or d.get("board") or "",
+                yaml_text=config,
+                firmware_sha256=sha,
+                firmware_size=entry["size"],
+            )
+            # erst jetzt ist der Build der aktuelle Stand -> auch unter <name>.bin
+            publish_firmware(name, d.get("platform") or "", entry["path"], sha, entry["version"])
+            _drop_rollback_images(name)
+            return jsonify({"status": "ok", "version": entry["version"], "device": saved}), 200
+        image = _rollback_image_name(name, sha)
+        _drop_rollback_images(name, keep=image)
+        published = publish_firmware(image, d.get("platform") or "", entry["path"],
+                                     entry["sha256"], entry["version"])
+        return jsonify({"status": "ready", "manifest_url": published["manifest_url"],
+                        "sha256": sha, "version": entry["version"], "device_id": dev_id}), 200
+    if method != "ota":
+        return jsonify({"error": f"Unknown method: {method}"}), 400
+    if not config:
+        return jsonify({"error": "No YAML available for OTA upload."}), 409
+
+    params = {
+        "config": config,
+        "sha256": sha,
+        "path": entry["path"],
+        "size": entry["size"],
+        "version": entry["version"],
+        "target": data.get("ip") or d.get("ip") or "OTA",
+        "platform": d.get("platform") or "",
+        "board_label": d.get("board_label") or "",
+        "board_id": d.get("board_id") or d.get("board") or "",
+        "ip": d.get("ip"),
+    }
+    try:
+        job, deduped = _scheduler.submit("rollback", name, params, _rollback_runner)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify({**job.to_dict(_scheduler.position(job)), "deduplicated": deduped}), 202
+
+
+# =========================
+# Scanning (concurrent TCP)
+# =========================
+SCAN_DEFAULT_SUBNET = "192.168.178"
+SCAN_CONNECT_TIMEOUT = 0.25      # s pro Connect-Versuch
+SCAN_DEFAULT_CONCURRENCY = 256   # Hosts gleichzeitig "in flight"
+SCAN_MAX_CONCURRENCY = 1024
+SCAN_DEFAULT_BUDGET = 15.0       # s Gesamtbudget pro Sweep
+SCAN_MAX_HOSTS = 4096            # größter erlaubter Bereich (/20)
+SCAN_FD_RESERVE = 256            # fds, die ein Sweep dem restlichen Server lässt
+SCAN_FD_RETRY = 0.05             # s Pause, wenn gerade gar kein fd frei ist
+
+
+def _parse_scan_targets(subnet: Optional[str] = None, cidr: Optional[str] = None) -> List[str]:
+    """
+    Resolve the scan range into host IPs.
+    ?cidr=10.0.0.0/22 takes precedence; legacy ?subnet=192.168.178 means .1-.254.
+    """
+    if not isinstance(cidr, (str, type(None))) or not isinstance(subnet, (str, type(None))):
+        raise ValueError("subnet/cidr must be strings.")
+    if cidr:
+        raw = cidr.strip()
+    else:
+        raw = f"{(subnet or SCAN_DEFAULT_SUBNET).strip().rstrip('.')}.0/24"
+    try:
+        net = ipaddress.ip_network(raw, strict=False)
+    except ValueError:
+        raise ValueError(f"Invalid scan range: {raw}")
+    if net.version != 4:
+        raise ValueError("Only IPv4 ranges are supported.")
+    if net.num_addresses > SCAN_MAX_HOSTS:
+        raise ValueError(f"Scan range too large (max {SCAN_MAX_HOSTS} addresses).")
+    hosts = [str(h) for h in net.hosts()]
+    return hosts or [str(net.network_address)]
+
+
+def _parse_scan_ports(raw: Optional[str]) -> List[int]:
+    if isinstance(raw, int) and not isinstance(raw, bool):
+        raw = str(raw)
+    if not isinstance(raw, (str, type(None))):
+        raise ValueError("ports must be a comma-separated string or a list.")
+    ports = []
+    for p in (raw or "80").split(","):
+        p = p.strip()
+        if p.isdigit() and 0 < int(p) < 65536 and int(p) not in ports:
+            ports.append(int(p))
+    return ports
+
+
+def _bounded_float(raw: Optional[str], default: float, lo: float, hi: float) -> float:
+    try:
+        v = float(raw) if raw not in (None, "") else default
+    except (TypeError, ValueError):
+        v = default
+    if v != v:   # NaN
+        v = default
+    return max(lo, min(hi, v))
+
+
+def _scan_fd_budget() -> int:
+    """Sockets one sweep may hold: half of what RLIMIT_NOFILE leaves after the reserve."""
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    return max(16, (soft - SCAN_FD_RESERVE) // 2)
+
+
+def scan_hosts(
+    hosts: Iterable[str],
+    ports: List[int],
+    *,
+    concurrency: int = SCAN_DEFAULT_CONCURRENCY,
+    timeout: float = SCAN_CONNECT_TIMEOUT,
+    host_deadline: Optional[float] = None,
+    budget: float = SCAN_DEFAULT_BUDGET,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[Tuple[str, List[int]]]:
+    """
+    Probe hosts x ports with non-blocking connects multiplexed over one selector.
+
+    All ports of a host are tried in parallel; a host is finished once every
+    connect has answered or its deadline (default: `timeout`) has passed.
+    At most `concurrency` hosts are in flight (clamped so that hosts x ports
+    fits the fd budget), the whole sweep stops after `budget` seconds or when
+    `cancel` is set. If sockets run out anyway (EMFILE, other scans), fewer
+    hosts are kept in flight until fds are free again. Yields
+    (ip, open_ports) for every finished host, as soon as it is finished.
+    """
+    host_deadline = host_deadline or timeout
+    limit = max(1, min(int(concurrency), _scan_fd_budget() // max(1, len(ports))))
+    concurrency = limit
+    sel = selectors.DefaultSelector()
+    pending = iter(hosts)
+    deferred: deque = deque()   # Hosts, für die gerade kein Socket zu bekommen war
+    exhausted = False
+    inflight: Dict[str, Dict[str, Any]] = {}   # ip -> {"deadline", "open", "socks"}
+    sweep_end = time.monotonic() + budget
+
+    def _drop(sock: socket.socket) -> None:
+        try:
+            sel.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= sweep_end or (cancel is not None and cancel.is_set()):
+                return
+
+            # Neue Hosts nachschieben, bis das Limit erreicht ist
+            starved = False
+            while not exhausted and len(inflight) < concurrency:
+                ip = deferred.popleft() if deferred else next(pending, None)
+                if ip is None:
+                    exhausted = True
+                    break
+                st: Dict[str, Any] = {"deadline": now + host_deadline, "open": [], "socks": []}
+                for port in ports:
+                    try:
+                        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    except OSError:
+                        # EMFILE/ENFILE: Host zurückstellen, bis laufende Hosts fds freigeben
+                        starved = True
+                        break
+                    sock.setblocking(False)
+                    try:
+                        rc = sock.connect_ex((ip, port))
+                    except OSError:
+                        sock.close()
+                        continue
+                    if rc == 0:
+                        st["open"].append(port)
+                        sock.close()
+                    elif rc in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        sel.register(sock, selectors.EVENT_WRITE, (ip, port))
+                        st["socks"].append(sock)
+                    else:
+                        sock.close()
+                if starved:
+                    for sock in st["socks"]:
+                        _drop(sock)
+                    deferred.appendleft(ip)
+                    concurrency = max(1, len(inflight))
+                    break
+                inflight[ip] = st
+
+            if exhausted and not inflight:
+                return
+            if starved and not inflight:
+                time.sleep(SCAN_FD_RETRY)
+                continue
+
+            if any(st["socks"] for st in inflight.values()):
+                next_deadline = min(st["deadline"] for st in inflight.values() if st["socks"])
+                wait = max(0.0, min(next_deadline, sweep_end) - time.monotonic())
+                for key, _ in sel.select(wait):
+                    sock = key.fileobj
+                    ip, port = key.data
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    st = inflight[ip]
+                    st["socks"].remove(sock)
+                    _drop(sock)
+                    if err == 0:
+                        st["open"].append(port)
+
+            # Fertige oder abgelaufene Hosts melden
+            now = time.monotonic()
+            for ip in list(inflight):
+                st = inflight[ip]
+                if st["socks"] and now < st["deadline"]:
+                    continue
+                for sock in st["socks"]:
+                    _drop(sock)
+                del inflight[ip]
+                if concurrency < limit and not starved:
+                    concurrency += 1
+                yield ip, sorted(st["open"])
+    finally:
+        for st in inflight.values():
+            for sock in st["socks"]:
+                _drop(sock)
+        sel.close()
+
+
+# =========================
+# Discovery cache
+# =========================
+DISCOVERY_FILE = Path(DATA_DIR) / "discovery.json"
+DISCOVERY_FRESH_TTL = 300.0           # s: so lange gilt ein Probe-Ergebnis als aktuell
+DISCOVERY_EVICT_TTL = 7 * 86400.0     # s: Hosts, die so lange nicht antworten, fliegen raus
+DISCOVERY_NEGATIVE_TTL = 3600.0       # s: Hosts ohne offene Ports merken wir uns kürzer
+
+
+class _DiscoveryCache:
+    """
+    Per-IP liveness cache persisted to /data/discovery.json.
+    Entry: {"ports": open ports, "probed_ports": ports checked,
+            "last_probe": ts, "last_seen": ts|None, "first_seen": ts,
+            "identity": fingerprint (see identify_host), optional}
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._loaded = False
+        self._dirty = False
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            self.entries = json.loads(self.path.read_text(encoding="utf-8")).get("hosts", {})
+        except Exception:
+            self.entries = {}
+
+    def fresh_result(self, ip: str, ports: List[int], now: float) -> Optional[List[int]]:
+        """Cached open ports for `ports` if the entry is fresh enough, else None."""
+        with self.lock:
+            self._ensure_loaded()
+            e = self.entries.get(ip)
+            if not e or now - e.get("last_probe", 0) > DISCOVERY_FRESH_TTL:
+                return None
+            if not set(ports) <= set(e.get("probed_ports", [])):
+                return None
+            return [p for p in e.get("ports", []) if p in ports]
+
+    def record(self, ip: str, ports: List[int], open_ports: List[int], now: float) -> None:
+        with self.lock:
+            self._ensure_loaded()
+            e = self.entries.setdefault(ip, {"first_seen": now, "last_seen": None})
+            # frühere Treffer auf nicht geprüften Ports bleiben erhalten
+            keep = [p for p in e.get("ports", []) if p not in ports]
+            e["ports"] = sorted(keep + list(open_ports))
+            probed = set(ports)
+            if now - e.get("last_probe", 0) <= DISCOVERY_FRESH_TTL:
+                probed |= set(e.get("probed_ports", []))
+            e["probed_ports"] = sorted(probed)
+            e["last_probe"] = now
+            if open_ports:
+                e["last_seen"] = now
+            self._dirty = True
+
+    def identity(self, ip: str, max_age: float, now: float) -> Optional[Dict[str, Any]]:
+        """Cached fingerprint of `ip` if younger than max_age."""
+        with self.lock:
+            self._ensure_loaded()
+            ident = (self.entries.get(ip) or {}).get("identity")
+            if not ident or now - ident.get("identified_at", 0) > max_age:
+                return None
+            return dict(ident)
+
+    def set_identity(self, ip: str, ident: Dict[str, Any]) -> None:
+        with self.lock:
+            self._ensure_loaded()
+            e = self.entries.setdefault(ip, {"first_seen": ident["identified_at"], "last_seen": None})
+            e["identity"] = ident
+            self._dirty = True
+
+    def known_ips(self) -> List[str]:
+        with self.lock:
+            self._ensure_loaded()
+            return [ip for ip, e in self.entries.items() if e.get("last_seen")]
+
+    def get(self, ip: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            self._ensure_loaded()
+            e = self.entries.get(ip)
+            return dict(e) if e else None
+
+    def evict(self, now: float) -> int:
+        with self.lock:
+            self._ensure_loaded()
+            stale = [
+                ip for ip, e in self.entries.items()
+                if (e.get("last_seen") and now - e["last_seen"] > DISCOVERY_EVICT_TTL)
+                or (not e.get("last_seen") and now - e.get("last_probe", 0) > DISCOVERY_NEGATIVE_TTL)
+            ]
+            for ip in stale:
+                del self.entries[ip]
+            if stale:
+                self._dirty = True
+            return len(stale)
+
+    def save(self) -> None:
+        with self.lock:
+            if not self._dirty:
+                return
+            _atomic_write(self.path, {"version": 1, "hosts": self.entries})
+            self._dirty = False
+
+
+_discovery = _DiscoveryCache(DISCOVERY_FILE)
+
+
+def _known_device_ips() -> List[str]:
+    """Registry IPs first, then mDNS announcements, then hosts the discovery cache has seen alive."""
+    ips: List[str] = []
+    for d in _registry.all():
+        ip = (d.get("ip") or "").strip()
+        if ip and ip not in ips:
+            ips.append(ip)
+    for ip in _mdns.ips() + _discovery.known_ips():
+        if ip not in ips:
+            ips.append(ip)
+    valid = []
+    for ip in ips:
+        try:
+            if ipaddress.ip_address(ip).version == 4:
+                valid.append(ip)
+        except ValueError:
+            pass
+    return valid
+
+
+def discover_hosts(
+    params: Dict[str, Any],
+    cancel: Optional[threading.Event] = None,
+    stats: Optional[Dict[str, int]] = None,
+) -> Iterator[Tuple[str, List[int], bool]]:
+    """
+    Incremental scan: fresh cache entries are answered without probing,
+    known devices are probed before the rest of the range.
+    Yields (ip, open_ports, from_cache).
+    """
+    ports = params["ports"]
+    now = time.time()
+    t0 = time.monotonic()
+    _discovery.evict(now)
+    stats = stats if stats is not None else {}
+    stats.update({"cached": 0, "probed": 0})
+
+    known = set(_known_device_ips())
+    to_probe: List[str] = []
+    for ip in params["hosts"]:
+        hit = None if params.get("refresh") else _discovery.fresh_result(ip, ports, now)
+        if hit is None:
+            to_probe.append(ip)
+            continue
+        stats["cached"] += 1
+        M_DISCOVERY_LOOKUPS.inc(result="hit")
+        yield ip, hit, True
+    # bekannte Geräte zuerst – die liefern die ersten Treffer
+    to_probe.sort(key=lambda ip: ip not in known)
+
+    try:
+        for ip, open_ports in scan_hosts(to_probe, ports, concurrency=params["concurrency"],
+                                         timeout=params["timeout"], budget=params["budget"],
+                                         cancel=cancel):
+            stats["probed"] += 1
+            _discovery.record(ip, ports, open_ports, time.time())
+            yield ip, open_ports, False
+    finally:
+        mode = params.get("scope") or "range"
+        M_DISCOVERY_LOOKUPS.inc(len(to_probe), result="miss")
+        M_SCAN_DURATION.observe(time.monotonic() - t0, mode=mode)
+        M_SCAN_HOSTS.observe(stats["probed"], mode=mode)
+        M_SCAN_CACHED.inc(stats["cached"])
+        try:
+            _discovery.save()
+        except Exception:
+            traceback.print_exc()
+
+
+def _scan_params(src: Dict[str, Any]) -> Dict[str, Any]:
+    """Parse scan options from query args / JSON body; raises ValueError."""
+    for key in ("concurrency", "timeout", "budget"):
+        if isinstance(src.get(key), (list, dict, bool)):
+            raise ValueError(f"{key} must be a number.")
+    ports_raw = src.get('ports')
+    if isinstance(ports_raw, list):
+        ports_raw = ",".join(str(p) for p in ports_raw)
+    scope = src.get('scope') or "range"
+    if scope in ("known", "mdns"):
+        # nur bekannte Geräte (Registry + mDNS + Cache) bzw. nur per mDNS angekündigte,
+        # optional auf den Bereich begrenzt
+        hosts = _known_device_ips() if scope == "known" else _mdns.ips()
+        if src.get('subnet') or src.get('cidr'):
+            in_range = set(_parse_scan_targets(src.get('subnet'), src.get('cidr')))
+            hosts = [ip for ip in hosts if ip in in_range]
+    else:
+        hosts = _parse_scan_targets(src.get('subnet'), src.get('cidr'))
+    return {
+        "hosts": hosts,
+        "scope": scope if scope in ("known", "mdns") else "range",
+        "refresh": str(src.get('refresh', '')).lower() in ("1", "true", "yes"),
+        "identify": str(src.get('identify', '1')).lower() not in ("0", "false", "no"),
+        "ports": _parse_scan_ports(ports_raw),
+        "concurrency": int(_bounded_float(src.get('concurrency'),
+                                          SCAN_DEFAULT_CONCURRENCY, 1, SCAN_MAX_CONCURRENCY)),
+        "timeout": _bounded_float(src.get('timeout'), SCAN_CONNECT_TIMEOUT, 0.05, 5.0),
+        "budget": _bounded_float(src.get('budget'), SCAN_DEFAULT_BUDGET, 0.1, 120.0),
+    }
+
+
+@app.route('/scan', methods=['GET'])
+@_streaming
+def scan():
+    """
+    Concurrent, incremental TCP port scan.
+    Example: /scan?subnet=192.168.178&ports=80,6053
+             /scan?cidr=10.0.0.0/23&ports=6053&concurrency=256&timeout=0.3&budget=10
+             /scan?scope=known          (only registry/mDNS/cached devices)
+             /scan?scope=mdns           (only hosts announced via mDNS, see /api/discovery/mdns)
+             /scan?identify=0           (no fingerprinting)
+    Hosts probed within DISCOVERY_FRESH_TTL are answered from the discovery
+    cache unless ?refresh=1. With ?stream=ndjson|sse the scan runs as background job and hosts are
+    streamed as soon as they answer (see /scan/jobs).
+    Hosts with open ports are fingerprinted in parallel while the sweep runs
+    ("identity": name/version/mac/device_id, see identify_host).
+    """
+    try:
+        params = _scan_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    stream_fmt = request.args.get('stream')
+    if stream_fmt:
+        try:
+            job = _start_scan_job(params)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 429
+        return _scan_stream_response(job, stream_fmt)
+
+    stats: Dict[str, int] = {}
+    found_devices = []
+    pending: Dict[str, Tuple[Dict[str, Any], Any]] = {}
+    for ip, open_ports, cached in discover_hosts(params, stats=stats):
+        if not open_ports:
+            continue
+        hit = {"ip": ip, "ports": open_ports, "cached": cached}
+        found_devices.append(hit)
+        if params["identify"] and set(open_ports) & set(FINGERPRINT_PORTS):
+            pending[ip] = (hit, _fingerprint_pool.submit(identify_host, ip, open_ports, params["refresh"]))
+    if pending:
+        _attach_identities(pending, FINGERPRINT_BUDGET)
+        try:
+            _discovery.save()
+        except Exception:
+            traceback.print_exc()
+    found_devices.sort(key=lambda d: ipaddress.ip_address(d["ip"]))
+    resp = jsonify(found_devices)
+    resp.headers["X-Scan-Probed"] = str(stats["probed"])
+    resp.headers["X-Scan-Cached"] = str(stats["cached"])
+    return resp
+
+
+# =========================
+# mDNS discovery (_esphomelib._tcp)
+# =========================
+MDNS_GROUP = "224.0.0.251"
+MDNS_PORT = int(os.environ.get("ESPFLASHER_MDNS_PORT", "5353"))   # Tests: eigener Port
+MDNS_SERVICE = "_esphomelib._tcp.local"
+MDNS_ENABLED = str(_addon_option("mdns_discovery", "true")).lower() in ("1", "true", "yes")
+MDNS_QUERY_MIN = 1.0              # s: erste Wiederholung, danach verdoppeln (RFC 6762 5.2)
+MDNS_QUERY_MAX = 300.0            # s: im Dauerbetrieb alle 5 min nachfragen
+MDNS_FORGET_AFTER = DISCOVERY_EVICT_TTL
+MDNS_REFRESH_WAIT = 1.0           # s: ?refresh=1 wartet so lange auf Antworten
+
+_DNS_A, _DNS_PTR, _DNS_TXT, _DNS_SRV = 1, 12, 16, 33
+
+
+def _dns_encode_name(name: str) -> bytes:
+    out = b""
+    for label in name.rstrip(".").split("."):
+        raw = label.encode("utf-8")[:63]
+        out += bytes([len(raw)]) + raw
+    return out + b"\0"
+
+
+def _dns_query(*questions: Tuple[str, int]) -> bytes:
+    msg = struct.pack("!6H", 0, 0, len(questions), 0, 0, 0)
+    for name, qtype in questions:
+        msg += _dns_encode_name(name) + struct.pack("!HH", qtype, 1)
+    return msg
+
+
+def _dns_read_name(buf: bytes, off: int) -> Tuple[str, int]:
+    """(name, offset after it); follows compression pointers."""
+    labels: List[str] = []
+    end = None
+    for _ in range(128):
+        n = buf[off]
+        if n & 0xC0 == 0xC0:
+            if end is None:
+                end = off + 2
+            off = ((n & 0x3F) << 8) | buf[off + 1]
+            continue
+        off += 1
+        if n == 0:
+            return ".".join(labels), (end if end is not None else off)
+        labels.append(buf[off:off + n].decode("utf-8", "replace"))
+        off += n
+    raise ValueError("DNS name pointer loop")
+
+
+def _dns_records(buf: bytes) -> Iterator[Tuple[str, int, int, Any]]:
+    """
+    Resource records of an mDNS response as (name, type, ttl, data).
+    data: A -> ip, PTR -> name, SRV -> (target, port), TXT -> {key: value}, else None.
+    Raises ValueError/IndexError/struct.error on garbage.
+    """
+    _, flags, qd, an, ns, ar = struct.unpack("!6H", buf[:12])
+    if not flags & 0x8000:   # Anfrage, keine Antwort
+        return
+    off = 12
+    for _ in range(qd):
+        off = _dns_read_name(buf, off)[1] + 4
+    for _ in range(an + ns + ar):
+        name, off = _dns_read_name(buf, off)
+        rtype, _, ttl, rdlen = struct.unpack("!HHIH", buf[off:off + 10])
+        off += 10
+        rdata = buf[off:off + rdlen]
+        if len(rdata) != rdlen:
+            raise ValueError("truncated record")
+        data: Any = None
+        if rtype == _DNS_A and rdlen == 4:
+            data = socket.inet_ntoa(rdata)
+        elif rtype == _DNS_PTR:
+            data = _dns_read_name(buf, off)[0]
+        elif rtype == _DNS_SRV:
+            data = (_dns_read_name(buf, off + 6)[0], struct.unpack("!H", rdata[4:6])[0])
+        elif rtype == _DNS_TXT:
+            data = {}
+            i = 0
+            while i < rdlen:
+                entry = rdata[i + 1:i + 1 + rdata[i]].decode("utf-8", "replace")
+                i += 1 + rdata[i]
+                key, _, value = entry.partition("=")
+                if key:
+                    data[key.lower()] = value
+        off += rdlen
+        yield name, rtype, ttl, data
+
+
+def _format_mac(raw: Optional[str]) -> Optional[str]:
+    """aabbccddeeff / aa-bb-.. -> AA:BB:CC:DD:EE:FF (None if not a MAC)."""
+    hexdigits = re.sub(r'[^0-9a-fA-F]', "", raw or "")
+    if len(hexdigits) != 12:
+        return None
+    return ":".join(hexdigits[i:i + 2] for i in range(0, 12, 2)).upper()
+
+
+class _MdnsBrowser:
+    """
+    Listens on the mDNS group for ESPHome announcements and browses actively
+    (PTR query, backoff MDNS_QUERY_MIN..MDNS_QUERY_MAX). Keeps a table
+    instance -> {"name", "ip", "port", "version", "mac", "platform", ...};
+    new or moved nodes are written to the registry (ip/mac) and marked alive
+    in the discovery cache.
+    """
+
+    TXT_FIELDS = ("version", "platform", "board", "network", "friendly_name",
+                  "project_name", "project_version")
+
+    def __init__(self, service: str, port: int):
+        self.service = service.lower()
+        self.port = port
+        self.lock = threading.Lock()
+        self.nodes: Dict[str, Dict[str, Any]] = {}   # instance (lower) -> node
+        self._addr: Dict[str, str] = {}              # host (lower) -> ip
+        self._sock: Optional[socket.socket] = None
+        self._interval = MDNS_QUERY_MIN
+        self._next_query = 0.0
+        self.running = False
+        self.error: Optional[str] = None
+        self.stats = {"queries": 0, "packets": 0, "bad_packets": 0, "reconciled": 0}
+
+    # ---- socket / loop ----
+    def _open(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            try:   # avahi o.ä. hält 5353 evtl. schon
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except OSError:
+                pass
+        sock.bind(("", self.port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack("4s4s", socket.inet_aton(MDNS_GROUP), socket.inet_aton("0.0.0.0")))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        return sock
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="mdns-browser", daemon=True).start()
+
+    def _send(self, msg: bytes) -> None:
+        try:
+            self._sock.sendto(msg, (MDNS_GROUP, self.port))
+            self.stats["queries"] += 1
+        except OSError as e:
+            self.error = str(e)
+
+    def _run(self) -> None:
+        try:
+            self._sock = self._open()
+        except OSError as e:
+            self.error = f"mDNS socket: {e}"
+            return
+        self.running = True
+        while True:
+            now = time.monotonic()
+            if now >= self._next_query:
+                self._send(_dns_query((self.service, _DNS_PTR)))
+                self._next_query = now + self._interval
+                self._interval = min(self._interval * 2, MDNS_QUERY_MAX)
+            # kurzer Takt, damit refresh() nicht bis zur nächsten Runde warten muss
+            self._sock.settimeout(max(0.05, min(0.5, self._next_query - now)))
+            try:
+                data, _ = self._sock.recvfrom(9000)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                self.error = str(e)
+                time.sleep(1.0)
+                continue
+            try:
+                self._handle(data)
+            except Exception:
+                self.stats["bad_packets"] += 1
+
+    def refresh(self) -> None:
+        """Ask again now and restart the backoff."""
+        self._interval = MDNS_QUERY_MIN
+        self._next_query = 0.0
+
+    # ---- records ----
+    def _node(self, instance: str, now: float) -> Dict[str, Any]:
+        key = instance.lower()
+        node = self.nodes.get(key)
+        if node is None:
+            label = instance[:-len(self.service) - 1] if key.endswith("." + self.service) else instance
+            node = self.nodes[key] = {"name": label, "instance": instance, "first_seen": now}
+        node["last_seen"] = now
+        return node
+
+    def _handle(self, data: bytes) -> None:
+        records = list(_dns_records(data))
+        if not records:
+            return
+        self.stats["packets"] += 1
+        now = time.time()
+        suffix = "." + self.service
+        touched: Dict[str, Dict[str, Any]] = {}
+        with self.lock:
+            for name, rtype, ttl, value in records:
+                lname = name.lower()
+                if rtype == _DNS_A and value:
+                    self._addr[lname] = value
+                elif rtype == _DNS_PTR and lname == self.service and value:
+                    node = touched[value.lower()] = self._node(value, now)
+                    # TTL 0 = Goodbye (Gerät fährt herunter)
+                    node["expires"] = now + ttl
+                elif rtype == _DNS_SRV and lname.endswith(suffix) and value:
+                    node = touched[lname] = self._node(name, now)
+                    node["host"], node["port"] = value[0].lower(), value[1]
+                    node.setdefault("expires", now + ttl)
+                elif rtype == _DNS_TXT and lname.endswith(suffix) and value is not None:
+                    node = touched[lname] = self._node(name, now)
+                    for f in self.TXT_FIELDS:
+                        if value.get(f):
+                            node[f] = value[f]
+                    node["mac"] = _format_mac(value.get("mac")) or node.get("mac")
+                    node["api_encryption"] = value.get("api_encryption") or None
+
+            alive, moved, questions = [], set(), []
+            for key, node in self.nodes.items():
+                ip = self._addr.get(node.get("host") or "")
+                if ip and ip != node.get("ip"):
+                    node["ip"] = ip
+                    touched[key] = node
+                    moved.add(key)
+            for key, node in touched.items():
+                if node.get("expires", 0) <= now:
+                    continue
+                if "host" not in node:
+                    questions += [(node["instance"], _DNS_SRV), (node["instance"], _DNS_TXT)]
+                elif not node.get("ip"):
+                    questions.append((node["host"], _DNS_A))
+                else:
+                    alive.append(dict(node))
+            for key in [k for k, n in self.nodes.items() if now - n["last_seen"] > MDNS_FORGET_AFTER]:
+                del self.nodes[key]
+        if questions:
+            self._send(_dns_query(*questions))
+        for node in alive:
+            self._reconcile(node)
+        if moved:
+            try:
+                _discovery.save()
+            except Exception:
+                traceback.print_exc()
+
+    def _reconcile(self, node: Dict[str, Any]) -> None:
+        """Registry ip/mac nachziehen und den Host im Discovery-Cache als lebendig markieren."""
+        ip, port, mac = node["ip"], node.get("port") or 6053, node.get("mac")
+        _discovery.record(ip, [port], [port], time.time())
+        dev_id, updated = _reconcile_device(node.get("name", ""), node.get("platform", ""), mac, ip)
+        if dev_id is None:
+            return
+        with self.lock:
+            entry = self.nodes.get(node["instance"].lower())
+            if entry is not None:
+                entry["device_id"] = dev_id
+        if updated:
+            self.stats["reconciled"] += 1
+
+    # ---- queries ----
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            nodes = [dict(n) for n in self.nodes.values()]
+        for n in nodes:
+            n["online"] = n.get("expires", 0) > now
+            n.pop("expires", None)
+        return sorted(nodes, key=lambda n: n["name"].lower())
+
+    def ips(self) -> List[str]:
+        return [n["ip"] for n in self.snapshot() if n.get("ip") and n["online"]]
+
+    def by_ip(self, ip: str) -> Optional[Dict[str, Any]]:
+        return next((n for n in self.snapshot() if n.get("ip") == ip and n["online"]), None)
+
+
+def _match_registry(name: str, platform: str, mac: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Registry record for a discovered node: name (+platform), then MAC."""
+    rec = _registry.find(name, platform) if platform else None
+    if rec is not None:
+        return rec
+    norm = _normalize_name(name)
+    by_name = [d for d in _registry.all() if d.get("name") == norm]
+    if not by_name and norm:
+        # web_server liefert oft nur den Friendly Name
+        by_name = [d for d in _registry.all() if _normalize_name(d.get("friendly_name") or "") == norm]
+    if len(by_name) == 1:
+        return by_name[0]
+    if mac:
+        by_mac = [d for d in _registry.all() if _format_mac(d.get("mac")) == mac]
+        if len(by_mac) == 1:
+            return by_mac[0]
+    return None
+
+
+def _reconcile_device(name: str, platform: str, mac: Optional[str], ip: str) -> Tuple[Optional[str], bool]:
+    """Match a discovered node and pull its ip/mac into the registry: (device id, updated)."""
+    with _registry.lock:
+        rec = _match_registry(name, platform, mac)
+        if rec is None:
+            return None, False
+        if rec.get("ip") != ip or (mac and _format_mac(rec.get("mac")) != mac):
+            # nur ip/mac schreiben – put() mischt mit dem aktuellen Record, eine ältere
+            # Kopie würde sonst firmware_sha256/flashed_at/notes/tags zurückdrehen
+            _registry.put({"id": rec["id"], "ip": ip, "mac": mac or rec.get("mac")})
+            return rec["id"], True
+        return rec["id"], False
+
+
+_mdns = _MdnsBrowser(MDNS_SERVICE, MDNS_PORT)
+
+
+@app.route("/api/discovery/mdns", methods=["GET"])
+def api_mdns_nodes():
+    """
+    ESPHome nodes announced via mDNS (no network traffic per request).
+    ?refresh=1 sends a query and waits MDNS_REFRESH_WAIT for answers.
+    """
+    if MDNS_ENABLED and request.args.get("refresh") in ("1", "true", "yes"):
+        _mdns.refresh()
+        time.sleep(MDNS_REFRESH_WAIT)
+    return jsonify({
+        "enabled": MDNS_ENABLED,
+        "running": _mdns.running,
+        "error": _mdns.error,
+        "service": MDNS_SERVICE,
+        "stats": dict(_mdns.stats),
+        "nodes": _mdns.snapshot(),
+    })
+
+
+# =========================
+# Fingerprinting (ESPHome API hello / web server)
+# =========================
+FINGERPRINT_TIMEOUT = 1.5        # s Deadline pro Host (Connect + Hello + DeviceInfo)
+FINGERPRINT_BUDGET = 5.0         # s, die ein Scan nach dem Sweep noch auf Fingerprints wartet
+FINGERPRINT_CONCURRENCY = 32
+FINGERPRINT_TTL = 3600.0         # s: so lange gilt eine gecachte Identität
+FINGERPRINT_NEGATIVE_TTL = DISCOVERY_FRESH_TTL   # s: Hosts ohne Identität nicht bei jedem Scan erneut fragen
+FINGERPRINT_MAX_IPS = 1024       # /api/discovery/identify
+FINGERPRINT_MAX_WAIT = 60.0      # s, Obergrenze für /api/discovery/identify (Budget wächst mit der Batch)
+ESPHOME_API_PORT = 6053
+FINGERPRINT_PORTS = (ESPHOME_API_PORT, 80)
+_HTML_TITLE_RE = re.compile(rb'<title[^>]*>([^<]{1,128})</title>', re.I)
+# web_server v2/v3: Seite ohne <title>, der Name kommt per /events im "ping"-Event
+_SSE_PING_RE = re.compile(rb'event:\s*ping\r?\n(?:(?:id|retry):[^\n]*\n)*data:\s*([^\r\n]+)')
+
+
+def _pb_varint(n: int) -> bytes:
+    out = b""
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out += bytes([b | 0x80])
+        else:
+            return out + bytes([b])
+
+
+def _pb_read_varint(buf: bytes, off: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[off]
+        off += 1
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n, off
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def _pb_fields(buf: bytes) -> Dict[int, Any]:
+    """Flat protobuf decode: field number -> int (varint) or bytes (length-delimited)."""
+    fields: Dict[int, Any] = {}
+    off = 0
+    while off < len(buf):
+        key, off = _pb_read_varint(buf, off)
+        num, wire = key >> 3, key & 7
+        if wire == 0:
+            fields[num], off = _pb_read_varint(buf, off)
+        elif wire == 2:
+            n, off = _pb_read_varint(buf, off)
+            fields[num] = buf[off:off + n]
+            off += n
+        elif wire in (1, 5):
+            off += 8 if wire == 1 else 4
+        else:
+            raise ValueError(f"unsupported wire type {wire}")
+    return fields
+
+
+def _pb_str(fields: Dict[int, Any], num: int) -> Optional[str]:
+    v = fields.get(num)
+    return v.decode("utf-8", "replace") if isinstance(v, bytes) and v else None
+
+
+def _api_frame(msg_type: int, body: bytes = b"") -> bytes:
+    # Plaintext-Frame: 0x00, varint Länge, varint Typ, Protobuf
+    return b"\0" + _pb_varint(len(body)) + _pb_varint(msg_type) + body
+
+
+class _Deadline:
+    def __init__(self, seconds: float):
+        self.end = time.monotonic() + seconds
+
+    def left(self) -> float:
+        left = self.end - time.monotonic()
+        if left <= 0:
+            raise socket.timeout("fingerprint deadline")
+        return left
+
 
-    sha256 = _sha256_file(bin_dst)
-    return (f"/firmware/{name}.manifest.json", sha256)
+def _recv_some(sock: socket.socket, deadline: _Deadline) -> bytes:
+    sock.settimeout(deadline.left())
+    chunk = sock.recv(4096)
+    if not chunk:
+        raise ConnectionError("closed")
+    return chunk
 
 
+def _api_fingerprint(ip: str, port: int, deadline: _Deadline) -> Optional[Dict[str, Any]]:
+    """
+    ESPHome native API: HelloRequest (1) + DeviceInfoRequest (9) pipelined,
+    read HelloResponse (2) / DeviceInfoResponse (10). Encrypted APIs answer
+    with the Noise indicator 0x01; then only that fact is reported.
+    """
+    hello = b"\x0a" + _pb_varint(len(b"espflasher")) + b"espflasher" + b"\x10\x01\x18\x0a"
+    with socket.create_connection((ip, port), timeout=deadline.left()) as sock:
+        sock.sendall(_api_frame(1, hello) + _api_frame(9))
+        buf = b""
+        ident: Dict[str, Any] = {}
+        while True:
+            while len(buf) < 3:
+                buf += _recv_some(sock, deadline)
+            if buf[0] == 0x01:
+                return {"api_encryption": True}
+            if buf[0] != 0x00:
+                return None
+            try:
+                length, off = _pb_read_varint(buf, 1)
+                msg_type, off = _pb_read_varint(buf, off)
+            except IndexError:
+                buf += _recv_some(sock, deadline)
+                continue
+            if len(buf) < off + length:
+                buf += _recv_some(sock, deadline)
+                continue
+            fields = _pb_fields(buf[off:off + length])
+            buf = buf[off + length:]
+            if msg_type == 2:     # HelloResponse
+                ident["name"] = _pb_str(fields, 4)
+                ident["api_version"] = f"{fields.get(1, 0)}.{fields.get(2, 0)}"
+                server = _pb_str(fields, 3) or ""
+                m = re.search(r'esphome v?([\w.\-]+)', server)
+                if m:
+                    ident["version"] = m.group(1)
+            elif msg_type == 10:  # DeviceInfoResponse
+                ident.update({
+                    "name": _pb_str(fields, 2) or ident.get("name"),
+                    "mac": _format_mac(_pb_str(fields, 3)),
+                    "version": _pb_str(fields, 4) or ident.get("version"),
+                    "compiled_at": _pb_str(fields, 5),
+                    "model": _pb_str(fields, 6),
+                    "project_name": _pb_str(fields, 8),
+                    "project_version": _pb_str(fields, 9),
+                    "manufacturer": _pb_str(fields, 12),
+                    "friendly_name": _pb_str(fields, 13),
+                    "api_encryption": False,
+                })
+                try:
+                    sock.sendall(_api_frame(5))   # DisconnectRequest, sonst loggt das Gerät einen Fehler
+                except OSError:
+                    pass
+                return ident
+            elif msg_type == 5:   # DisconnectRequest vom Gerät
+                return ident or None
 
-# =========================
-# Routes
-# =========================
-@app.route("/compile", methods=["POST"])
-def compile_yaml():
-    data = request.get_json(silent=True) or {}
-    config = (data.get("configuration") or "").strip()
 
-    if not config:
-        return Response("❌ No YAML configuration received.\n",
-                        status=400, mimetype="text/plain")
+def _http_get(ip: str, port: int, request_head: str, deadline: _Deadline, until=None) -> bytes:
+    """Raw response (head + body, max 64 KiB); stops early once `until(raw)` is true."""
+    with socket.create_connection((ip, port), timeout=deadline.left()) as sock:
+        sock.sendall(request_head.encode("ascii"))
+        raw = b""
+        try:
+            while len(raw) < 65536:
+                raw += _recv_some(sock, deadline)
+                if until is not None and until(raw):
+                    break
+        except (ConnectionError, socket.timeout):
+            pass
+    return raw
 
-    # Name bevorzugt aus YAML (Option B). Fallback: Request-Name.
-    yaml_name = extract_name_from_yaml(config)
-    req_name  = (data.get("name") or "device").strip()
-    name      = _normalize_name(yaml_name or req_name)
 
-    # YAML dort speichern, wo esphome arbeitet
-    yaml_path = os.path.join(YAML_DIR, f"{name}.yaml")
-    with open(yaml_path, "w", encoding="utf-8") as f:
-        f.write(config)
+def _http_fingerprint(ip: str, port: int, deadline: _Deadline) -> Optional[Dict[str, Any]]:
+    """
+    Name of the ESPHome web server: page <title> (v1), else the "title" of
+    the first /events ping (v2/v3 pages have no title). ESPHome shows the
+    friendly name there, or the node name if none is set.
+    """
+    raw = _http_get(ip, port, f"GET / HTTP/1.0\r\nHost: {ip}\r\nAccept-Encoding: gzip\r\n\r\n", deadline)
+    head, _, body = raw.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/"):
+        return None
+    if re.search(rb'^content-encoding:\s*gzip', head, re.I | re.M):
+        try:
+            body = gzip.decompress(body)
+        except (OSError, EOFError):
+            body = b""
+    web_server = b"esphome" in body.lower() or b"esp-app" in body
+    m = _HTML_TITLE_RE.search(body)
+    title = m.group(1).decode("utf-8", "replace").strip() if m else None
+    if not title and web_server:
+        try:
+            events = _http_get(ip, port, f"GET /events HTTP/1.1\r\nHost: {ip}\r\n"
+                                         "Accept: text/event-stream\r\n\r\n",
+                               deadline, until=_SSE_PING_RE.search)
+            m = _SSE_PING_RE.search(events)
+            ping = json.loads(m.group(1)) if m else {}
+            title = str(ping.get("title") or "").strip() if isinstance(ping, dict) else None
+        except (OSError, ValueError):
+            title = None
+    if not title:
+        return None
+    return {"name": _normalize_name(title), "friendly_name": title, "web_server": web_server}
 
-    # Rest wie gehabt
-    platform = data.get("platform") or detect_platform_from_yaml(config)
-    board_label, board_id = unify_board(data)
-    if not board_id:
-        board_id = "esp32dev" if platform == "ESP32" else "d1_mini"
-    if not board_label:
-        board_label = board_id
 
-    chip_family = chip_family_for_platform(platform)
-    # ... (dein bisheriger Code geht hier weiter)
+def fingerprint_host(ip: str, open_ports: List[int], timeout: float = FINGERPRINT_TIMEOUT) -> Optional[Dict[str, Any]]:
+    """
+    Probe one host within `timeout`: native API if 6053 is open; the web
+    server title on 80 only if the API gave no name (e.g. encrypted).
+    """
+    deadline = _Deadline(timeout)
+    result: Dict[str, Any] = {}
+    for port, probe, source in zip(FINGERPRINT_PORTS, (_api_fingerprint, _http_fingerprint), ("api", "http")):
+        if port not in open_ports or result.get("name"):
+            continue
+        t0 = time.monotonic()
+        try:
+            ident = probe(ip, port, deadline)
+        except (OSError, ValueError, IndexError):
+            ident = None
+        M_FINGERPRINT_DURATION.observe(time.monotonic() - t0, source=source)
+        if ident:
+            result.update({k: v for k, v in ident.items() if v is not None and k not in result})
+            result.setdefault("source", source)
+    return result or None
+
 
+def identify_host(ip: str, open_ports: List[int], refresh: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Identity of a host: cached fingerprint (FINGERPRINT_TTL), mDNS table, else probe.
+    Fresh probes and live mDNS records update ip/mac of the matched registry
+    entry; a cached identity only looks the device up. Result carries "device_id".
+    """
+    now = time.time()
+    ident = None if refresh else _discovery.identity(ip, FINGERPRINT_TTL, now)
+    if ident is not None and ident.get("unknown"):
+        if now - ident["identified_at"] <= FINGERPRINT_NEGATIVE_TTL:
+            M_FINGERPRINTS.inc(source="cache")
+            return None
+        ident = None
+    cached = ident is not None
+    if cached:
+        M_FINGERPRINTS.inc(source="cache")
+    else:
+        node = _mdns.by_ip(ip)
+        if node and node.get("name") and not refresh:
+            ident = {k: node.get(k) for k in ("name", "friendly_name", "version", "mac", "platform",
+                                              "board", "project_name", "project_version")}
+            ident["source"] = "mdns"
+        else:
+            ident = fingerprint_host(ip, open_ports)
+        M_FINGERPRINTS.inc(source=ident["source"] if ident else "none")
+        if ident is None:
+            _discovery.set_identity(ip, {"unknown": True, "identified_at": now})
+            return None
+        ident = {k: v for k, v in ident.items() if v is not None}
+        ident["identified_at"] = now
+    dev_id = None
+    if cached:
+        # aus dem Cache: Registry nicht anfassen – die IP kann inzwischen einem anderen Gerät gehören
+        rec = _match_registry(ident.get("name", ""), ident.get("platform", ""), ident.get("mac"))
+        dev_id = rec["id"] if rec else None
+    elif ident.get("name") or ident.get("mac"):
+        dev_id, _ = _reconcile_device(ident.get("name", ""), ident.get("platform", ""), ident.get("mac"), ip)
+    if "device_id" not in ident or ident["device_id"] != dev_id:
+        ident["device_id"] = dev_id
+        _discovery.set_identity(ip, ident)
+    return ident
 
-    def generate():
+
+_fingerprint_pool = ThreadPoolExecutor(max_workers=FINGERPRINT_CONCURRENCY, thread_name_prefix="fingerprint")
+
+
+def _attach_identities(pending: Dict[str, Tuple[Dict[str, Any], Any]], budget: float) -> None:
+    """
+    Wait up to `budget` for submitted fingerprints and store them in their
+    scan hits; ones that have not started by then are cancelled.
+    """
+    futures_wait([fut for _, fut in pending.values()], timeout=budget)
+    for hit, fut in pending.values():
+        if not fut.done():
+            fut.cancel()
+        elif not fut.cancelled() and not fut.exception() and fut.result():
+            hit["identity"] = fut.result()
+
+
+@app.route("/api/discovery/identify", methods=["POST"])
+def api_identify_hosts():
+    """
+    Body: {"ips": [...], "ports": [6053, 80], "refresh": false}   (ports: which of FINGERPRINT_PORTS to try)
+    Fingerprints all hosts concurrently (cache first) and matches them to the registry.
+    """
+    data = request.get_json(silent=True) or {}
+    ips = data.get("ips") or []
+    if not isinstance(ips, list) or not ips:
+        return jsonify({"error": "No ips provided."}), 400
+    if len(ips) > FINGERPRINT_MAX_IPS:
+        return jsonify({"error": f"Too many hosts (max {FINGERPRINT_MAX_IPS})."}), 400
+    try:
+        ips = list(dict.fromkeys(str(ipaddress.ip_address(str(ip).strip())) for ip in ips))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    ports_raw = data.get("ports") or list(FINGERPRINT_PORTS)
+    if isinstance(ports_raw, list):
+        if not all((isinstance(p, int) and not isinstance(p, bool)) or (isinstance(p, str) and p.strip().isdigit())
+                   for p in ports_raw):
+            return jsonify({"error": "ports must be a list of port numbers."}), 400
+        ports_raw = ",".join(str(p).strip() for p in ports_raw)
+    try:
+        ports = _parse_scan_ports(ports_raw)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not ports:
+        return jsonify({"error": "No valid ports provided."}), 400
+    refresh = bool(data.get("refresh"))
+    pending = {ip: ({"ip": ip}, _fingerprint_pool.submit(identify_host, ip, ports, refresh)) for ip in ips}
+    # jede Welle von FINGERPRINT_CONCURRENCY Hosts braucht bis zu FINGERPRINT_TIMEOUT
+    waves = -(-len(ips) // FINGERPRINT_CONCURRENCY)
+    _attach_identities(pending, min(FINGERPRINT_MAX_WAIT, FINGERPRINT_BUDGET + waves * FINGERPRINT_TIMEOUT))
+    hosts = [hit for hit, _ in pending.values()]
+    for hit in hosts:
+        hit.setdefault("identity", None)
+    try:
+        _discovery.save()
+    except Exception:
+        traceback.print_exc()
+    return jsonify(hosts)
+
+
+# =========================
+# Scan jobs (background + streaming)
+# =========================
+SCAN_JOB_RETENTION = 300.0   # s, so lange bleiben fertige Jobs abrufbar
+SCAN_MAX_RUNNING_JOBS = 4
+
+
+class _ScanJob:
+    """A sweep running in its own thread; results are collected as hosts answer."""
+
+    def __init__(self, params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.total = len(params["hosts"])
+        self.probed = 0
+        self.stats: Dict[str, int] = {}
+        self.results: List[Dict[str, Any]] = []
+        self.identified: List[Dict[str, Any]] = []   # Treffer mit Identität, in Eingangsreihenfolge
+        self._pending: List[Any] = []
+        self.state = "running"
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.cancel = threading.Event()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=f"scan-{self.id[:8]}", daemon=True)
+
+    def _run(self) -> None:
         try:
-            yield f"📥 YAML saved: {yaml_path}\n"
-            yield "🚀 Starting compilation...\n\n"
-
-            # Wichtig: im YAML_DIR ausführen und nur den Dateinamen übergeben
-            proc = subprocess.Popen(
-                ["esphome", "compile", f"{name}.yaml"],
-                cwd=YAML_DIR,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-            )
-            for line in iter(proc.stdout.readline, ''):
-                yield line
-            proc.stdout.close()
-            returncode = proc.wait()
+            for ip, open_ports, cached in discover_hosts(self.params, cancel=self.cancel,
+                                                         stats=self.stats):
+                hit = {"ip": ip, "ports": open_ports, "cached": cached}
+                with self.cond:
+                    self.probed += 1
+                    if open_ports:
+                        self.results.append(hit)
+                    self.cond.notify_all()
+                if self.params.get("identify") and set(open_ports) & set(FINGERPRINT_PORTS):
+                    fut = _fingerprint_pool.submit(identify_host, ip, open_ports, self.params.get("refresh"))
+                    fut.add_done_callback(lambda f, hit=hit: self._identified(hit, f))
+                    self._pending.append(fut)
+            if self._pending and not self.cancel.is_set():
+                futures_wait(self._pending, timeout=FINGERPRINT_BUDGET)
+                try:
+                    _discovery.save()
+                except Exception:
+                    traceback.print_exc()
+            state = "cancelled" if self.cancel.is_set() else "done"
+        except Exception:
+            traceback.print_exc()
+            state = "failed"
+        with self.cond:
+            self.state = state
+            self.finished_at = time.time()
+            self.cond.notify_all()
 
-            if returncode != 0:
-                yield f"\n❌ Compilation failed with code {returncode}.\n"
-                return
+    def _identified(self, hit: Dict[str, Any], fut: Any) -> None:
+        if fut.exception() or not fut.result():
+            return
+        with self.cond:
+            hit["identity"] = fut.result()
+            self.identified.append(hit)
+            self.cond.notify_all()
 
-            bin_path, _ = get_firmware_paths(name)
-            if not bin_path or not os.path.exists(bin_path):
-                yield f"❌ No binary file found under {os.path.join(YAML_DIR, '.esphome', 'build')}.\n"
-                return
-            else:
-                yield f"📦 Found firmware at: {bin_path}\n"
-
-            # Bin in www/firmware spiegeln
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-            output_bin = os.path.join(OUTPUT_DIR, f"{name}.bin")
-            shutil.copyfile(bin_path, output_bin)
-            # Optional: Original behalten; wenn du löschen willst, auskommentierten Block aktivieren
-            # try:
-            #     os.remove(bin_path)
-            # except Exception:
-            #     pass
-
-            # Web-Flasher Manifest schreiben
-            manifest_data = {
-                "name": f"{name} Firmware",
-                "version": "1.0.0",
-                "builds": [{
-                    "chipFamily": chip_family,
-                    "parts": [{"path": f"firmware/{name}.bin", "offset": 0}],
-                }],
-            }
-            manifest_path = os.path.join(OUTPUT_DIR, f"{name}.manifest.json")
-            with open(manifest_path, "w", encoding="utf-8") as f:
-                json.dump(manifest_data, f)
+    @property
+    def finished(self) -> bool:
+        return self.state != "running"
 
-            # Registry synchronisieren (falls UI state mitschickt)
-            config_json = data.get("config_json") or {}
+    def key(self) -> Tuple[Any, ...]:
+        p = self.params
+        return (tuple(p["hosts"]), tuple(p["ports"]), p.get("refresh"), p.get("identify"))
 
-            saved_dev = upsert_device_record(
-                name=name,
-                platform=platform,
-                board_label=board_label,
-                board_id=board_id,
-                yaml_text=config,
-                config_json=config_json,
-                firmware_sha256=None,
+    def progress(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "probed": self.probed,
+            "total": self.total,
+            "found": len(self.results),
+            "identified": len(self.identified),
+            "cache_hits": self.stats.get("cached", 0),
+            "ports": self.params["ports"],
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def wait(self, seen: int, probed: int, timeout: float, identified: int = 0) -> None:
+        """Block until new results/progress/identities beyond (seen, probed, identified) or the job ends."""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: (len(self.results) > seen or self.probed > probed
+                         or len(self.identified) > identified or self.finished),
+                timeout=timeout,
             )
 
-            yield "\n✅ Compilation successful!\n"
-            # WICHTIG: Device-Objekt mitsenden -> Client kann saved_dev['id'] merken
-            yield json.dumps({
-                "manifest_url": f"/firmware/{name}.manifest.json",
-                "device": saved_dev
-            }) + "\n"
 
-        except Exception as e:
-            traceback.print_exc()
-            yield f"💥 Error: {str(e)}\n"
+_scan_jobs: Dict[str, _ScanJob] = {}
+_scan_jobs_lock = threading.Lock()
 
-    return Response(generate(), mimetype="text/plain")
 
+def _prune_scan_jobs() -> None:
+    cutoff = time.time() - SCAN_JOB_RETENTION
+    for jid, job in list(_scan_jobs.items()):
+        if job.finished and (job.finished_at or 0) < cutoff:
+            del _scan_jobs[jid]
 
 
-@app.route("/flash", methods=["POST"])
-def flash_device():
-    try:
-        data = request.get_json(silent=True) or {}
-        name = _normalize_name(data.get("name", ""))
-        method = data.get("method", "ota")
-        ip = data.get("ip")
-        mac = data.get("mac")
+def _start_scan_job(params: Dict[str, Any]) -> _ScanJob:
+    """Start a scan job, or return the running one for the same range/ports."""
+    job = _ScanJob(params)
+    with _scan_jobs_lock:
+        _prune_scan_jobs()
+        running = [j for j in _scan_jobs.values() if not j.finished]
+        for other in running:
+            if other.key() == job.key():
+                return other
+        if len(running) >= SCAN_MAX_RUNNING_JOBS:
+            raise RuntimeError("Too many scans running, try again later.")
+        _scan_jobs[job.id] = job
+    job.thread.start()
+    return job
 
-        if not name:
-            return jsonify({"error": "No device name provided."}), 400
 
-        yaml_path = os.path.join(YAML_DIR, f"{name}.yaml")
-        if not os.path.exists(yaml_path):
-            return jsonify({"error": "YAML config not found."}), 404
+def _scan_stream_response(job: _ScanJob, fmt: str) -> Response:
+    """Stream host hits (and their identities) as NDJSON lines or SSE events until the job ends."""
+    sse = fmt == "sse" or "text/event-stream" in request.headers.get("Accept", "")
 
-        config_text = Path(yaml_path).read_text(encoding="utf-8")
-        platform = detect_platform_from_yaml(config_text)
+    def _event(kind: str, payload: Dict[str, Any]) -> str:
+        if sse:
+            return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps({"type": kind, **payload}) + "\n"
 
-        # best-guess board from registry if available
-        db = _load_devices()
-        existing = next(
-            (d for d in db["devices"]
-             if _normalize_name(d.get("name", "")) == name and d.get("platform") == platform),
-            None
-        )
-        board_label = existing.get("board_label") if existing else ""
-        board_id = existing.get("board_id") if existing else ""
-        if not board_id:
-            board_id = "esp32dev" if platform == "ESP32" else "d1_mini"
-        if not board_label:
-            board_label = board_id
+    def generate():
+        seen, probed, identified = 0, 0, 0
+        yield _event("job", job.progress())
+        while True:
+            job.wait(seen, probed, timeout=1.0, identified=identified)
+            with job.cond:
+                new = [dict(hit) for hit in job.results[seen:]]
+                seen += len(new)
+                named = [dict(hit) for hit in job.identified[identified:]]
+                identified += len(named)
+                finished = job.finished
+                snap = job.progress()
+            for hit in new:
+                yield _event("host", hit)
+            for hit in named:
+                yield _event("identity", hit)
+            if snap["probed"] != probed:
+                probed = snap["probed"]
+                yield _event("progress", snap)
+            if finished:
+                yield _event("done", {**snap, "results": job.results})
+                return
 
-        if method == "usb":
-    # 1) (Re-)Compile sicherstellen
-            compile_proc = subprocess.run(
-                ["esphome", "compile", f"{name}.yaml"],
-                cwd=YAML_DIR,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-            )
-            if compile_proc.returncode != 0:
-                return Response(compile_proc.stdout + "\n❌ Compile failed.\n", mimetype="text/plain")
+    return Response(
+        generate(),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Scan-Job": job.id},
+    )
 
-    # 2) Manifest + Bin im WWW-Verzeichnis sicherstellen
-            try:
-                manifest_rel, sha256 = ensure_manifest_for_name(name, platform)
-            except Exception as ex:
-                return jsonify({"error": f"Failed to prepare manifest: {ex}"}), 500
 
-    # 3) Registry upserten (inkl. SHA)
-            saved = upsert_device_record(
-                name=name,
-                platform=platform,
-                board_label=board_label,
-                board_id=board_id,
-                yaml_text=config_text,
-                ip=ip,
-                mac=mac,
-                firmware_sha256=sha256,
-            )
+@app.route('/scan/jobs', methods=['POST'])
+def api_start_scan_job():
+    """Start a background scan; body/args like /scan. Returns the job id."""
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify({"error": "JSON object expected."}), 400
+    src = {**request.args.to_dict(), **body}
+    try:
+        job = _start_scan_job(_scan_params(src))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify(job.progress()), 202
 
-    # 4) Client bekommt Manifest-URL + device_id
-            return jsonify({
-                "status": "ok",
-                "manifest_url": manifest_rel,
-                "device_id": saved.get("id"),
-            })
 
-        else:
-            def generate():
-                try:
-                    yield f"🚀 Starting OTA flash for {yaml_path}...\n\n"
-                    proc = subprocess.Popen(
-                        ["esphome", "run", f"{name}.yaml"],
-                        cwd=YAML_DIR,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        text=True,
-                        bufsize=1,
-                    )
-                    for line in iter(proc.stdout.readline, ''):
-                        yield line
-                    proc.stdout.close()
-                    returncode = proc.wait()
-
-                    if returncode == 0:
-                        upsert_device_record(
-                            name=name,
-                            platform=platform,
-                            board_label=board_label,
-                            board_id=board_id,
-                            yaml_text=config_text,
-                            ip=ip,
-                            mac=mac,
-                        )
-                        yield "\n✅ Flash successful.\n"
-                    else:
-                        yield f"\n❌ Flash failed with code {returncode}.\n"
-                except Exception as e:
-                    traceback.print_exc()
-                    yield f"\n💥 Error during flash: {str(e)}\n"
+@app.route('/scan/jobs/<job_id>', methods=['GET'])
+def api_get_scan_job(job_id):
+    job = _scan_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    offset = request.args.get('offset', type=int) or 0
+    with job.cond:
+        return jsonify({**job.progress(), "results": job.results[offset:]}), 200
 
-            return Response(generate(), mimetype="text/plain")
 
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+@app.route('/scan/jobs/<job_id>/stream', methods=['GET'])
+@_streaming
+def api_stream_scan_job(job_id):
+    job = _scan_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    return _scan_stream_response(job, request.args.get('format', 'ndjson'))
+
+
+@app.route('/scan/jobs/<job_id>', methods=['DELETE'])
+def api_cancel_scan_job(job_id):
+    job = _scan_jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    job.cancel.set()
+    return jsonify(job.progress()), 200
 
 
 # =========================
-# Device registry API
+# Catalog search (icons, sensors, templates, displays)
 # =========================
-@app.route("/api/devices", methods=["GET"])
-def api_list_devices():
-    db = _load_devices()
-    include = request.args.get("include", "")
-    items = []
-    for d in db.get("devices", []):
-        _migrate_device_inplace(d)
-        if include == "full":
-            items.append(d)
-        else:
-            items.append({
-                "id": d.get("id"),
-                "name": d.get("name"),
-                "friendly_name": d.get("friendly_name") or d.get("name"),
-                "platform": d.get("platform"),
-                # include modern board fields
-                "board_id": d.get("board_id"),
-                "board_label": d.get("board_label"),
-                # legacy field for UI display fallback
-                "board": d.get("board") or d.get("board_label") or d.get("board_id"),
-                "ip": d.get("ip"),
-                "mac": d.get("mac"),
-                "flashed_at": d.get("flashed_at"),
-                "firmware_sha256": d.get("firmware_sha256"),
-            })
-    return jsonify({"devices": items}), 200
+CATALOG_DIR = Path(WWW_DIR) / "assets" / "assets"
+CATALOG_FILES = {
+    "icons": "icons/esphome_mdi_icons.json",
+    "sensors": "sensors.json",
+    "templates": "templates.json",
+    "displays": "displays.json",
+}
+CATALOG_DEFAULT_LIMIT = 50
+CATALOG_MAX_LIMIT = 500
+_TOKEN_SPLIT_RE = re.compile(r'[^0-9a-zäöüß]+')
 
 
-@app.route("/api/devices/<dev_id>", methods=["GET"])
-def api_get_device(dev_id):
-    db = _load_devices()
-    for d in db["devices"]:
-        if d.get("id") == dev_id:
-            _migrate_device_inplace(d)
-            return jsonify(d), 200
-    return jsonify({"error": "Not found"}), 404
+def _catalog_items(catalog: str, raw: Any) -> List[Dict[str, Any]]:
+    """Flatten a catalog file: icons list as-is, {category: {name: spec}} -> one item per component."""
+    if catalog == "icons":
+        return [dict(i) for i in (raw.get("icons") or []) if isinstance(i, dict)]
+    items = []
+    for category, entries in (raw or {}).items():
+        if not isinstance(entries, dict):
+            continue
+        for name, spec in entries.items():
+            if isinstance(spec, dict):
+                items.append({"id": f"{category}/{name}", "category": category, "name": name, **spec})
+    return items
 
 
-@app.route("/api/devices/<dev_id>/yaml", methods=["GET"])
-def api_get_device_yaml(dev_id):
-    db = _load_devices()
-    for d in db["devices"]:
-        if d.get("id") == dev_id:
-            yaml_text = d.get("yaml") or d.get("yaml_snapshot") or ""
-            if not yaml_text:
-                return jsonify({"error": "YAML not found"}), 404
-            filename = f"{(d.get('name') or 'device')}.yaml"
-            return Response(
-                yaml_text,
-                mimetype="application/x-yaml",
-                headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-            )
-    return jsonify({"error": "Not found"}), 404
+def _search_text(catalog: str, item: Dict[str, Any]) -> str:
+    if catalog == "icons":
+        parts = [item.get("name", "")] + list(item.get("tags") or []) + list(item.get("aliases") or [])
+    else:
+        parts = [item.get("name", ""), item.get("platform", ""), item.get("category", "")]
+        parts += [str(w) for w in item.get("werte") or []]
+    return " ".join(str(p) for p in parts).lower()
 
 
-@app.route("/api/devices", methods=["POST"])
-def api_upsert_device():
-    p = request.get_json(silent=True) or {}
-    db = _load_devices()
+class _CatalogIndex:
+    """
+    One catalog file, loaded once (reloaded when the file changes). Queries of
+    3+ characters go through a trigram index, shorter ones through sorted
+    token prefixes; candidates are verified by substring and ranked by
+    exact name > name prefix > name substring > other fields.
+    """
 
-    board_id = p.get("board_id") or p.get("board") or ""
-    board_label = p.get("board_label") or ""
-    raw_name = p.get("name", "")
-    norm_name = _normalize_name(raw_name)
-    friendly = p.get("friendly_name") or raw_name or norm_name
+    def __init__(self, catalog: str, path: Path):
+        self.catalog = catalog
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp: Optional[Tuple[int, int]] = None
+        self.etag = ""
+        self.items: List[Dict[str, Any]] = []
+        self.texts: List[str] = []
+        self.names: List[str] = []
+        self.trigrams: Dict[str, set] = {}
+        self.tokens: List[Tuple[str, int]] = []   # sortiert: (token, item index)
 
-    dev = {
-        "id": p.get("id") or None,
-        "name": norm_name,
-        "friendly_name": friendly,
-        "platform": p.get("platform", ""),
-        "board_id": board_id,
-        "board_label": board_label,
-        "board": board_id,  # legacy
-        "yaml": p.get("yaml") or p.get("yaml_snapshot") or "",
-        "yaml_snapshot": p.get("yaml_snapshot") or p.get("yaml") or "",
-        "config_json": p.get("config_json") or {},
-        "firmware_sha256": p.get("firmware_sha256"),
-        "ip": p.get("ip"),
-        "mac": p.get("mac"),
-        "tags": p.get("tags") or [],
-        "notes": p.get("notes") or "",
-        "flashed_at": p.get("flashed_at") or _iso_now(),
-        "history": p.get("history") or [],
-    }
+    def _ensure(self) -> None:
+        st = self.path.stat()
+        stamp = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if stamp == self.stamp:
+                return
+            raw_bytes = self.path.read_bytes()
+            items = _catalog_items(self.catalog, json.loads(raw_bytes.decode("utf-8")))
+            texts = [_search_text(self.catalog, i) for i in items]
+            trigrams: Dict[str, set] = {}
+            tokens: List[Tuple[str, int]] = []
+            for idx, text in enumerate(texts):
+                for k in range(len(text) - 2):
+                    trigrams.setdefault(text[k:k + 3], set()).add(idx)
+                for tok in set(t for t in _TOKEN_SPLIT_RE.split(text) if t):
+                    tokens.append((tok, idx))
+            tokens.sort()
+            self.items, self.texts = items, texts
+            self.names = [str(i.get("name", "")).lower() for i in items]
+            self.trigrams, self.tokens = trigrams, tokens
+            self.etag = hashlib.sha256(raw_bytes).hexdigest()[:16]
+            self.stamp = stamp
 
-    # upsert by id first
-    idx = None
-    if dev["id"]:
-        for i, d in enumerate(db["devices"]):
-            if d.get("id") == dev["id"]:
-                idx = i
+    def _candidates(self, q: str) -> List[int]:
+        if len(q) >= 3:
+            sets = sorted((self.trigrams.get(q[k:k + 3], set()) for k in range(len(q) - 2)), key=len)
+            found = set.intersection(*sets) if sets else set()
+            return [i for i in found if q in self.texts[i]]
+        lo = bisect.bisect_left(self.tokens, (q, -1))
+        found = set()
+        for tok, idx in self.tokens[lo:]:
+            if not tok.startswith(q):
                 break
+            found.add(idx)
+        return list(found)
 
-    # else upsert by (name + platform)
-    if idx is None and dev["name"] and dev["platform"]:
-        for i, d in enumerate(db["devices"]):
-            if _normalize_name(d.get("name", "")) == dev["name"] and d.get("platform") == dev["platform"]:
-                idx = i
-                dev["id"] = d.get("id")
-                break
+    def _rank(self, q: str, idx: int) -> Tuple[int, str]:
+        name = self.names[idx]
+        if name == q:
+            return 0, name
+        if name.startswith(q):
+            return 1, name
+        return (2 if q in name else 3), name
 
-    # update or insert
-    if idx is not None:
-        hist = db["devices"][idx].get("history", [])
-        if db["devices"][idx].get("flashed_at") or db["devices"][idx].get("firmware_sha256"):
-            hist.append({
-                "flashed_at": db["devices"][idx].get("flashed_at"),
-                "firmware_sha256": db["devices"][idx].get("firmware_sha256"),
-            })
-        dev["history"] = [h for h in hist if h.get("flashed_at")]
-        db["devices"][idx] = {**db["devices"][idx], **dev}
-    else:
-        dev["id"] = dev["id"] or str(uuid.uuid4())
-        db["devices"].append(dev)
+    def search(self, q: str = "", filters: Optional[Dict[str, str]] = None) -> Tuple[List[Dict[str, Any]], str]:
+        """Matching items (ranked) and the catalog ETag."""
+        self._ensure()
+        q = (q or "").strip().lower()
+        with self.lock:
+            idxs = self._candidates(q) if q else list(range(len(self.items)))
+            for field, want in (filters or {}).items():
+                want = want.lower()
+                idxs = [i for i in idxs if _catalog_field_matches(self.items[i].get(field), want)]
+            if q:
+                idxs.sort(key=lambda i: self._rank(q, i))
+            return [self.items[i] for i in idxs], self.etag
 
-    _save_devices(db)
-    return dev
 
+def _catalog_field_matches(value: Any, want: str) -> bool:
+    if isinstance(value, list):
+        return any(str(v).lower() == want for v in value)
+    return value is not None and str(value).lower() == want
 
-@app.route("/api/devices/<dev_id>", methods=["DELETE"])
-def api_delete_device(dev_id):
-    db = _load_devices()
-    before = len(db["devices"])
-    db["devices"] = [d for d in db["devices"] if d.get("id") != dev_id]
-    if len(db["devices"]) == before:
-        return jsonify({"error": "Not found"}), 404
-    _save_devices(db)
-    return jsonify({"ok": True}), 200
+
+_catalogs = {name: _CatalogIndex(name, CATALOG_DIR / rel) for name, rel in CATALOG_FILES.items()}
+
+
+def _preload_catalogs() -> None:
+    for index in _catalogs.values():
+        try:
+            index._ensure()
+        except (OSError, ValueError):
+            pass
+
+
+# erlaubte Filter je Katalog (?bus=i2c, ?tag=Math, ...)
+_CATALOG_FILTERS = {
+    "icons": {"tag": "tags"},
+    "sensors": {"bus": "bus", "category": "category", "platform": "platform"},
+    "templates": {"category": "category", "platform": "platform"},
+    "displays": {"bus": "bus", "category": "category", "platform": "platform"},
+}
+
+
+@app.route("/api/catalog/<catalog>", methods=["GET"])
+def api_catalog_search(catalog):
+    """
+    /api/catalog/icons?q=temp&limit=50&offset=0&fields=name,codepoint
+    /api/catalog/sensors?bus=i2c&q=bme
+    Paginated, ranked search; ETag covers catalog content + query.
+    """
+    index = _catalogs.get(catalog)
+    if index is None:
+        return jsonify({"error": f"Unknown catalog: {catalog}"}), 404
+    args = request.args
+    filters = {field: args[param] for param, field in _CATALOG_FILTERS[catalog].items() if args.get(param)}
+    try:
+        items, etag = index.search(args.get("q", ""), filters)
+    except (OSError, ValueError) as e:
+        return jsonify({"error": f"Catalog not available: {e}"}), 500
+
+    limit = min(CATALOG_MAX_LIMIT, max(1, args.get("limit", type=int) or CATALOG_DEFAULT_LIMIT))
+    offset = max(0, args.get("offset", type=int) or 0)
+    page = items[offset:offset + limit]
+    fields = [f for f in (args.get("fields") or "").split(",") if f]
+    if fields:
+        page = [{k: it[k] for k in fields if k in it} for it in page]
+
+    query = "&".join(f"{k}={v}" for k, v in sorted(args.items(multi=True)))
+    resp = jsonify({
+        "catalog": catalog,
+        "total": len(items),
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + limit if offset + limit < len(items) else None,
+        "items": page,
+    })
+    resp.set_etag(hashlib.sha256(f"{etag}?{query}".encode("utf-8")).hexdigest()[:24])
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
 
 
 # =========================
-# Scanning (simple TCP)
+# Static assets (precompressed, ETag, Range)
 # =========================
-@app.route('/scan', methods=['GET'])
-def scan():
+STATIC_CACHE_DIR = Path(DATA_DIR) / "static_cache"   # <sha256>.gz / .br, content-addressed
+STATIC_MIN_COMPRESS = 1024
+STATIC_COMPRESSIBLE = {
+    ".js", ".mjs", ".json", ".wasm", ".html", ".css", ".txt", ".svg", ".map",
+    ".symbols", ".otf", ".ttf", ".frag", ".bin",
+}
+STATIC_IMMUTABLE_AGE = 365 * 24 * 3600
+# Dateinamen mit Content-Hash (main.3f2a9c1d.js) ändern sich nie
+_HASHED_NAME_RE = re.compile(r'[.-][0-9a-fA-F]{8,}\.[A-Za-z0-9]+$')
+
+mimetypes.add_type("application/wasm", ".wasm")
+mimetypes.add_type("text/javascript", ".mjs")
+
+
+class _StaticAssets:
     """
-    Simple TCP port scan across a /24 subnet.
-    Example: /scan?subnet=192.168.178&ports=80,6053
+    Serves WWW_DIR. Per file the SHA-256 is computed once (cached by size+mtime)
+    and used as strong ETag; .gz/.br variants are built once in the background
+    under STATIC_CACHE_DIR and picked by Accept-Encoding. www/firmware is
+    dynamic and served as-is.
     """
-    subnet = request.args.get('subnet', '192.168.178')
-    ports_raw = request.args.get('ports', '80')
-    ports = [int(p.strip()) for p in ports_raw.split(',') if p.strip().isdigit()]
 
-    found_devices = []
-    for i in range(1, 255):
-        ip = f"{subnet}.{i}"
-        open_ports = []
-        for port in ports:
+    ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, root: str, cache_dir: Path):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}   # path -> (size, mtime_ns, sha)
+
+    def _compressible(self, rel: str, size: int) -> bool:
+        return (size >= STATIC_MIN_COMPRESS
+                and not rel.startswith("firmware/")
+                and (os.path.splitext(rel)[1].lower() in STATIC_COMPRESSIBLE
+                     or rel.endswith("NOTICES")))
+
+    def digest(self, path: str, st: os.stat_result) -> str:
+        with self.lock:
+            hit = self.hashes.get(path)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            return hit[2]
+        sha = _sha256_file(path)
+        with self.lock:
+            self.hashes[path] = (st.st_size, st.st_mtime_ns, sha)
+        return sha
+
+    def variant(self, sha: str, suffix: str) -> Path:
+        return self.cache_dir / f"{sha}{suffix}"
+
+    def _build_variants(self, path: str, sha: str) -> None:
+        raw = None
+        for enc, suffix in self.ENCODINGS:
+            dst = self.variant(sha, suffix)
+            if dst.exists() or (enc == "br" and brotli is None):
+                continue
+            if raw is None:
+                with open(path, "rb") as f:
+                    raw = f.read()
+            data = brotli.compress(raw, quality=11) if enc == "br" else gzip.compress(raw, 9, mtime=0)
+            if len(data) >= len(raw):
+                data = b""   # lohnt nicht -> leerer Marker, es wird unkomprimiert ausgeliefert
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp = dst.with_name(f".{dst.name}.{uuid.uuid4().hex}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, dst)
+
+    def warm(self) -> None:
+        """Hash + precompress the whole bundle (runs once at startup)."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel_dir = os.path.relpath(dirpath, self.root)
+            if rel_dir == "firmware" or rel_dir.startswith("firmware" + os.sep):
+                dirnames[:] = []
+                continue
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+                try:
+                    st = os.stat(path)
+                    if self._compressible(rel, st.st_size):
+                        self._build_variants(path, self.digest(path, st))
+                except OSError:
+                    traceback.print_exc()
+        # Varianten alter Bundles aufräumen
+        live = {sha for _, _, sha in self.hashes.values()}
+        if self.cache_dir.is_dir():
+            for f in self.cache_dir.iterdir():
+                if f.name.split(".", 1)[0] not in live and not f.name.startswith("."):
+                    f.unlink()
+
+    def warm_async(self) -> None:
+        threading.Thread(target=self.warm, name="static-warm", daemon=True).start()
+
+    def _pick_encoding(self, sha: str) -> Tuple[Optional[str], Optional[Path]]:
+        for enc, suffix in self.ENCODINGS:
+            if request.accept_encodings[enc] <= 0:
+                continue
+            path = self.variant(sha, suffix)
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(0.25)
-                result = sock.connect_ex((ip, port))
-                sock.close()
-                if result == 0:
-                    open_ports.append(port)
-            except Exception:
-                pass
-        if open_ports:
-            found_devices.append({"ip": ip, "ports": open_ports})
+                if path.stat().st_size > 0:
+                    return enc, path
+            except OSError:
+                continue
+        return None, None
+
+    def serve(self, rel: str) -> Response:
+        path = safe_join(self.root, rel)
+        if path is None or not os.path.isfile(path):
+            return jsonify({"error": "Not found"}), 404
+        st = os.stat(path)
+        mimetype = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+        compressible = self._compressible(rel, st.st_size)
+        sha = self.digest(path, st)
+
+        enc, variant = self._pick_encoding(sha) if compressible else (None, None)
+        resp = send_file(
+            str(variant or path),
+            mimetype=mimetype,
+            conditional=True,
+            etag=f"{sha}-{enc}" if enc else sha,
+            last_modified=st.st_mtime,
+            max_age=None,
+        )
+        if enc:
+            resp.headers["Content-Encoding"] = enc
+        if compressible:
+            resp.vary.add("Accept-Encoding")
+        if _HASHED_NAME_RE.search(rel) or request.args.get("v"):
+            resp.headers["Cache-Control"] = f"public, max-age={STATIC_IMMUTABLE_AGE}, immutable"
+        else:
+            # ungehashte Flutter-Dateien: immer revalidieren (304 per ETag)
+            resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+
+_static = _StaticAssets(WWW_DIR, STATIC_CACHE_DIR)
+
+
+# =========================
+# Firmware downloads (Range, ETag = SHA-256, transfer stats)
+# =========================
+FIRMWARE_TRANSFER_HISTORY = 200
+
+
+class _FirmwareTransfers:
+    """Per-download bytes/duration/throughput; the last N transfers plus totals."""
+
+    def __init__(self, keep: int):
+        self.lock = threading.Lock()
+        self.recent: List[Dict[str, Any]] = []
+        self.keep = keep
+        self.totals = {"transfers": 0, "bytes": 0, "seconds": 0.0, "not_modified": 0, "partial": 0}
 
-    return jsonify(found_devices)
+    def record(self, filename: str, status: int, nbytes: int, seconds: float, client: Optional[str]) -> None:
+        item = {
+            "file": filename,
+            "status": status,
+            "bytes": nbytes,
+            "seconds": round(seconds, 4),
+            "bytes_per_s": round(nbytes / seconds) if seconds > 0 else None,
+            "client": client,
+            "at": _iso_now(),
+        }
+        M_FW_BYTES.inc(nbytes, status=str(status))
+        M_FW_TRANSFER.observe(seconds, status=str(status))
+        with self.lock:
+            self.recent = (self.recent + [item])[-self.keep:]
+            t = self.totals
+            if status == 304:
+                t["not_modified"] += 1
+                return
+            t["transfers"] += 1
+            t["bytes"] += nbytes
+            t["seconds"] += seconds
+            if status == 206:
+                t["partial"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            t = dict(self.totals)
+            recent = list(self.recent)
+        t["seconds"] = round(t["seconds"], 3)
+        t["avg_bytes_per_s"] = round(t["bytes"] / t["seconds"]) if t["seconds"] > 0 else None
+        return {"totals": t, "recent": recent}
+
+
+_fw_transfers = _FirmwareTransfers(FIRMWARE_TRANSFER_HISTORY)
+
+
+def _published_sha256(filename: str, size: int) -> Optional[str]:
+    """SHA-256 of a published <name>.bin from its manifest (avoids re-hashing)."""
+    if not filename.endswith(".bin") or "/" in filename:
+        return None
+    try:
+        with open(os.path.join(OUTPUT_DIR, filename[:-4] + ".manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for build in manifest.get("builds", []):
+            for part in build.get("parts", []):
+                if part.get("path") == f"firmware/{filename}" and part.get("size") == size:
+                    return part.get("sha256")
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+@app.route("/firmware/<path:filename>", methods=["GET", "HEAD"])
+def firmware_download(filename):
+    """
+    Firmware + manifests from OUTPUT_DIR. send_file hands the open file to the
+    server's wsgi.file_wrapper (sendfile where supported), handles Range/If-Range
+    and If-None-Match; a transfer is recorded when the server closes the body.
+    """
+    path = safe_join(OUTPUT_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Not found"}), 404
+    st = os.stat(path)
+    sha = _published_sha256(filename, st.st_size) or _static.digest(path, st)
+    mimetype = "application/json" if filename.endswith(".json") else "application/octet-stream"
+
+    started = time.monotonic()
+    resp = send_file(path, mimetype=mimetype, conditional=True, etag=sha,
+                     last_modified=st.st_mtime, max_age=None)
+    # Name bleibt gleich, Inhalt nicht -> immer revalidieren
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Accept-Ranges"] = "bytes"
+    if filename.endswith(".bin"):
+        resp.headers["X-Firmware-SHA256"] = sha
+
+    if request.method != "GET":
+        return resp
+    status, client = resp.status_code, request.remote_addr
+    if status == 304:
+        _fw_transfers.record(filename, status, 0, time.monotonic() - started, client)
+        return resp
+    nbytes = resp.content_length or 0
+    # direct_passthrough umgeht call_on_close -> close() des File-Wrappers einhaken,
+    # den ruft der Server erst nach dem letzten Byte (Wrapper-Typ bleibt für sendfile erhalten)
+    body = resp.response
+    orig_close = getattr(body, "close", None)
+
+    def _close():
+        try:
+            if orig_close:
+                orig_close()
+        finally:
+            _fw_transfers.record(filename, status, nbytes, time.monotonic() - started, client)
+
+    try:
+        body.close = _close
+    except AttributeError:
+        resp.call_on_close(_close)
+    return resp
+
+
+@app.route("/firmware/stats", methods=["GET"])
+def firmware_stats():
+    return jsonify(_fw_transfers.snapshot()), 200
 
 
 # =========================
@@ -699,7 +5679,12 @@ def scan():
 # =========================
 @app.route("/")
 def index():
-    return send_from_directory(app.static_folder, "index.html")
+    return _static.serve("index.html")
+
+
+@app.route("/<path:filename>", methods=["GET", "HEAD"])
+def static_file(filename):
+    return _static.serve(filename)
 
 
 @app.route("/firmware/list", methods=["GET"])
@@ -717,9 +5702,59 @@ def ping():
     return "pong"
 
 
+# Zustandswerte werden erst beim Scrape gelesen
+_Gauge("espflasher_job_queue_depth", "Jobs waiting for a build worker.", fn=lambda: _scheduler.depth())
+_Gauge("espflasher_jobs_running", "Jobs currently running.", fn=lambda: len(_scheduler.running))
+_Gauge("espflasher_build_workers", "Configured build workers.", fn=lambda: _scheduler.workers)
+_Gauge("espflasher_stream_slots_active", "Long-running responses holding a server thread.",
+       fn=lambda: _stream_slots.stats()["active"])
+_Gauge("espflasher_build_cache_hit_ratio", "Build cache hits / lookups since start.",
+       fn=lambda: _build_cache.stats()["hit_rate"])
+_Gauge("espflasher_build_cache_bytes", "Size of cached firmware artifacts.",
+       fn=lambda: _build_cache.stats()["bytes"])
+_Gauge("espflasher_registry_devices", "Devices in the registry.", fn=lambda: len(_registry.all()))
+_Gauge("espflasher_mdns_nodes", "ESPHome nodes currently announced via mDNS.",
+       fn=lambda: sum(1 for n in _mdns.snapshot() if n["online"]))
+_Gauge("espflasher_scan_jobs_running", "Background scan jobs not yet finished.",
+       fn=lambda: sum(1 for j in list(_scan_jobs.values()) if not j.finished))
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition (version 0.0.4)."""
+    lines: List[str] = []
+    for m in list(_metrics):
+        lines.extend(m.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
 # =========================
 # Entrypoint
 # =========================
+def start_background_services() -> None:
+    """Threads the serving process needs; not started on import (tests, validation workers)."""
+    _validation.prewarm()
+    if MDNS_ENABLED:
+        _mdns.start()
+    _static.warm_async()
+    threading.Thread(target=_preload_catalogs, name="catalog-load", daemon=True).start()
+    if BUILD_WARMUP_ON_START:
+        _build_warmup.start_async(WARMUP_START_DELAY)
+
+
 if __name__ == "__main__":
-    # For local testing; in HA add-on this is managed by s6.
-    app.run(host="0.0.0.0", port=8099)
+    start_background_services()
+    if SERVER_MODE != "dev" and waitress_serve is not None:
+        # Feste Thread-Zahl; Streams sind über _stream_slots begrenzt, der Rest bleibt für /ping & Co.
+        waitress_serve(
+            app,
+            host="0.0.0.0",
+            port=SERVER_PORT,
+            threads=SERVER_THREADS,
+            connection_limit=SERVER_CONNECTION_LIMIT,
+            channel_timeout=300,
+            ident="espflasher",
+        )
+    else:
+        # Lokales Testen / waitress fehlt: Werkzeug-Devserver, aber threaded
+        app.run(host="0.0.0.0", port=SERVER_PORT, threaded=True)
@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+_DATA = tempfile.mkdtemp(prefix="espflasher-test-")
+os.environ.setdefault("ESPFLASHER_DATA_DIR", _DATA)
+os.environ.setdefault("ESPFLASHER_WWW_DIR", _DATA)
+os.environ.setdefault("ESPFLASHER_MDNS_DISCOVERY", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "espflasher_web"))
+
+import server  # noqa: E402
+
+
+class BuildCacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.bin = self.root / "firmware.bin"
+        self.bin.write_bytes(b"\xe9" * 4096)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_zero_budget_bypasses_cache(self):
+        cache = server._BuildCache(self.root / "cache", 0, 500)
+        entry = cache.store("k1", str(self.bin), "dev")
+        self.assertEqual(entry["path"], str(self.bin))
+        self.assertEqual(entry["size"], 4096)
+        self.assertEqual(entry["sha256"], server._sha256_file(str(self.bin)))
+        self.assertTrue(self.bin.exists())
+        self.assertIsNone(cache.lookup("k1"))
+
+    def test_artifact_larger_than_budget_bypasses_cache(self):
+        cache = server._BuildCache(self.root / "cache", 1024, 500)
+        entry = cache.store("k1", str(self.bin), "dev")
+        self.assertEqual(entry["path"], str(self.bin))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_store_never_evicts_the_new_entry(self):
+        cache = server._BuildCache(self.root / "cache", 6000, 500)
+        cache.store("old", str(self.bin), "dev")
+        self.bin.write_bytes(b"\x00" * 4096)
+        entry = cache.store("new", str(self.bin), "dev")
+        self.assertTrue(os.path.exists(entry["path"]))
+        self.assertIsNone(cache.lookup("old"))
+        self.assertEqual(cache.lookup("new")["sha256"], entry["sha256"])
+
+
+if __name__ == "__main__":
+    unittest.main()